@@ -0,0 +1,169 @@
+#!/usr/bin/env python3
+
+# For using the scripts from Python, without shelling out: tagging, cover lookup, extraction and conversion
+# Nothing here exits, prompts or sets up logging (the logger is applogger, "album-art-script"),
+# results come back as named tuples. Imports and caches stay warm between calls, so a long-running
+# service pays for mutagen/PIL and the cover lookups once
+# Names (and keyword arguments) follow PEP 8 here, it's what other Python code expects to import
+#
+#   import albumart
+#   result = albumart.process_album("/music/Some Album", albumart.options(copy_cover=True))
+#   print(result.tagged, result.failed)
+
+import threading
+from collections import namedtuple
+from os import listdir as listDir
+from os.path import join
+
+import albumtagger
+import artconverter
+import artextractor
+from resizer import setDecodeSlots, DEFAULT_MAX_DECODED_IMAGES
+from statedb import ACTION_ADD, ACTION_SKIP, RESULT_OK, RESULT_FAILED
+
+RESULT_UNCHANGED = "unchanged"  # skipped after a stat(), see --state-db
+RESULT_NO_COVER = "no cover"  # nothing found automatically and no cover given
+
+# result is statedb's RESULT_OK/RESULT_FAILED, or one of the above
+TrackResult = namedtuple("TrackResult", ["path", "action", "result", "cover"])
+AlbumResult = namedtuple(
+    "AlbumResult", ["dir", "tracks", "tagged", "failed", "unresolved"]
+)
+ExtractedCover = namedtuple("ExtractedCover", ["track", "mime", "ext", "data", "path"])
+# outcome is one of "converted", "upToDate", "noArt" or "failed"
+ConvertedCover = namedtuple("ConvertedCover", ["dir", "outcome", "path"])
+
+# Same limit as the command line, a service calling in from many threads doesn't decode more at once
+setDecodeSlots(threading.BoundedSemaphore(DEFAULT_MAX_DECODED_IMAGES))
+
+
+def buildOptions(argparser, overrides):
+    # The command line defaults, with overrides by their argparse names (copy_cover=True, not --copy-cover)
+    args = argparser.parse_args(["."])
+    for name, value in overrides.items():
+        if not hasattr(args, name):
+            raise TypeError(f"Unknown option {name}")
+        setattr(args, name, value)
+    return args
+
+
+def options(**overrides):
+    # Options for process_album()/process_tracks(), e.g. options(edit_all=True, state_db="state.sqlite")
+    args = buildOptions(albumtagger.buildArgumentParser(), overrides)
+    if albumtagger.checkArguments(args) is None:
+        raise ValueError(f"Options don't go together: {overrides}")
+    return args
+
+
+def toTrackResults(stats, unchangedPaths):
+    results = [
+        TrackResult(songPath, ACTION_SKIP, RESULT_UNCHANGED, None)
+        for songPath in unchangedPaths
+    ]
+    results.extend(
+        TrackResult(
+            result["path"], result["action"], result["result"], result["coverPath"]
+        )
+        for result in stats["results"]
+    )
+    results.extend(
+        TrackResult(songPath, ACTION_ADD, RESULT_NO_COVER, None)
+        for songPath in stats["unresolved"]
+    )
+    return results
+
+
+def process_tracks(paths, opts=None, cover=None):
+    # Tags the tracks album by album, cover (a path) is used for all of them instead of looking for one
+    # Returns a TrackResult per track
+    opts = opts or options()
+    stateDb = albumtagger.openStateDb(opts)
+    results = []
+    try:
+        for albumDir, songPaths in albumtagger.groupByAlbum(paths).items():
+            # The dir may have changed since the last call, a new cover for one
+            albumtagger.forgetCoverIndex(albumDir)
+            stats = albumtagger.newStats()
+            changedPaths = albumtagger.filterUnchangedTracks(
+                songPaths, opts, stateDb, stats
+            )
+            changedSet = set(changedPaths)
+            if changedPaths:
+                # A track that can't be read comes back as a failed TrackResult, it doesn't raise
+                albumtagger.processAlbumSafe(changedPaths, opts, stats, cover)
+            if stateDb is not None:
+                stateDb.record(stats["results"])
+            albumtagger.takeResizeCacheCounters(stats)
+            results.extend(
+                toTrackResults(
+                    stats,
+                    [songPath for songPath in songPaths if songPath not in changedSet],
+                )
+            )
+    finally:
+        if stateDb is not None:
+            stateDb.close()
+    return results
+
+
+def process_album(album_dir, opts=None, cover=None):
+    # Tags every track in album_dir (not the dirs under it), returns an AlbumResult
+    tracks = process_tracks(albumtagger.listTracks(album_dir), opts, cover)
+    return AlbumResult(
+        album_dir,
+        tracks,
+        sum(
+            track.result == RESULT_OK and track.action != ACTION_SKIP
+            for track in tracks
+        ),
+        sum(track.result == RESULT_FAILED for track in tracks),
+        sum(track.result == RESULT_NO_COVER for track in tracks),
+    )
+
+
+def find_cover(album_dir, opts=None):
+    # The cover the tagging would use for album_dir, or None; nothing is resized or copied
+    opts = opts or options()
+    albumtagger.forgetCoverIndex(album_dir)
+    coverPath, _ = albumtagger.checkForCommonAlbumArtNames(
+        join(album_dir, ""),
+        albumtagger.COMMON_ART_NAMES,
+        opts.copy_cover_name,
+        opts.cover_resize_name,
+        opts.cover_save_extension,
+    )
+    return coverPath
+
+
+def extract_cover(track, save_dir=None, save_name=artextractor.DEFAULT_SAVE_NAME):
+    # The front cover (or first picture) embedded in the track as an ExtractedCover, None if there isn't one
+    # With save_dir it's also written there as save_name.<ext>, bytes as they are
+    picture = artextractor.extractImageFromTrack(track)
+    if picture is None:
+        return None
+    imageMimeType, imageData = picture
+    imagePath = None
+    if save_dir is not None:
+        imagePath = artextractor.saveImage(
+            imageMimeType, imageData, save_dir, save_name
+        )
+    return ExtractedCover(
+        track,
+        imageMimeType,
+        artextractor.imageExtension(imageMimeType, imageData),
+        imageData,
+        imagePath,
+    )
+
+
+def convert_cover(album_dir, **overrides):
+    # Makes cover.jpg in album_dir the way convert-album-art-to-jpg.py does, returns a ConvertedCover
+    # overrides are its options, e.g. convert_cover(album_dir, resize_dimensions=600, force=True)
+    args = buildOptions(artconverter.buildArgumentParser(), overrides)
+    outcome, _ = artconverter.convertDir(album_dir, listDir(album_dir), args)
+    convertedPath = (
+        join(album_dir, artconverter.WANTED_FILENAME)
+        if outcome in ("converted", "upToDate")
+        else None
+    )
+    return ConvertedCover(album_dir, outcome, convertedPath)
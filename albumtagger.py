@@ -0,0 +1,2472 @@
+#!/usr/bin/env python3
+
+# Everything album-art-script.py does, importable; see albumart.py for the functions meant to be used from Python
+
+# For parsing the commandline arguments
+import argparse
+
+import heapq
+import itertools
+import threading
+from collections import OrderedDict, deque
+
+# For --jobs, the pools themselves are imported when they're needed
+from os import cpu_count as cpuCount
+
+# System file handling stuff
+from os import scandir as scanDir
+from os import fstat, stat
+from os.path import basename, dirname, join, getsize, getmtime
+from os.path import exists as fileExists
+from os.path import isdir as isDir
+from os.path import splitext as fileExtension
+
+# Heavy stuff (tkinter for the file dialog in coverprompt.py, mutagen for tags, PIL for resizing) is imported
+# inside the functions that use it, so e.g. a track that already has art doesn't pay for any of it
+# Startup time is kept in check by benchmarks/startup.py
+
+# Needed for ogg album art
+import base64
+
+# For the batch run summary
+from time import perf_counter as perfCounter
+
+# Cover resizing, shared with convert-album-art-to-jpg.py
+from resizer import resizeImage, ResizeError
+from resizer import DEFAULT_JPEG_QUALITY, DEFAULT_JPEG_SUBSAMPLING, JPEG_SUBSAMPLINGS
+from resizer import DEFAULT_MAX_DECODE_MEGAPIXELS, DEFAULT_MAX_DECODED_IMAGES
+from resizer import setDecodeSlots
+from resizecache import ResizeCache, DEFAULT_RESIZE_CACHE_SIZE_MB
+from io import BytesIO
+
+# Header-only checks for art that's already embedded
+from artprobe import probeMP3, probeOGG, probeFLAC, flacAudioOffset, ProbeError
+from artprobe import oggCommentPagesEnd, openSong
+from artprobe import mp3PictureSizes, oggPictureSizes, flacPictureSizes
+
+# Covers are mapped, not read, so worker processes share them
+# writeReplacing() is for copying user-selected album art as a standard cover file,
+# for example, to not ask for future track files for this album, and for resized covers
+from covermap import loadCover, writeReplacing
+
+# Logging setup has been offloaded to a separate module, logger.py
+# applogger is the logger to call, defined in logger.py
+import logging
+from logger import applogger, setupLogging, RecordCollectingHandler
+from logger import DEFAULT_TERMINAL_LEVEL, DEFAULT_FILE_LEVEL
+
+# Optional state for incremental re-runs, see --state-db
+from statedb import TrackStateDB
+from statedb import ACTION_ADD, ACTION_REPLACE, ACTION_SKIP, RESULT_OK, RESULT_FAILED
+
+# Per-stage timings and I/O counters, see --metrics
+from metrics import metrics, timedStage, buildReport, writeReport, METRICS_FORMATTERS
+
+# Asking for the covers that can't be found automatically, see --no-prompt
+from coverprompt import openPrompter, writeUnresolved
+
+# Looking up the covers that can't be found locally, see --fetch-covers
+from coverfetch import CoverFetcher, COVER_SOURCES, DEFAULT_FETCH_JOBS
+from coverfetch import DEFAULT_USER_AGENT
+
+# Long-running mode, see --watch
+from watcher import openWatcher, DEFAULT_POLL_INTERVAL
+
+# Two-phase mode, see --plan
+from planner import newPlan, savePlan, loadPlan, countPlanActions, PlanError
+from planner import localityKey, sortByLocality, DEFAULT_IO_CONCURRENCY
+from planner import PLAN_ADD, PLAN_REPLACE, PLAN_SKIP, PLAN_RESIZE, PLAN_COPY
+
+
+COMMON_ART_NAME_MAIN = [
+    "cover",
+    "Cover",
+    "COVER",
+    "cover0",
+    "folder",
+    "Folder",
+    "FOLDER",
+    "album_art",
+    "Album_art",
+    "ALBUM_ART",
+    "albumart",
+    "Albumart",
+    "AlbumArt",
+    "ALBUMART",
+]
+COMMON_ART_NAME_EXT = ["jpg", "Jpg", "jpeg", "Jpeg", "JPG", "JPEG", "png", "Png", "PNG"]
+COMMON_ART_NAMES = [
+    ".".join(combo)
+    for combo in itertools.product(COMMON_ART_NAME_MAIN, COMMON_ART_NAME_EXT)
+]
+MIME_TYPES = {"jpg": "image/jpg", "png": "image/png", "jpeg": "image/jpg"}
+DEFAULT_RESIZE_DIM = 1024
+DEFAULT_SAVE_NAME = "cover"
+DEFAULT_RESIZED_SAVE_NAME = "cover_resized"
+DEFAULT_SAVE_EXT = "jpg"
+SUPPORTED_TRACK_EXTS = ["mp3", "ogg", "flac"]
+WATCH_EXTS = SUPPORTED_TRACK_EXTS + list(MIME_TYPES)
+# --watch: how long an album dir has to be quiet before it's processed, so a copy in progress is done once
+DEFAULT_WATCH_DEBOUNCE = 5.0
+# What the last run left in a dir, to tell our own writes from new files; dirs over this are forgotten
+WATCH_SNAPSHOT_MAX_DIRS = 4096
+# When a track has to be rewritten anyway, leave at least this much padding so the next cover fits in place
+FLAC_MIN_REWRITE_PADDING = 256 * 1024
+MP3_MIN_REWRITE_PADDING = 64 * 1024
+OGG_MIN_REWRITE_PADDING = 64 * 1024
+
+# --audit-art/--shrink-art: embedded pictures over this are oversized, unless --max-cover-size says otherwise
+DEFAULT_MAX_EMBEDDED_SIZE_MB = 1.0
+AUDIT_WORST_OFFENDERS = 10
+
+# How many albums per worker can be queued up in --jobs mode
+ALBUMS_IN_FLIGHT_PER_JOB = 4
+# How far the tree walk can get ahead of the tagging in --recursive mode
+ALBUMS_PREFETCHED = 64
+
+# Cover lookup results, keyed by (dir, names to look for), least recently used dirs get dropped first
+COVER_INDEX_MAX_DIRS = 4096
+coverIndex = OrderedDict()
+
+# See --resize-cache and getResizeCache()
+resizeCache = None
+
+# Cover bytes and the ready-to-embed frames built from them, keyed by (image path, mtime, MIME type)
+# Covers can be tens of megs, so only a handful of them are kept around, and no more than
+# --cover-buffer-mb of them (the one in use is always kept, however big it is)
+# Big ones are mapped from the file (see covermap.py), the rest is private to the process
+PICTURE_CACHE_MAX_ENTRIES = 8
+DEFAULT_COVER_BUFFER_MB = 64
+pictureCache = OrderedDict()
+pictureCacheMaxBytes = DEFAULT_COVER_BUFFER_MB * 1024 * 1024
+# Most the picture cache has held at once in this process, for the run summary
+coverMemoryPeaks = {"private": 0, "mapped": 0}
+
+# --shrink-art results, keyed by the hash of the embedded picture, so every copy of it is resized once
+# Tracks are gone through album by album, and an album usually has the same picture in every track
+SHRUNK_PICTURE_CACHE_MAX_ENTRIES = 32
+shrunkPictureCache = OrderedDict()
+
+# --plan/--execute-plan, --list-artless, --audit-art and --shrink-art go through tracks on a thread pool,
+# and these caches are shared by all of it; anything that looks into, adds to, evicts from or
+# goes through one of them holds this
+cacheLock = threading.Lock()
+
+
+@timedStage("tag")
+def addAlbumArtToSong(
+    songPath, imagePath, imageMimeType, writeStats=None, trackFile=None, songFile=None
+):
+    # trackFile is the track already opened by openTrack(), songFile the tags probeTrack() parsed
+    # from it if it had to; with both, the track is read once and written once
+    songExt = fileExtension(songPath)[1].lower().strip(".")
+    tagArgs = (imagePath, imageMimeType, writeStats, trackFile, songFile)
+
+    if songExt == "mp3":
+        return addAlbumArtToMP3(songPath, *tagArgs)
+    elif songExt == "ogg":
+        return addAlbumArtToOGG(songPath, *tagArgs)
+    elif songExt == "flac":
+        return addAlbumArtToFLAC(songPath, *tagArgs)
+    else:
+        applogger.error(
+            f"File type {songExt} is not supported for track {songPath}, exiting..."
+        )
+        return -1
+
+
+def pictureEntryBytes(entry):
+    # The frames share the data, only the base64'd copy for Ogg comes on top
+    return len(entry["data"]) + len(entry.get("vorbis", ""))
+
+
+def notePictureCacheMemory():
+    with cacheLock:
+        entries = list(pictureCache.values())
+    mapped = sum(len(entry["data"]) for entry in entries if entry["mapped"])
+    private = sum(pictureEntryBytes(entry) for entry in entries) - mapped
+    coverMemoryPeaks["mapped"] = max(coverMemoryPeaks["mapped"], mapped)
+    coverMemoryPeaks["private"] = max(coverMemoryPeaks["private"], private)
+
+
+def takeCoverMemoryPeaks(stats):
+    for kind, peak in coverMemoryPeaks.items():
+        stats["coverMemory"][kind] = max(stats["coverMemory"][kind], peak)
+
+
+def cachePictureData(imagePath, imageMimeType, imageData, mapped=False):
+    # Cover hashes are for --state-db
+    from hashlib import sha1
+
+    key = (imagePath, getmtime(imagePath), imageMimeType)
+    entry = {
+        "data": imageData,
+        "mapped": mapped,
+        "mime": imageMimeType,
+        "hash": sha1(imageData).hexdigest(),
+    }
+    with cacheLock:
+        pictureCache[key] = entry
+        pictureCache.move_to_end(key)
+        cachedBytes = sum(pictureEntryBytes(cached) for cached in pictureCache.values())
+        while len(pictureCache) > 1 and (
+            len(pictureCache) > PICTURE_CACHE_MAX_ENTRIES
+            or cachedBytes > pictureCacheMaxBytes
+        ):
+            _, evicted = pictureCache.popitem(last=False)
+            cachedBytes -= pictureEntryBytes(evicted)
+    notePictureCacheMemory()
+    return entry
+
+
+def getCachedPicture(imagePath, imageMimeType):
+    # Reads the cover once, every other track of the album reuses the same entry
+    # mtime is in the key, so a cover that's been changed on disk is picked up again
+    key = (imagePath, getmtime(imagePath), imageMimeType)
+    with cacheLock:
+        if key in pictureCache:
+            pictureCache.move_to_end(key)
+            return pictureCache[key]
+
+    applogger.debug("Reading %s for embedding...", imagePath)
+    with metrics.stage("cover.read"):
+        imageData, mapped = loadCover(imagePath)
+    metrics.count(
+        "io.coverBytesMapped" if mapped else "io.coverBytesRead", len(imageData)
+    )
+    return cachePictureData(imagePath, imageMimeType, imageData, mapped)
+
+
+def getCachedAPIC(imagePath, imageMimeType):
+    from mutagen.id3 import APIC
+
+    picture = getCachedPicture(imagePath, imageMimeType)
+    if picture["mapped"]:
+        # ID3 frames only take bytes, a cached frame would be a private copy of the cover
+        # in every process, so this one's made for the one write and dropped again
+        return APIC(
+            encoding=3,
+            mime=imageMimeType,
+            type=3,
+            desc="Cover",
+            data=picture["data"][:],
+        )
+    if "apic" not in picture:
+        # Encoding = 3 is Encoding.UTF8, type = 3 is PictureType.COVER_FRONT
+        picture["apic"] = APIC(
+            encoding=3, mime=imageMimeType, type=3, desc="Cover", data=picture["data"]
+        )
+    return picture["apic"]
+
+
+def getCachedFLACPicture(imagePath, imageMimeType):
+    picture = getCachedPicture(imagePath, imageMimeType)
+    if "flac" not in picture:
+        from mutagen.flac import Picture as MutagenFLACPicture
+
+        image = MutagenFLACPicture()
+        image.data = picture["data"]
+        image.type = 3  # 3 is for album art
+        image.mime = imageMimeType
+        image.desc = "Cover"
+        picture["flac"] = image
+    return picture["flac"]
+
+
+def getCachedVorbisPicture(imagePath, imageMimeType):
+    picture = getCachedPicture(imagePath, imageMimeType)
+    if "vorbis" not in picture:
+        # OGG wants the FLAC picture block base64'd inside a comment
+        image = getCachedFLACPicture(imagePath, imageMimeType)
+        picture["vorbis"] = base64.b64encode(image.write()).decode("ascii")
+        notePictureCacheMemory()
+    return picture["vorbis"]
+
+
+def keepOrGrowPadding(reserve):
+    # mutagen padding callback: if the new tags fit into the old tags + padding, keep whatever
+    # padding is left, so only the metadata gets rewritten in place (mutagen's default would
+    # shrink big padding, which moves the whole audio stream)
+    # If they don't fit the file has to be rewritten anyway, so leave `reserve` bytes for next time
+    # The decision is kept in the returned list, see countWrittenBytes()
+    decisions = []
+
+    def padding(info):
+        chosen = info.padding if info.padding >= 0 else reserve
+        decisions.append((info, chosen))
+        return chosen
+
+    return padding, decisions
+
+
+def reclaimPadding(reserve):
+    # keepOrGrowPadding() for --shrink-art: everything a smaller picture leaves behind would turn into
+    # padding there, and the file wouldn't get any smaller on disk
+    # So unless there's no more than `reserve` bytes left over, the file is rewritten with that much
+    decisions = []
+
+    def padding(info):
+        chosen = info.padding if 0 <= info.padding <= reserve else reserve
+        decisions.append((info, chosen))
+        return chosen
+
+    return padding, decisions
+
+
+def countWrittenBytes(songPath, decisions, writeStats, trackFile=None, tagSize=None):
+    # info.size is the audio data following the metadata, that's only rewritten if the padding changed
+    # ID3 counts it from the start of the tag instead, so MP3s pass the old tag size (padding included),
+    # which is what a tag rewritten in place comes to
+    if not decisions:
+        return
+    info, chosen = decisions[-1]
+    if trackFile is None:
+        fileSize = getsize(songPath)
+    else:
+        trackFile.flush()
+        fileSize = fstat(trackFile.fileno()).st_size
+    inPlace = chosen == info.padding
+    if not inPlace:
+        bytesWritten = fileSize
+    elif tagSize is not None:
+        bytesWritten = tagSize
+    else:
+        bytesWritten = fileSize - info.size
+    applogger.info(
+        "Wrote %s bytes to %s (%s)",
+        bytesWritten,
+        songPath,
+        "in place" if inPlace else "whole file rewritten",
+    )
+    metrics.count("io.trackBytesWritten", bytesWritten)
+    if writeStats is not None:
+        writeStats["bytes"] += bytesWritten
+        writeStats["inPlace" if inPlace else "rewritten"] += 1
+
+
+def addAlbumArtToMP3(
+    songPath, imagePath, imageMimeType, writeStats=None, trackFile=None, songFile=None
+):
+    applogger.debug(
+        "Adding %s album art to MP3 file %s: %s", imageMimeType, songPath, imagePath
+    )
+
+    from mutagen.id3 import ID3, ID3NoHeaderError
+
+    song = songPath if trackFile is None else trackFile
+    if not isinstance(songFile, ID3):
+        try:
+            songFile = parseTags(ID3, song)
+        except ID3NoHeaderError:
+            # Bare MP3 with no tags at all, start a new tag from scratch
+            songFile = ID3()
+
+    # setall() so that any old cover frames (APIC:whatever) are replaced, not kept alongside
+    apicFrame = getCachedAPIC(imagePath, imageMimeType)
+    songFile.setall("APIC", [apicFrame])
+
+    # If the cover fits into the old tag's padding, only the tag is rewritten, otherwise
+    # the whole audio has to be shifted anyway, so leave room for a cover about this size next time
+    padding, decisions = keepOrGrowPadding(
+        max(MP3_MIN_REWRITE_PADDING, len(apicFrame.data) // 2)
+    )
+    tagSize = songFile.size
+    with metrics.stage("tag.save"):
+        songFile.save(rewound(song), padding=padding)
+    countWrittenBytes(songPath, decisions, writeStats, trackFile, tagSize)
+    return 0
+
+
+def addAlbumArtToOGG(
+    songPath, imagePath, imageMimeType, writeStats=None, trackFile=None, songFile=None
+):
+    applogger.debug(
+        "Adding %s album art to OGG file %s: %s", imageMimeType, songPath, imagePath
+    )
+
+    from mutagen.oggvorbis import OggVorbis
+
+    song = songPath if trackFile is None else trackFile
+    if not isinstance(songFile, OggVorbis):
+        songFile = parseTags(OggVorbis, song)
+
+    # Add the FLAC-format picture block to the Ogg file's metadata
+    vorbisPicture = getCachedVorbisPicture(imagePath, imageMimeType)
+    songFile["metadata_block_picture"] = [vorbisPicture]
+
+    # Save the Ogg file with the new metadata
+    # Ogg pages after the comment header only stay put if the comment packet keeps its size,
+    # so it gets the same keep-or-grow padding as MP3
+    padding, decisions = keepOrGrowPadding(
+        max(OGG_MIN_REWRITE_PADDING, len(vorbisPicture) // 2)
+    )
+    with metrics.stage("tag.save"):
+        songFile.save(rewound(song), padding=padding)
+    countWrittenBytes(songPath, decisions, writeStats, trackFile)
+    return 0
+
+
+def addAlbumArtToFLAC(
+    songPath, imagePath, imageMimeType, writeStats=None, trackFile=None, songFile=None
+):
+    applogger.debug(
+        "Adding %s album art to FLAC file %s: %s", imageMimeType, songPath, imagePath
+    )
+
+    from mutagen.flac import FLAC
+
+    song = songPath if trackFile is None else trackFile
+    if not isinstance(songFile, FLAC):
+        songFile = parseTags(FLAC, song)
+    image = getCachedFLACPicture(imagePath, imageMimeType)
+    songFile.clear_pictures()
+    songFile.add_picture(image)
+
+    # FLACs are big, so the existing padding block is used for the picture whenever it fits
+    padding, decisions = keepOrGrowPadding(
+        max(FLAC_MIN_REWRITE_PADDING, len(image.data) // 2)
+    )
+    with metrics.stage("tag.save"):
+        songFile.save(rewound(song), padding=padding)
+    countWrittenBytes(songPath, decisions, writeStats, trackFile)
+    return 0
+
+
+def estimateAlbumArtWrite(songPath, imagePath, imageMimeType):
+    # Dry run of addAlbumArtToSong(): the picture is put into the parsed tags, and those are
+    # saved into an in-memory copy of just the tag region, to see whether they fit into it
+    # Returns (fits in place, estimated bytes written)
+    songExt = fileExtension(songPath)[1].lower().strip(".")
+    fileSize = getsize(songPath)
+    if songExt == "mp3":
+        from mutagen.id3 import ID3, ID3NoHeaderError
+
+        try:
+            songFile = ID3(songPath)
+        except ID3NoHeaderError:
+            # A new tag always means shifting the audio
+            return False, fileSize + len(
+                getCachedPicture(imagePath, imageMimeType)["data"]
+            )
+        songFile.setall("APIC", [getCachedAPIC(imagePath, imageMimeType)])
+        regionSize = songFile.size
+    elif songExt == "ogg":
+        from mutagen.oggvorbis import OggVorbis
+
+        # Just the pages up to the end of the comment packet, the audio pages after it aren't
+        # needed to parse the tags or to see whether they still fit
+        regionSize = oggCommentPagesEnd(songPath)
+        with open(songPath, "rb") as f:
+            songFile = OggVorbis(BytesIO(f.read(regionSize)))
+        songFile["metadata_block_picture"] = [
+            getCachedVorbisPicture(imagePath, imageMimeType)
+        ]
+    elif songExt == "flac":
+        from mutagen.flac import FLAC
+
+        songFile = FLAC(songPath)
+        songFile.clear_pictures()
+        songFile.add_picture(getCachedFLACPicture(imagePath, imageMimeType))
+        regionSize = flacAudioOffset(songPath)
+    else:
+        raise ValueError(f"File type {songExt} is not supported")
+
+    with open(songPath, "rb") as f:
+        tagRegion = BytesIO(f.read(regionSize))
+    padding, decisions = keepOrGrowPadding(0)
+    songFile.save(tagRegion, padding=padding)
+    info, _ = decisions[-1]
+    if info.padding >= 0:
+        # Same as in countWrittenBytes(), an ID3 tag written in place keeps its size
+        return True, regionSize if songExt == "mp3" else regionSize - info.size
+    return False, fileSize - info.padding
+
+
+def openTrack(songPath):
+    # One handle per track for the art check, the parse and the write, instead of mutagen
+    # opening the file again for each of them; read-only files can still be checked
+    metrics.count("io.trackOpens")
+    try:
+        return open(songPath, "r+b")
+    except PermissionError:
+        return open(songPath, "rb")
+
+
+def checkExistingAlbumArt(songPath, trackFile=None):
+    return probeTrack(songPath, trackFile)[0]
+
+
+@timedStage("detect")
+def probeTrack(songPath, trackFile=None):
+    # Returns (art found, parsed tags or None), the tags are there if the fast probe had to
+    # fall back to mutagen, so addAlbumArtToSong() doesn't parse them a second time
+    applogger.debug("Checking for existing album art in %s", songPath)
+    metrics.count("fs.probes")
+    songExt = fileExtension(songPath)[1].lower().strip(".")
+    song = songPath if trackFile is None else trackFile
+    if songExt == "mp3":
+        return checkExistingAlbumArtMP3(songPath, song)
+    elif songExt == "ogg":
+        return checkExistingAlbumArtOGG(songPath, song)
+    elif songExt == "flac":
+        return checkExistingAlbumArtFLAC(songPath, song)
+    applogger.debug("Album art not found inside track %s", songPath)
+    return False, None
+
+
+def rewound(song):
+    # mutagen reads and writes an open file from wherever it's at
+    if not isinstance(song, str):
+        song.seek(0)
+    return song
+
+
+def parseTags(tagClass, song):
+    # Read through openSong() for io.trackBytesRead; mutagen still gets the path, so tags parsed
+    # from one can be saved back without passing the file again
+    metrics.count("tag.parses")
+    with metrics.stage("tag.parse"), openSong(song) as reader:
+        return tagClass(reader, filename=song if isinstance(song, str) else None)
+
+
+def checkExistingAlbumArtOGG(songPath, song):
+    songFile = None
+    try:
+        # Only reads the comment header, not the pictures themselves
+        albumArtFound = probeOGG(song)
+    except ProbeError as e:
+        applogger.debug(
+            "Fast probe failed for %s (%s), parsing the whole thing", songPath, e
+        )
+        metrics.count("detect.fallbackParses")
+        from mutagen import File as MutagenFile
+
+        songFile = parseTags(MutagenFile, song)
+        if songFile is None:
+            # mutagen couldn't make anything of it either
+            applogger.warning(f"Not a readable Ogg file: {songPath}")
+            return False, None
+        albumArtFound = "metadata_block_picture" in songFile
+    if albumArtFound:
+        applogger.debug("Album art found inside OGG track %s!", songPath)
+        return True, songFile
+    applogger.debug("Album art not found inside OGG track %s", songPath)
+    return False, songFile
+
+
+def checkExistingAlbumArtFLAC(songPath, song):
+    songFile = None
+    try:
+        # Only reads the metadata block headers, not the pictures themselves
+        albumArtFound = probeFLAC(song)
+    except ProbeError as e:
+        applogger.debug(
+            "Fast probe failed for %s (%s), parsing the whole thing", songPath, e
+        )
+        metrics.count("detect.fallbackParses")
+        from mutagen.flac import FLAC
+
+        songFile = parseTags(FLAC, song)
+        albumArtFound = bool(songFile.pictures)
+    if albumArtFound:
+        applogger.debug("Album art found inside FLAC track %s!", songPath)
+        return True, songFile
+    applogger.debug("Album art not found inside FLAC track %s", songPath)
+    return False, songFile
+
+
+def checkExistingAlbumArtMP3(songPath, song):
+    songFile = None
+    try:
+        # Only reads the ID3 header and frame headers, not the frames themselves
+        albumArtFound = probeMP3(song)
+    except ProbeError as e:
+        applogger.debug(
+            "Fast probe failed for %s (%s), parsing the whole thing", songPath, e
+        )
+        metrics.count("detect.fallbackParses")
+        from mutagen.id3 import ID3, ID3NoHeaderError
+
+        try:
+            songFile = parseTags(ID3, song)
+            albumArtFound = any(key.startswith("APIC:") for key in songFile.keys())
+        except ID3NoHeaderError:
+            albumArtFound = None
+
+    if albumArtFound is None:
+        applogger.warning(f"No ID3 tags at all in file {songPath}")
+        return False, None
+    if albumArtFound:
+        applogger.debug("Album art found inside MP3 track %s!", songPath)
+        return True, songFile
+    applogger.debug("Album art not found inside MP3 track %s", songPath)
+    return False, songFile
+
+
+def buildArgumentParser():
+    argparser = argparse.ArgumentParser()
+    argparser.add_argument("filename")
+    argparser.add_argument("--verbose", "-v", action="store_true")
+    argparser.add_argument("--very-verbose", "-vv", action="store_true")
+    argparser.add_argument("--edit-all", "-a", action="store_true")
+    argparser.add_argument("--copy-cover", "-c", action="store_true")
+    argparser.add_argument("--copy-cover-name", default=DEFAULT_SAVE_NAME)
+    argparser.add_argument("--cover-save-extension", default=DEFAULT_SAVE_EXT)
+    argparser.add_argument("--max-cover-size", "-s", type=float)
+    argparser.add_argument(
+        "--cover-resize-dimensions", type=int, default=DEFAULT_RESIZE_DIM
+    )
+    argparser.add_argument("--cover-resize-name", default=DEFAULT_RESIZED_SAVE_NAME)
+    argparser.add_argument(
+        "--cover-jpeg-quality", type=int, default=DEFAULT_JPEG_QUALITY
+    )
+    argparser.add_argument("--cover-jpeg-progressive", action="store_true")
+    argparser.add_argument(
+        "--cover-jpeg-subsampling",
+        choices=JPEG_SUBSAMPLINGS,
+        default=DEFAULT_JPEG_SUBSAMPLING,
+    )
+    argparser.add_argument(
+        "--max-decode-megapixels", type=float, default=DEFAULT_MAX_DECODE_MEGAPIXELS
+    )  # Covers bigger than this (after JPEG draft decoding) aren't resized, to cap memory use
+    argparser.add_argument(
+        "--max-decoded-images", type=int, default=DEFAULT_MAX_DECODED_IMAGES
+    )  # Covers decoded at once for resizing, across all --jobs workers
+    argparser.add_argument(
+        "--cover-buffer-mb", type=float, default=DEFAULT_COVER_BUFFER_MB
+    )  # Cover bytes kept around for reuse, per process
+    argparser.add_argument(
+        "--resize-cache"
+    )  # Dir to keep resized covers in, keyed by the source image hash, shared across albums and runs
+    argparser.add_argument(
+        "--resize-cache-size", type=float, default=DEFAULT_RESIZE_CACHE_SIZE_MB
+    )  # In MB, least recently used entries are dropped past that
+    argparser.add_argument(
+        "--textlog", action="store_true"
+    )  # Also log to album-art-script.log, written from a background thread
+    argparser.add_argument(
+        "--textlog-level",
+        choices=["DEBUG", "INFO", "WARNING", "ERROR"],
+        default=logging.getLevelName(DEFAULT_FILE_LEVEL),
+    )
+    argparser.add_argument("--force-resave", action="store_true")
+    argparser.add_argument(
+        "--delete-original-cover", action="store_true"
+    )  # TODO: Implement this
+    argparser.add_argument("--recursive", "-r", action="store_true")
+    argparser.add_argument(
+        "--no-prompt", action="store_true"
+    )  # Don't ask for covers that can't be found, just report the tracks that got left out
+    argparser.add_argument(
+        "--unresolved-file"
+    )  # Write the tracks left without a cover here, one per line
+    argparser.add_argument(
+        "--fetch-covers", choices=sorted(COVER_SOURCES)
+    )  # Look up the covers that can't be found locally online, by the artist and album tags
+    argparser.add_argument(
+        "--fetch-url"
+    )  # Ask this server instead of the source's own, a mirror or a local stub
+    argparser.add_argument(
+        "--fetch-cache"
+    )  # Dir for fetched covers (and albums that have none), ~/.cache/album-art-script/fetched-covers by default
+    argparser.add_argument(
+        "--fetch-jobs", type=int, default=DEFAULT_FETCH_JOBS
+    )  # Lookups at once
+    argparser.add_argument(
+        "--fetch-rate", type=float
+    )  # Requests per second per host, instead of what the source asks for
+    argparser.add_argument("--fetch-user-agent", default=DEFAULT_USER_AGENT)
+    argparser.add_argument(
+        "--list-artless", action="store_true"
+    )  # Just print the tracks that have no art in them, changes nothing
+    argparser.add_argument(
+        "--estimate-writes", action="store_true"
+    )  # Dry run, print which tracks can be tagged in place and which need a full rewrite
+    argparser.add_argument(
+        "--audit-art", action="store_true"
+    )  # Report how big the art embedded in the tracks is, changes nothing
+    argparser.add_argument(
+        "--shrink-art", action="store_true"
+    )  # Resize embedded art over --max-cover-size (1 MB by default) to --cover-resize-dimensions
+    argparser.add_argument(
+        "--plan"
+    )  # Scan only and write what would be done to this JSON file ("-" for stdout), changes nothing
+    argparser.add_argument(
+        "--execute-plan", action="store_true"
+    )  # filename is a plan made with --plan, do what it says
+    argparser.add_argument(
+        "--plan-first", action="store_true"
+    )  # Scan the whole tree first, then do the writes in disk order
+    argparser.add_argument(
+        "--io-concurrency", type=int, default=DEFAULT_IO_CONCURRENCY
+    )  # Tracks read/written at once while planning or executing a plan
+    argparser.add_argument(
+        "--watch", action="store_true"
+    )  # Keep running and tag albums as they're added to or changed in the filename dir
+    argparser.add_argument(
+        "--watch-debounce", type=float, default=DEFAULT_WATCH_DEBOUNCE
+    )
+    argparser.add_argument(
+        "--watch-poll", action="store_true"
+    )  # Poll instead of using inotify, e.g. for network filesystems
+    argparser.add_argument(
+        "--watch-poll-interval", type=float, default=DEFAULT_POLL_INTERVAL
+    )
+    argparser.add_argument(
+        "--metrics", choices=list(METRICS_FORMATTERS)
+    )  # Print per-stage timings, I/O counters and peak RSS at the end of the run
+    argparser.add_argument(
+        "--metrics-file"
+    )  # Write the --metrics report here instead of stdout
+    argparser.add_argument(
+        "--state-db"
+    )  # SQLite file to remember processed tracks in, unchanged tracks are skipped on re-runs
+    argparser.add_argument(
+        "--jobs", "-j", type=int, default=cpuCount() or 1
+    )  # Worker processes for --recursive (threads for --list-artless), 1 means everything is done in this process
+    return argparser
+
+
+def parseArguments(argv=None):
+    args = buildArgumentParser().parse_args(argv)
+
+    if args.very_verbose:
+        terminalLevel = logging.DEBUG
+    elif args.verbose:
+        terminalLevel = logging.INFO
+    else:
+        terminalLevel = DEFAULT_TERMINAL_LEVEL
+    setupLogging(
+        terminalLevel,
+        logging.getLevelName(args.textlog_level) if args.textlog else None,
+    )
+    applogger.debug("Arguments are %s", args)
+    return checkArguments(args)
+
+
+def checkArguments(args):
+    # Returns args, or None if they don't make sense together
+    if args.max_cover_size and not (
+        args.copy_cover or args.audit_art or args.shrink_art
+    ):
+        applogger.error("--max-cover-size is only possible with --copy-cover!")
+        return None
+
+    if args.force_resave and not args.copy_cover:
+        applogger.error("--force-resave only possible with --copy-cover!")
+        return None
+
+    if args.jobs < 1:
+        applogger.error("--jobs has to be at least 1!")
+        return None
+
+    if args.watch and args.metrics:
+        # The timings would pile up for as long as it runs
+        applogger.error("--metrics can't be used with --watch!")
+        return None
+
+    if args.max_decoded_images < 1:
+        applogger.error("--max-decoded-images has to be at least 1!")
+        return None
+
+    if args.io_concurrency < 1:
+        applogger.error("--io-concurrency has to be at least 1!")
+        return None
+
+    if args.fetch_jobs < 1:
+        applogger.error("--fetch-jobs has to be at least 1!")
+        return None
+
+    if args.fetch_rate is not None and args.fetch_rate <= 0:
+        applogger.error("--fetch-rate has to be more than 0!")
+        return None
+
+    if args.watch and args.fetch_covers:
+        # Albums are waited on until their cover shows up, there's nothing to fetch for
+        applogger.error("--fetch-covers can't be used with --watch!")
+        return None
+
+    if args.fetch_url and not args.fetch_covers:
+        applogger.error("--fetch-url is only possible with --fetch-covers!")
+        return None
+
+    return args
+
+
+def scanDirForCovers(songDir, albumArtNames):
+    # One listing of the dir instead of a stat() per possible cover name
+    # Names are matched case-insensitively, so cover.JPG or Folder.Jpeg are found too
+    metrics.count("fs.probes")
+    dirFiles = {}
+    try:
+        with scanDir(songDir or ".") as entries:
+            for entry in entries:
+                if not entry.is_file():
+                    continue
+                lowerName = entry.name.lower()
+                # If there's both cover.jpg and Cover.jpg, pick the same one every time
+                if lowerName not in dirFiles or entry.name < dirFiles[lowerName]:
+                    dirFiles[lowerName] = entry.name
+    except OSError as e:
+        applogger.warning(f"Couldn't list {songDir}: {e}")
+        return None
+
+    for commonName in albumArtNames:
+        fileName = dirFiles.get(commonName.lower())
+        if fileName is not None:
+            return join(songDir, fileName)
+    return None
+
+
+def forgetCoverIndex(songDir):
+    # Has to be called when a cover gets written to songDir, so that it's picked up on the next lookup
+    with cacheLock:
+        for key in [key for key in coverIndex if key[0] == songDir]:
+            del coverIndex[key]
+
+
+@timedStage("lookup")
+def checkForCommonAlbumArtNames(
+    songPath,
+    albumArtNames=COMMON_ART_NAMES,
+    saveName=DEFAULT_SAVE_NAME,
+    resizedName=DEFAULT_RESIZED_SAVE_NAME,
+    saveExt=DEFAULT_SAVE_EXT,
+):
+    applogger.debug("Checking for usual album art filenames")
+    # TODO: this doesn't check if the cover file has been copied with the default name, but non-default extension
+    # but fuck it, we ball
+    # Resized image to be checked first, since we do want the resized image to be added instead of a fucking 50 meg file
+    # then the default name, then all generated names, see COMMON_ART_NAMES
+    priorityNames = (
+        f"{resizedName}.{saveExt}",
+        f"{saveName}.{saveExt}",
+        *albumArtNames,
+    )
+    songDir = dirname(songPath)
+    key = (songDir, priorityNames)
+
+    with cacheLock:
+        cached = key in coverIndex
+        if cached:
+            coverIndex.move_to_end(key)
+            possibleName = coverIndex[key]
+    if not cached:
+        # Scanned without the lock, two threads scanning the same dir just find the same thing
+        applogger.debug("Scanning %s for covers...", songDir or ".")
+        possibleName = scanDirForCovers(songDir, priorityNames)
+        with cacheLock:
+            coverIndex[key] = possibleName
+            if len(coverIndex) > COVER_INDEX_MAX_DIRS:
+                coverIndex.popitem(last=False)
+
+    if possibleName is not None:
+        applogger.debug("Found it! %s", possibleName)
+        return possibleName, True
+    applogger.debug("Couldn't find anything.")
+    return None, False
+
+
+@timedStage("resize")
+def resizeImageAndSave(
+    imagePath,
+    saveDir,
+    resizeDim=DEFAULT_RESIZE_DIM,
+    resizeName=DEFAULT_RESIZED_SAVE_NAME,
+    resizeExt=DEFAULT_SAVE_EXT,
+    quality=DEFAULT_JPEG_QUALITY,
+    progressive=False,
+    subsampling=DEFAULT_JPEG_SUBSAMPLING,
+    maxDecodeMegapixels=DEFAULT_MAX_DECODE_MEGAPIXELS,
+    resizeCache=None,
+):
+    # Returns the resized file name, or None if the image couldn't be resized
+    fileName = join(saveDir, f"{resizeName}.{resizeExt}")
+    try:
+        if resizeCache is None:
+            imageData, imageSize = resizeImage(
+                imagePath,
+                resizeDim,
+                resizeExt,
+                quality,
+                progressive,
+                subsampling,
+                maxDecodeMegapixels,
+            )
+        else:
+            # Same cover bytes + same settings = same result, wherever in the library the cover is
+            sourceData, mapped = loadCover(imagePath)
+            metrics.count(
+                "io.coverBytesMapped" if mapped else "io.coverBytesRead",
+                len(sourceData),
+            )
+            cacheKey = resizeCache.key(
+                sourceData, (resizeDim, resizeExt, quality, progressive, subsampling)
+            )
+            imageData = resizeCache.get(cacheKey)
+            imageSize = "the cached size"
+            if imageData is None:
+                # A mapping is read straight from the page cache, bytes need a file around them
+                imageData, imageSize = resizeImage(
+                    sourceData if mapped else BytesIO(sourceData),
+                    resizeDim,
+                    resizeExt,
+                    quality,
+                    progressive,
+                    subsampling,
+                    maxDecodeMegapixels,
+                )
+                resizeCache.put(cacheKey, imageData)
+            # Don't hold on to a possibly 50 meg source any longer than needed
+            del sourceData
+    except (ResizeError, OSError) as e:
+        applogger.error(f"Couldn't resize {imagePath}: {e}")
+        return None
+
+    applogger.debug("Trying to save the resized image...")
+    writeReplacing(fileName, imageData)
+    metrics.count("io.coverBytesWritten", len(imageData))
+    forgetCoverIndex(saveDir)
+    # The tracks get the bytes we already have in memory, no need to read the file back
+    cachePictureData(fileName, MIME_TYPES[resizeExt.lower()], imageData)
+    applogger.debug("Resized %s to %s and saved as %s.", imagePath, imageSize, fileName)
+    return fileName
+
+
+def getResizeCache(args):
+    # One per process, made on first use so that worker processes get their own too
+    global resizeCache
+    if args.resize_cache is None:
+        return None
+    if resizeCache is None:
+        resizeCache = ResizeCache(
+            args.resize_cache, int(args.resize_cache_size * 1024 * 1024)
+        )
+    return resizeCache
+
+
+def takeResizeCacheCounters(stats):
+    if resizeCache is None:
+        return
+    for name, count in resizeCache.takeCounters().items():
+        stats["resizeCache"][name] += count
+
+
+def copyCover(imagePath, targetPath):
+    # Returns targetPath, the copy is what gets embedded and remembered in the --state-db,
+    # since it's the cover the next run finds
+    writeReplacing(targetPath, sourcePath=imagePath)
+    metrics.count("io.coverBytesWritten", getsize(targetPath))
+    forgetCoverIndex(dirname(targetPath))
+    return targetPath
+
+
+def findAlbumArt(songPath, args, chosenPath=None):
+    # Finds the cover for the album songPath is in, or uses the one the user chose for it
+    # Returns (imagePath, imageMimeType), or None if there's no usable art
+    songDir = dirname(songPath)
+    if chosenPath is not None:
+        # Not one of the common names, so --copy-cover copies it next to the tracks
+        imagePath, commonNameFoundFlag = chosenPath, False
+    else:
+        imagePath, commonNameFoundFlag = checkForCommonAlbumArtNames(
+            songPath,
+            COMMON_ART_NAMES,
+            args.copy_cover_name,
+            args.cover_resize_name,
+            args.cover_save_extension,
+        )
+    if imagePath is None:
+        applogger.error(f"No art found for {songDir}")
+        return None
+    if not fileExists(imagePath):
+        applogger.error(f"Album art file does not exist: {imagePath}")
+        return None
+
+    imageExt = fileExtension(imagePath)[1].lower().strip(".")
+    applogger.debug('Seems like %s exists, file ext is "%s"', imagePath, imageExt)
+
+    if imageExt not in MIME_TYPES.keys():
+        applogger.error(f"Image {imagePath} is not of supported type!")
+        return None
+    else:
+        imageMimeType = MIME_TYPES[imageExt]
+        applogger.debug("Image file MIME type is %s", imageMimeType)
+
+    if args.max_cover_size is not None or args.force_resave:
+        # Get size in MB, since the commandline parameter is in MB
+        coverSize = getsize(imagePath) / 1024 / 1024
+        applogger.debug(
+            "MAX_COVER_SIZE is set to %s MB, file size is %s MB",
+            args.max_cover_size,
+            coverSize,
+        )
+        if args.force_resave or coverSize > args.max_cover_size:
+            applogger.info(
+                "Cover is bigger than the size specified, shrinking it down and saving as cover.jpg..."
+            )
+            imagePath = resizeImageAndSave(
+                imagePath,
+                songDir,
+                args.cover_resize_dimensions,
+                args.cover_resize_name,
+                args.cover_save_extension,
+                args.cover_jpeg_quality,
+                args.cover_jpeg_progressive,
+                args.cover_jpeg_subsampling,
+                args.max_decode_megapixels,
+                getResizeCache(args),
+            )
+            if imagePath is None:
+                return None
+            imageExt = args.cover_save_extension
+            imageMimeType = MIME_TYPES[imageExt]
+        else:
+            applogger.debug(
+                "Cover is within the specified size, continuing as normal..."
+            )
+            if not commonNameFoundFlag:
+                applogger.info(f"Copying {imagePath} to track dir as cover.{imageExt}")
+                imagePath = copyCover(
+                    imagePath, join(songDir, f"{args.copy_cover_name}.{imageExt}")
+                )
+    elif args.copy_cover and not commonNameFoundFlag:
+        applogger.info(f"Copying {imagePath} to track dir as cover.{imageExt}")
+        imagePath = copyCover(
+            imagePath, join(songDir, f"{args.copy_cover_name}.{imageExt}")
+        )
+
+    return imagePath, imageMimeType
+
+
+def recordTrackResult(stats, songPath, action, result, albumArt=None):
+    # Per-track outcome, this is what ends up in the --state-db
+    imagePath, imageMimeType = albumArt if albumArt else (None, None)
+    stats["results"].append(
+        {
+            "path": songPath,
+            "action": action,
+            "result": result,
+            "coverPath": imagePath,
+            "coverHash": (
+                getCachedPicture(imagePath, imageMimeType)["hash"]
+                if imagePath and result == RESULT_OK
+                else None
+            ),
+            "mime": imageMimeType,
+        }
+    )
+
+
+def hasFindableCover(songPath, args):
+    # Goes through the cover index, so the lookup in findAlbumArt() right after is free
+    imagePath, _ = checkForCommonAlbumArtNames(
+        songPath,
+        COMMON_ART_NAMES,
+        args.copy_cover_name,
+        args.cover_resize_name,
+        args.cover_save_extension,
+    )
+    return imagePath is not None
+
+
+def processAlbum(songPaths, args, stats, chosenPath=None):
+    # All songPaths are expected to be in the same dir, so the cover is looked up
+    # (and resized/copied) only once, for the first track that needs it
+    # Nobody's asked for anything here: if there's no cover to be found, the tracks that need one
+    # go to stats["unresolved"], to be asked about once the rest of the run is done
+    albumArt = None
+    albumArtLookedUp = False
+    unresolved = False
+
+    for songPath in songPaths:
+        stats["tracks"] += 1
+        action = ACTION_ADD
+        try:
+            # Checked, parsed (if need be) and written through the one handle
+            with openTrack(songPath) as trackFile:
+                albumArtExistsInTrack, songFile = probeTrack(songPath, trackFile)
+                action = ACTION_REPLACE if albumArtExistsInTrack else ACTION_ADD
+
+                if albumArtExistsInTrack and not args.edit_all:
+                    applogger.info(f"File already has an album art: {songPath}")
+                    recordTrackResult(stats, songPath, ACTION_SKIP, RESULT_OK)
+                    continue
+
+                if not albumArtLookedUp:
+                    albumArtLookedUp = True
+                    if chosenPath is None and not hasFindableCover(songPath, args):
+                        applogger.info(f"Art for {songPath} not found automatically")
+                        unresolved = True
+                    else:
+                        albumArt = findAlbumArt(songPath, args, chosenPath)
+
+                if unresolved:
+                    stats["unresolved"].append(songPath)
+                    continue
+
+                if albumArt is None:
+                    applogger.error(f"No album art for {songPath}, skipping...")
+                    stats["failed"].append(songPath)
+                    recordTrackResult(stats, songPath, action, RESULT_FAILED)
+                    continue
+
+                imagePath, imageMimeType = albumArt
+                applogger.info(
+                    f"Adding album art to: {songPath}"
+                    if not albumArtExistsInTrack
+                    else f"Changing album art for: {songPath}"
+                )
+
+                try:
+                    result = addAlbumArtToSong(
+                        songPath,
+                        imagePath,
+                        imageMimeType,
+                        stats["writes"],
+                        trackFile,
+                        songFile,
+                    )
+                except Exception as e:
+                    applogger.error(f"Exception occured while tagging {songPath}: {e}")
+                    result = -1
+
+                if result:
+                    applogger.error(
+                        f"Something went wrong when adding art to file {songPath}"
+                    )
+                    stats["failed"].append(songPath)
+                    recordTrackResult(stats, songPath, action, RESULT_FAILED, albumArt)
+                else:
+                    stats["tagged"] += 1
+                    recordTrackResult(stats, songPath, action, RESULT_OK, albumArt)
+        except Exception as e:
+            # One unreadable track doesn't stop the rest of the album, or the run
+            applogger.error(f"Couldn't process {songPath}: {e}")
+            stats["failed"].append(songPath)
+            recordTrackResult(stats, songPath, action, RESULT_FAILED)
+
+    takeResizeCacheCounters(stats)
+    takeCoverMemoryPeaks(stats)
+
+
+def filterUnchangedTracks(songPaths, args, stateDb, stats):
+    # With --state-db, tracks that haven't changed since the last run (and whose cover hasn't either)
+    # are dropped here after a single stat(), without parsing any tags
+    if stateDb is None:
+        return songPaths
+    metrics.count("fs.probes", len(songPaths))
+    currentCoverPath, _ = checkForCommonAlbumArtNames(
+        songPaths[0],
+        COMMON_ART_NAMES,
+        args.copy_cover_name,
+        args.cover_resize_name,
+        args.cover_save_extension,
+    )
+    with metrics.stage("state.filter"):
+        changedPaths = stateDb.filterChanged(songPaths, currentCoverPath, args.edit_all)
+    unchangedCount = len(songPaths) - len(changedPaths)
+    if unchangedCount:
+        applogger.debug(
+            "%s tracks in %s haven't changed", unchangedCount, dirname(songPaths[0])
+        )
+    stats["tracks"] += unchangedCount
+    stats["unchanged"] += unchangedCount
+    return changedPaths
+
+
+def findAlbums(rootDir):
+    # Yields (albumDir, [track paths]) for every dir under rootDir that has supported tracks in it
+    # Depth first, in a stable order, with only the dirs still to be visited and one listing held at a time
+    pendingDirs = [rootDir]
+    while pendingDirs:
+        albumDir = pendingDirs.pop()
+        subDirs, songPaths = [], []
+        try:
+            with scanDir(albumDir) as entries:
+                for entry in entries:
+                    # Symlinked dirs aren't followed, same as os.walk()
+                    if entry.is_dir(follow_symlinks=False):
+                        subDirs.append(entry.path)
+                    elif (
+                        fileExtension(entry.name)[1].lower().strip(".")
+                        in SUPPORTED_TRACK_EXTS
+                    ):
+                        songPaths.append(entry.path)
+        except OSError as e:
+            applogger.error(f"Couldn't list {albumDir}: {e}")
+            continue
+        if songPaths:
+            yield albumDir, sorted(songPaths)
+        # Reversed, so they come off the stack in order
+        pendingDirs.extend(sorted(subDirs, reverse=True))
+
+
+def prefetch(items, maxQueued):
+    # Runs the items generator in a thread, at most maxQueued items ahead of whoever's consuming them,
+    # so slow dir listings (NFS, spinning disks) overlap with the tagging without piling up
+    import queue
+
+    itemQueue = queue.Queue(maxsize=maxQueued)
+    done = object()
+
+    def produce():
+        try:
+            for item in items:
+                itemQueue.put(item)
+        finally:
+            itemQueue.put(done)
+
+    # Daemon, so a run that stops early doesn't hang on a full queue
+    threading.Thread(target=produce, daemon=True).start()
+    while True:
+        item = itemQueue.get()
+        if item is done:
+            return
+        yield item
+
+
+def newStats():
+    return {
+        "tracks": 0,
+        "tagged": 0,
+        "unchanged": 0,
+        "failed": [],
+        "unresolved": [],
+        "results": [],
+        "resizeCache": {"hits": 0, "misses": 0, "evictions": 0},
+        "writes": {"bytes": 0, "inPlace": 0, "rewritten": 0},
+        "coverMemory": {"private": 0, "mapped": 0},
+        "startTime": perfCounter(),
+    }
+
+
+def logStats(stats):
+    elapsed = perfCounter() - stats["startTime"]
+    tracksPerSec = stats["tracks"] / elapsed if elapsed > 0 else 0.0
+    applogger.warning(
+        f"Processed {stats['tracks']} tracks in {elapsed:.2f}s ({tracksPerSec:.1f} tracks/sec), "
+        f"{stats['tagged']} tagged, {stats['unchanged']} unchanged, {len(stats['failed'])} failed"
+        + (
+            f", {len(stats['unresolved'])} without a cover"
+            if stats["unresolved"]
+            else ""
+        )
+    )
+    if stats["writes"]["inPlace"] or stats["writes"]["rewritten"]:
+        applogger.warning(
+            f"Wrote {stats['writes']['bytes']} bytes, "
+            f"{stats['writes']['inPlace']} tracks updated in place, "
+            f"{stats['writes']['rewritten']} rewritten whole"
+        )
+    if any(stats["resizeCache"].values()):
+        applogger.warning(
+            f"Resize cache: {stats['resizeCache']['hits']} hits, "
+            f"{stats['resizeCache']['misses']} misses, "
+            f"{stats['resizeCache']['evictions']} evictions"
+        )
+    if any(stats["coverMemory"].values()):
+        applogger.warning(
+            f"Cover buffers: at most {stats['coverMemory']['private'] / 1024 / 1024:.1f} MB "
+            f"private and {stats['coverMemory']['mapped'] / 1024 / 1024:.1f} MB mapped "
+            "from the cover files (shared between processes) per process"
+        )
+    for songPath in stats["failed"]:
+        applogger.warning(f"Failed: {songPath}")
+    for songPath in stats["unresolved"]:
+        applogger.warning(f"No cover: {songPath}")
+
+
+def openStateDb(args):
+    if args.state_db is None:
+        return None
+    return TrackStateDB(args.state_db)
+
+
+def groupByAlbum(songPaths):
+    albums = {}
+    for songPath in songPaths:
+        albums.setdefault(dirname(songPath), []).append(songPath)
+    return albums
+
+
+def askForCovers(albums, args):
+    # albums is {album dir: tracks that need a cover}, everyone gets asked once, whatever the track count
+    # Returns {album dir: chosen cover} for the albums the user picked one for
+    # With --no-prompt, or with neither a display nor a terminal to ask on, nobody's asked
+    if not albums:
+        return {}
+    prompter = None if args.no_prompt else openPrompter()
+    if prompter is None:
+        if not args.no_prompt:
+            applogger.warning(
+                f"No display or terminal to ask on, {len(albums)} albums left without a cover"
+            )
+        if args.unresolved_file is not None:
+            writeUnresolved(albums, args.unresolved_file)
+        return {}
+
+    applogger.warning(f"Asking for the covers of {len(albums)} albums...")
+    chosenCovers = {}
+    try:
+        for albumDir, songPaths in albums.items():
+            chosenPath = prompter.ask(albumDir, len(songPaths))
+            if chosenPath is None:
+                applogger.error(f"No art selected for {albumDir}")
+                continue
+            chosenCovers[albumDir] = chosenPath
+    finally:
+        prompter.close()
+    # Skipped albums end up in the list too, so they can be dealt with later
+    if args.unresolved_file is not None:
+        writeUnresolved(
+            {
+                albumDir: songPaths
+                for albumDir, songPaths in albums.items()
+                if albumDir not in chosenCovers
+            },
+            args.unresolved_file,
+        )
+    return chosenCovers
+
+
+def readAlbumTags(songPaths):
+    # (artist, album) from the first track that has both, the album artist if there is one
+    # Returns None if none of them do
+    from mutagen import File as MutagenFile, MutagenError
+
+    for songPath in songPaths:
+        try:
+            songFile = MutagenFile(songPath, easy=True)
+        except (MutagenError, OSError) as e:
+            applogger.debug("Couldn't read the tags of %s: %s", songPath, e)
+            continue
+        if songFile is None or songFile.tags is None:
+            continue
+        artist = (
+            songFile.tags.get("albumartist") or songFile.tags.get("artist") or [""]
+        )[0]
+        album = (songFile.tags.get("album") or [""])[0]
+        if artist.strip() and album.strip():
+            return artist.strip(), album.strip()
+    return None
+
+
+def fetchMissingCovers(albums, args):
+    # albums is {album dir: tracks that need a cover}, returns {album dir: fetched cover}
+    if not args.fetch_covers or not albums:
+        return {}
+    queries = {}
+    for albumDir, songPaths in albums.items():
+        albumTags = readAlbumTags(songPaths)
+        if albumTags is None:
+            applogger.warning(f"No artist and album tags to look {albumDir} up by")
+            continue
+        queries[albumDir] = albumTags
+    if not queries:
+        return {}
+
+    applogger.warning(
+        f"Looking up the covers of {len(queries)} albums on {args.fetch_covers}..."
+    )
+    fetcher = CoverFetcher(
+        COVER_SOURCES[args.fetch_covers](args.fetch_url),
+        args.fetch_cache,
+        args.fetch_jobs,
+        args.fetch_rate,
+        args.fetch_user_agent,
+    )
+    try:
+        fetchedCovers = fetcher.fetchAll(queries)
+    finally:
+        fetcher.close()
+    return {
+        albumDir: coverPath
+        for albumDir, coverPath in fetchedCovers.items()
+        if coverPath is not None
+    }
+
+
+def findMissingCovers(albums, args):
+    # Fetched covers first (with --fetch-covers), then the user gets asked about the rest
+    coverPaths = fetchMissingCovers(albums, args)
+    coverPaths.update(
+        askForCovers(
+            {
+                albumDir: songPaths
+                for albumDir, songPaths in albums.items()
+                if albumDir not in coverPaths
+            },
+            args,
+        )
+    )
+    return coverPaths
+
+
+def resolveUnresolved(stats, args, stateDb):
+    # Second pass over the albums processAlbum() couldn't find a cover for, tagged here in this process
+    albums = groupByAlbum(stats["unresolved"])
+    chosenCovers = findMissingCovers(albums, args)
+    stats["unresolved"] = []
+    for albumDir, songPaths in albums.items():
+        albumStats = newStats()
+        if albumDir in chosenCovers:
+            processAlbum(songPaths, args, albumStats, chosenCovers[albumDir])
+            # They were counted when they got put aside
+            albumStats["tracks"] -= len(songPaths)
+        elif args.no_prompt:
+            # Nobody was asked, they're still just without a cover
+            stats["unresolved"].extend(songPaths)
+            continue
+        else:
+            albumStats["failed"] = songPaths
+            for songPath in songPaths:
+                recordTrackResult(albumStats, songPath, ACTION_ADD, RESULT_FAILED)
+        mergeStats(stats, albumStats, stateDb)
+
+
+def runSingleFile(args):
+    songPath = args.filename
+    applogger.debug("Track full path is %s", songPath)
+    applogger.debug("Track dir is %s", dirname(songPath))
+
+    if not fileExists(songPath):
+        applogger.error(f"File does not exist: {songPath}, exiting...")
+        return -1
+
+    stateDb = openStateDb(args)
+    stats = newStats()
+    songPaths = filterUnchangedTracks([songPath], args, stateDb, stats)
+    if songPaths:
+        albumStats = newStats()
+        processAlbum(songPaths, args, albumStats)
+        mergeStats(stats, albumStats, stateDb)
+    resolveUnresolved(stats, args, stateDb)
+    if stateDb is not None:
+        stateDb.close()
+    if stats["unresolved"]:
+        applogger.warning(f"No cover: {songPath}")
+    return -1 if stats["failed"] or stats["unresolved"] else 0
+
+
+def mergeStats(stats, albumStats, stateDb=None):
+    # Per-track results are only kept until they're in the state db, so they don't pile up over a long run
+    if stateDb is not None:
+        with metrics.stage("state.record"):
+            stateDb.record(albumStats["results"])
+    # Whatever the worker process measured for this album
+    metrics.merge(albumStats.get("metrics"))
+    metrics.count("tracks.tagged", albumStats["tagged"])
+    metrics.count("tracks.failed", len(albumStats["failed"]))
+    stats["tracks"] += albumStats["tracks"]
+    stats["tagged"] += albumStats["tagged"]
+    stats["unchanged"] += albumStats["unchanged"]
+    stats["failed"].extend(albumStats["failed"])
+    stats["unresolved"].extend(albumStats["unresolved"])
+    for name, count in albumStats["resizeCache"].items():
+        stats["resizeCache"][name] += count
+    for name, count in albumStats["writes"].items():
+        stats["writes"][name] += count
+    # Per process peaks, the biggest one is kept
+    for kind, peak in albumStats["coverMemory"].items():
+        stats["coverMemory"][kind] = max(stats["coverMemory"][kind], peak)
+
+
+def limitMemory(args, decodeSlots):
+    # See --max-decoded-images and --cover-buffer-mb, done in every worker process too
+    global pictureCacheMaxBytes
+    pictureCacheMaxBytes = int(args.cover_buffer_mb * 1024 * 1024)
+    setDecodeSlots(decodeSlots)
+
+
+def initWorker(logLevel, metricsEnabled=False, args=None, decodeSlots=None):
+    # Workers don't log to the terminal or the file themselves,
+    # the records are sent back to the parent along with the album results
+    global workerLogHandler
+    if args is not None:
+        limitMemory(args, decodeSlots)
+    workerLogHandler = RecordCollectingHandler()
+    for handler in list(applogger.handlers):
+        applogger.removeHandler(handler)
+    applogger.addHandler(workerLogHandler)
+    applogger.setLevel(logLevel)
+    metrics.enable(metricsEnabled)
+
+
+def processAlbumSafe(songPaths, args, stats, chosenPath=None):
+    # processAlbum() already fails tracks one by one, this is for whatever goes wrong around them:
+    # what got done is kept, the tracks it didn't get to count as failed
+    try:
+        processAlbum(songPaths, args, stats, chosenPath)
+    except Exception as e:
+        applogger.error(f"Processing {dirname(songPaths[0])} failed: {e}")
+        reached = {result["path"] for result in stats["results"]}
+        reached.update(stats["unresolved"])
+        stats["tracks"] = len(songPaths)
+        for songPath in songPaths:
+            if songPath not in reached:
+                stats["failed"].append(songPath)
+                recordTrackResult(stats, songPath, ACTION_ADD, RESULT_FAILED)
+
+
+def processAlbumInWorker(albumDir, songPaths, args):
+    albumStats = newStats()
+    applogger.debug("Processing %s tracks in %s", len(songPaths), albumDir)
+    processAlbumSafe(songPaths, args, albumStats)
+    albumStats["metrics"] = metrics.take()
+    return albumStats, workerLogHandler.takeRecords()
+
+
+def collectAlbumResult(songPaths, future, stats, stateDb):
+    try:
+        albumStats, records = future.result()
+    except Exception as e:
+        # The worker process itself died (or the results couldn't be sent back), tracks are
+        # failed one by one in there, so nothing's known about any of them
+        applogger.error(f"Worker failed on {dirname(songPaths[0])}: {e}")
+        albumStats = newStats()
+        albumStats["tracks"] = len(songPaths)
+        albumStats["failed"] = songPaths
+        records = []
+    # Replaying the records here keeps the log in the same order as a serial run
+    for record in records:
+        applogger.handle(record)
+    mergeStats(stats, albumStats, stateDb)
+
+
+def runRecursive(args):
+    rootDir = args.filename
+    if not isDir(rootDir):
+        applogger.error(f"--recursive needs a directory, got {rootDir}, exiting...")
+        return -1
+
+    stateDb = openStateDb(args)
+    stats = newStats()
+    albums = prefetch(findAlbums(rootDir), ALBUMS_PREFETCHED)
+    if args.jobs == 1:
+        for albumDir, songPaths in albums:
+            songPaths = filterUnchangedTracks(songPaths, args, stateDb, stats)
+            if not songPaths:
+                continue
+            applogger.debug("Processing %s tracks in %s", len(songPaths), albumDir)
+            albumStats = newStats()
+            processAlbumSafe(songPaths, args, albumStats)
+            mergeStats(stats, albumStats, stateDb)
+    else:
+        # Whole albums go to one worker, so the cover is looked up, resized and read only once
+        # Only a few albums per worker are in flight, the tree is walked as results come in
+        # The decode limit is for all of the workers together, not per worker
+        from concurrent.futures import ProcessPoolExecutor
+        from multiprocessing import BoundedSemaphore
+
+        pending = deque()
+        with ProcessPoolExecutor(
+            max_workers=args.jobs,
+            initializer=initWorker,
+            initargs=(
+                applogger.level,
+                metrics.enabled,
+                args,
+                BoundedSemaphore(args.max_decoded_images),
+            ),
+        ) as pool:
+            for albumDir, songPaths in albums:
+                songPaths = filterUnchangedTracks(songPaths, args, stateDb, stats)
+                if not songPaths:
+                    continue
+                future = pool.submit(processAlbumInWorker, albumDir, songPaths, args)
+                pending.append((songPaths, future))
+                if len(pending) >= args.jobs * ALBUMS_IN_FLIGHT_PER_JOB:
+                    collectAlbumResult(*pending.popleft(), stats, stateDb)
+            while pending:
+                collectAlbumResult(*pending.popleft(), stats, stateDb)
+
+    resolveUnresolved(stats, args, stateDb)
+    if stateDb is not None:
+        stateDb.close()
+    logStats(stats)
+    return -1 if stats["failed"] or stats["unresolved"] else 0
+
+
+def hasAlbumArtSafe(songPath):
+    try:
+        return checkExistingAlbumArt(songPath)
+    except Exception as e:
+        applogger.error(f"Couldn't check {songPath} for album art: {e}")
+        return None
+
+
+def albumsFromArgs(args):
+    # A dir is walked whole, a single track is an album of one
+    if isDir(args.filename):
+        return findAlbums(args.filename)
+    elif fileExists(args.filename):
+        return [(dirname(args.filename), [args.filename])]
+    applogger.error(f"File does not exist: {args.filename}, exiting...")
+    return None
+
+
+def runListArtless(args):
+    # Read-only, prints tracks without embedded art to stdout, one per line, so it can be piped somewhere
+    # Only tag headers are read, and a few tracks are probed at once to keep the disk (or NFS) busy
+    albums = albumsFromArgs(args)
+    if albums is None:
+        return -1
+
+    from concurrent.futures import ThreadPoolExecutor
+
+    artlessCount = failedCount = 0
+    with ThreadPoolExecutor(max_workers=args.jobs) as pool:
+        for albumDir, songPaths in albums:
+            for songPath, hasArt in zip(
+                songPaths, pool.map(hasAlbumArtSafe, songPaths)
+            ):
+                if hasArt is None:
+                    failedCount += 1
+                elif not hasArt:
+                    artlessCount += 1
+                    print(songPath)
+    applogger.info(
+        f"{artlessCount} tracks without album art, {failedCount} couldn't be read"
+    )
+    return -1 if failedCount else 0
+
+
+def runEstimateWrites(args):
+    # Read-only, for every track that would get art prints whether the tag can be patched in place
+    # or the whole file has to be rewritten, plus the estimated bytes written:
+    # "in-place<TAB>bytes<TAB>path" / "rewrite<TAB>bytes<TAB>path"
+    # Covers that would need resizing are estimated with the original cover
+    albums = albumsFromArgs(args)
+    if albums is None:
+        return -1
+
+    counts = {"in-place": 0, "rewrite": 0}
+    totalBytes = failedCount = 0
+    for albumDir, songPaths in albums:
+        albumArt = None
+        for songPath in songPaths:
+            try:
+                if checkExistingAlbumArt(songPath) and not args.edit_all:
+                    continue
+                if albumArt is None:
+                    imagePath, _ = checkForCommonAlbumArtNames(
+                        songPath,
+                        COMMON_ART_NAMES,
+                        args.copy_cover_name,
+                        args.cover_resize_name,
+                        args.cover_save_extension,
+                    )
+                    if imagePath is None:
+                        applogger.warning(f"No cover to estimate with in {albumDir}")
+                        break
+                    imageExt = fileExtension(imagePath)[1].lower().strip(".")
+                    albumArt = (imagePath, MIME_TYPES[imageExt])
+                fits, bytesWritten = estimateAlbumArtWrite(songPath, *albumArt)
+            except Exception as e:
+                applogger.error(f"Couldn't estimate {songPath}: {e}")
+                failedCount += 1
+                continue
+            verdict = "in-place" if fits else "rewrite"
+            counts[verdict] += 1
+            totalBytes += bytesWritten
+            print(f"{verdict}\t{bytesWritten}\t{songPath}")
+
+    applogger.warning(
+        f"{counts['in-place']} tracks can be patched in place, {counts['rewrite']} need a full rewrite, "
+        f"about {totalBytes} bytes would be written, {failedCount} couldn't be estimated"
+    )
+    return -1 if failedCount else 0
+
+
+def maxEmbeddedBytes(args):
+    if args.max_cover_size is not None:
+        return int(args.max_cover_size * 1024 * 1024)
+    return int(DEFAULT_MAX_EMBEDDED_SIZE_MB * 1024 * 1024)
+
+
+def parseEmbeddedPictureSizes(songPath):
+    songExt = fileExtension(songPath)[1].lower().strip(".")
+    if songExt == "mp3":
+        from mutagen.id3 import ID3, ID3NoHeaderError
+
+        try:
+            return [len(frame.data) for frame in ID3(songPath).getall("APIC")]
+        except ID3NoHeaderError:
+            return []
+    elif songExt == "ogg":
+        from mutagen.oggvorbis import OggVorbis
+
+        return [
+            len(encodedPicture) * 3 // 4
+            for encodedPicture in OggVorbis(songPath).get("metadata_block_picture", [])
+        ]
+    elif songExt == "flac":
+        from mutagen.flac import FLAC
+
+        return [len(picture.data) for picture in FLAC(songPath).pictures]
+    raise ValueError(f"File type {songExt} is not supported")
+
+
+def embeddedPictureSizes(songPath):
+    # Sizes of the pictures in the track (give or take their frame headers), from the tag headers
+    # where possible, so 50 meg covers aren't read just to be measured
+    # Returns None if the track couldn't be read
+    songExt = fileExtension(songPath)[1].lower().strip(".")
+    probes = {"mp3": mp3PictureSizes, "ogg": oggPictureSizes, "flac": flacPictureSizes}
+    try:
+        metrics.count("fs.probes")
+        return probes[songExt](songPath) or []
+    except (ProbeError, OSError) as e:
+        applogger.debug("Couldn't probe %s (%s), parsing it instead", songPath, e)
+    try:
+        metrics.count("detect.fallbackParses")
+        return parseEmbeddedPictureSizes(songPath)
+    except Exception as e:
+        applogger.error(f"Couldn't read the art in {songPath}: {e}")
+        return None
+
+
+def runAuditArt(args):
+    # Read-only, prints "bytes<TAB>path" for every track with oversized art in it, the totals
+    # and the worst offenders go to the log at the end
+    albums = albumsFromArgs(args)
+    if albums is None:
+        return -1
+    limit = maxEmbeddedBytes(args)
+
+    from concurrent.futures import ThreadPoolExecutor
+
+    totals = {
+        "tracks": 0,
+        "withArt": 0,
+        "artBytes": 0,
+        "oversized": 0,
+        "overLimitBytes": 0,
+        "failed": 0,
+    }
+    # Smallest on top, so only AUDIT_WORST_OFFENDERS tracks are ever kept
+    worstOffenders = []
+    with ThreadPoolExecutor(max_workers=args.jobs) as pool:
+        for albumDir, songPaths in albums:
+            for songPath, sizes in zip(
+                songPaths, pool.map(embeddedPictureSizes, songPaths)
+            ):
+                totals["tracks"] += 1
+                if sizes is None:
+                    totals["failed"] += 1
+                    continue
+                if not sizes:
+                    continue
+                artBytes = sum(sizes)
+                totals["withArt"] += 1
+                totals["artBytes"] += artBytes
+                overLimitBytes = sum(size - limit for size in sizes if size > limit)
+                if overLimitBytes:
+                    totals["oversized"] += 1
+                    totals["overLimitBytes"] += overLimitBytes
+                    print(f"{artBytes}\t{songPath}")
+                if len(worstOffenders) < AUDIT_WORST_OFFENDERS:
+                    heapq.heappush(worstOffenders, (artBytes, songPath))
+                else:
+                    heapq.heappushpop(worstOffenders, (artBytes, songPath))
+
+    applogger.warning(
+        f"{totals['tracks']} tracks, {totals['withArt']} with art in them, "
+        f"{totals['artBytes'] / 1024 / 1024:.1f} MB of it in total; "
+        f"{totals['oversized']} tracks have art over {limit / 1024 / 1024:.1f} MB, "
+        f"{totals['overLimitBytes'] / 1024 / 1024:.1f} MB over the limit, "
+        f"{totals['failed']} couldn't be read"
+    )
+    for artBytes, songPath in sorted(worstOffenders, reverse=True):
+        applogger.warning(f"{artBytes / 1024 / 1024:8.2f} MB  {songPath}")
+    return -1 if totals["failed"] else 0
+
+
+def shrinkPicture(imageData, args):
+    # Resizes an embedded picture the same way --max-cover-size resizes cover files
+    # Returns (data, MIME type, (width, height)), or None if it's better left alone
+    from hashlib import sha1
+
+    key = sha1(imageData).digest()
+    with cacheLock:
+        if key in shrunkPictureCache:
+            shrunkPictureCache.move_to_end(key)
+            return shrunkPictureCache[key]
+
+    saveExt = args.cover_save_extension
+    resizeParams = (
+        args.cover_resize_dimensions,
+        saveExt,
+        args.cover_jpeg_quality,
+        args.cover_jpeg_progressive,
+        args.cover_jpeg_subsampling,
+    )
+    cache = getResizeCache(args)
+    cacheKey = cache.key(imageData, resizeParams) if cache is not None else None
+    resizedData = cache.get(cacheKey) if cache is not None else None
+    shrunk = None
+    try:
+        if resizedData is None:
+            with metrics.stage("resize"):
+                resizedData, imageSize = resizeImage(
+                    BytesIO(imageData), *resizeParams, args.max_decode_megapixels
+                )
+            if cache is not None:
+                cache.put(cacheKey, resizedData)
+        else:
+            from PIL import Image as PILImage
+
+            with PILImage.open(BytesIO(resizedData)) as image:
+                imageSize = image.size
+        if len(resizedData) < len(imageData):
+            shrunk = (resizedData, MIME_TYPES[saveExt.lower()], imageSize)
+        else:
+            applogger.info(
+                f"A {len(imageData)} byte picture doesn't get any smaller resized, keeping it"
+            )
+    except (ResizeError, OSError) as e:
+        applogger.error(f"Couldn't resize a {len(imageData)} byte picture: {e}")
+
+    # Kept even if it's None, so the same picture isn't tried again for every track
+    with cacheLock:
+        shrunkPictureCache[key] = shrunk
+        if len(shrunkPictureCache) > SHRUNK_PICTURE_CACHE_MAX_ENTRIES:
+            shrunkPictureCache.popitem(last=False)
+    return shrunk
+
+
+def shrinkArtInMP3(songPath, shrink, writeStats):
+    from mutagen.id3 import ID3
+
+    with metrics.stage("tag.parse"):
+        songFile = ID3(songPath)
+    changed = False
+    for frame in songFile.getall("APIC"):
+        shrunk = shrink(frame.data)
+        if shrunk is not None:
+            frame.data, frame.mime, _ = shrunk
+            changed = True
+    if changed:
+        padding, decisions = reclaimPadding(MP3_MIN_REWRITE_PADDING)
+        tagSize = songFile.size
+        with metrics.stage("tag.save"):
+            songFile.save(songPath, padding=padding)
+        countWrittenBytes(songPath, decisions, writeStats, tagSize=tagSize)
+    return changed
+
+
+def shrinkArtInOGG(songPath, shrink, writeStats):
+    from mutagen.oggvorbis import OggVorbis
+    from mutagen.flac import Picture as MutagenFLACPicture
+
+    with metrics.stage("tag.parse"):
+        songFile = OggVorbis(songPath)
+    changed = False
+    encodedPictures = []
+    for encodedPicture in songFile.get("metadata_block_picture", []):
+        picture = MutagenFLACPicture(base64.b64decode(encodedPicture))
+        shrunk = shrink(picture.data)
+        if shrunk is not None:
+            picture.data, picture.mime, (picture.width, picture.height) = shrunk
+            encodedPicture = base64.b64encode(picture.write()).decode("ascii")
+            changed = True
+        encodedPictures.append(encodedPicture)
+    if changed:
+        songFile["metadata_block_picture"] = encodedPictures
+        padding, decisions = reclaimPadding(OGG_MIN_REWRITE_PADDING)
+        with metrics.stage("tag.save"):
+            songFile.save(padding=padding)
+        countWrittenBytes(songPath, decisions, writeStats)
+    return changed
+
+
+def shrinkArtInFLAC(songPath, shrink, writeStats):
+    from mutagen.flac import FLAC
+
+    with metrics.stage("tag.parse"):
+        songFile = FLAC(songPath)
+    changed = False
+    for picture in songFile.pictures:
+        shrunk = shrink(picture.data)
+        if shrunk is not None:
+            picture.data, picture.mime, (picture.width, picture.height) = shrunk
+            changed = True
+    if changed:
+        padding, decisions = reclaimPadding(FLAC_MIN_REWRITE_PADDING)
+        with metrics.stage("tag.save"):
+            songFile.save(padding=padding)
+        countWrittenBytes(songPath, decisions, writeStats)
+    return changed
+
+
+def shrinkArtInSong(songPath, shrink, writeStats):
+    # shrink(picture bytes) returns what to replace the picture with, or None to keep it
+    # Returns True if the track was written to
+    songExt = fileExtension(songPath)[1].lower().strip(".")
+    shrinkers = {"mp3": shrinkArtInMP3, "ogg": shrinkArtInOGG, "flac": shrinkArtInFLAC}
+    return shrinkers[songExt](songPath, shrink, writeStats)
+
+
+def runShrinkArt(args):
+    # Tracks are probed a few at a time like in --audit-art, only the ones with oversized art
+    # get parsed and written, one at a time in album order so the shrunk picture cache gets the hits
+    albums = albumsFromArgs(args)
+    if albums is None:
+        return -1
+    limit = maxEmbeddedBytes(args)
+    saved = {"pictures": 0, "bytes": 0}
+
+    def shrink(imageData):
+        if len(imageData) <= limit:
+            return None
+        shrunk = shrinkPicture(imageData, args)
+        if shrunk is not None:
+            saved["pictures"] += 1
+            saved["bytes"] += len(imageData) - len(shrunk[0])
+        return shrunk
+
+    from concurrent.futures import ThreadPoolExecutor
+
+    stats = newStats()
+    with ThreadPoolExecutor(max_workers=args.jobs) as pool:
+        for albumDir, songPaths in albums:
+            for songPath, sizes in zip(
+                songPaths, pool.map(embeddedPictureSizes, songPaths)
+            ):
+                stats["tracks"] += 1
+                if sizes is None:
+                    stats["failed"].append(songPath)
+                    continue
+                if not any(size > limit for size in sizes):
+                    continue
+                applogger.info(f"Shrinking the art in {songPath}")
+                try:
+                    if shrinkArtInSong(songPath, shrink, stats["writes"]):
+                        stats["tagged"] += 1
+                except Exception as e:
+                    applogger.error(
+                        f"Exception occured while shrinking {songPath}: {e}"
+                    )
+                    stats["failed"].append(songPath)
+
+    applogger.warning(
+        f"Shrunk {saved['pictures']} pictures in {stats['tagged']} tracks, "
+        f"{saved['bytes'] / 1024 / 1024:.1f} MB smaller in total"
+    )
+    takeResizeCacheCounters(stats)
+    logStats(stats)
+    return -1 if stats["failed"] else 0
+
+
+def planSettings(args):
+    # Everything executing the plan needs besides the plan itself, so a plan runs the same
+    # no matter what it's executed with
+    return {
+        "editAll": args.edit_all,
+        "coverResizeDimensions": args.cover_resize_dimensions,
+        "coverJpegQuality": args.cover_jpeg_quality,
+        "coverJpegProgressive": args.cover_jpeg_progressive,
+        "coverJpegSubsampling": args.cover_jpeg_subsampling,
+        "maxDecodeMegapixels": args.max_decode_megapixels,
+    }
+
+
+def planTrack(songPath, editAll):
+    # Header reads only, this is what runs io-concurrency wide while planning
+    try:
+        songStat = stat(songPath)
+        hasArt = checkExistingAlbumArt(songPath)
+    except Exception as e:
+        applogger.error(f"Couldn't check {songPath} for album art: {e}")
+        return {"path": songPath, "action": PLAN_SKIP, "reason": "unreadable"}
+    track = {
+        "path": songPath,
+        "size": songStat.st_size,
+        "mtimeNs": songStat.st_mtime_ns,
+    }
+    if hasArt and not editAll:
+        track.update(action=PLAN_SKIP, reason="has art")
+    else:
+        track["action"] = PLAN_REPLACE if hasArt else PLAN_ADD
+    return track
+
+
+def planCover(songPath, args, chosenPath=None):
+    # Same decisions as findAlbumArt(), but nothing's written
+    # Returns (cover to embed, its MIME type, steps to make it), or (None, None, [])
+    songDir = dirname(songPath)
+    if chosenPath is not None:
+        imagePath, commonNameFoundFlag = chosenPath, False
+    else:
+        imagePath, commonNameFoundFlag = checkForCommonAlbumArtNames(
+            songPath,
+            COMMON_ART_NAMES,
+            args.copy_cover_name,
+            args.cover_resize_name,
+            args.cover_save_extension,
+        )
+    if imagePath is None:
+        return None, None, []
+    imageExt = fileExtension(imagePath)[1].lower().strip(".")
+    if imageExt not in MIME_TYPES:
+        applogger.error(f"Image {imagePath} is not of supported type!")
+        return None, None, []
+
+    if args.max_cover_size is not None or args.force_resave:
+        coverSize = getsize(imagePath) / 1024 / 1024
+        if args.force_resave or coverSize > args.max_cover_size:
+            resizedPath = join(
+                songDir, f"{args.cover_resize_name}.{args.cover_save_extension}"
+            )
+            step = {"action": PLAN_RESIZE, "source": imagePath, "target": resizedPath}
+            return resizedPath, MIME_TYPES[args.cover_save_extension.lower()], [step]
+    if (args.copy_cover or args.max_cover_size is not None) and not commonNameFoundFlag:
+        # A cover the user picked from somewhere else, so it's found next time
+        copiedPath = join(songDir, f"{args.copy_cover_name}.{imageExt}")
+        step = {"action": PLAN_COPY, "source": imagePath, "target": copiedPath}
+        return copiedPath, MIME_TYPES[imageExt], [step]
+    return imagePath, MIME_TYPES[imageExt], []
+
+
+def planAlbum(albumDir, songPaths, args, stateDb, pool):
+    changedPaths = set(filterUnchangedTracks(songPaths, args, stateDb, newStats()))
+    # Unchanged tracks are listed too, so the plan shows the whole picture
+    tracks = [
+        {"path": songPath, "action": PLAN_SKIP, "reason": "unchanged"}
+        for songPath in songPaths
+        if songPath not in changedPaths
+    ]
+    tracks.extend(
+        pool.map(
+            planTrack,
+            sortByLocality(changedPaths),
+            itertools.repeat(args.edit_all),
+        )
+    )
+    album = {"dir": albumDir, "cover": None, "mime": None, "coverSteps": []}
+
+    needArt = [track for track in tracks if track["action"] != PLAN_SKIP]
+    if needArt:
+        album["cover"], album["mime"], album["coverSteps"] = planCover(
+            needArt[0]["path"], args
+        )
+        if album["cover"] is None:
+            # Left as they are for now, buildPlan() asks for these once the scan is done
+            applogger.info(f"No cover found automatically in {albumDir}")
+    album["tracks"] = tracks
+    return album
+
+
+def resolvePlanCovers(plan, args):
+    # Fetches or asks for the covers of the albums the scan couldn't find one for, the choice becomes
+    # the album's cover steps; tracks of albums still without one are skipped
+    unresolvedAlbums = {}
+    for album in plan["albums"]:
+        needArt = [track for track in album["tracks"] if track["action"] != PLAN_SKIP]
+        if needArt and album["cover"] is None:
+            unresolvedAlbums[album["dir"]] = (album, needArt)
+    chosenCovers = findMissingCovers(
+        {
+            albumDir: [track["path"] for track in needArt]
+            for albumDir, (_, needArt) in unresolvedAlbums.items()
+        },
+        args,
+    )
+    for albumDir, (album, needArt) in unresolvedAlbums.items():
+        if albumDir in chosenCovers:
+            album["cover"], album["mime"], album["coverSteps"] = planCover(
+                needArt[0]["path"], args, chosenCovers[albumDir]
+            )
+        if album["cover"] is None:
+            for track in needArt:
+                track.update(action=PLAN_SKIP, reason="no cover")
+
+
+def buildPlan(args, stateDb):
+    # Phase one: read-only scan of the whole tree
+    # Returns None if there's nothing to scan
+    albums = albumsFromArgs(args)
+    if albums is None:
+        return None
+
+    from concurrent.futures import ThreadPoolExecutor
+
+    plan = newPlan(args.filename, planSettings(args))
+    with ThreadPoolExecutor(max_workers=args.io_concurrency) as pool:
+        for albumDir, songPaths in albums:
+            plan["albums"].append(planAlbum(albumDir, songPaths, args, stateDb, pool))
+    resolvePlanCovers(plan, args)
+    # Walk the album dirs in disk order too, not just the tracks in them
+    plan["albums"].sort(key=lambda album: localityKey(album["dir"]))
+
+    counts = countPlanActions(plan)
+    applogger.warning(
+        f"Plan for {len(plan['albums'])} albums: {counts[PLAN_ADD]} tracks to add art to, "
+        f"{counts[PLAN_REPLACE]} to replace art in, {counts[PLAN_SKIP]} skipped, "
+        f"{counts[PLAN_RESIZE]} covers to resize, {counts[PLAN_COPY]} to copy"
+    )
+    return plan
+
+
+def runCoverSteps(album, settings, args):
+    # Returns False if the cover couldn't be made
+    for step in album["coverSteps"]:
+        targetDir = dirname(step["target"])
+        if step["action"] == PLAN_RESIZE:
+            resizeName, resizeExt = fileExtension(basename(step["target"]))
+            applogger.info(f"Resizing {step['source']} to {step['target']}")
+            resizedPath = resizeImageAndSave(
+                step["source"],
+                targetDir,
+                settings["coverResizeDimensions"],
+                resizeName,
+                resizeExt.strip("."),
+                settings["coverJpegQuality"],
+                settings["coverJpegProgressive"],
+                settings["coverJpegSubsampling"],
+                settings["maxDecodeMegapixels"],
+                getResizeCache(args),
+            )
+            if resizedPath is None:
+                return False
+        elif step["action"] == PLAN_COPY:
+            applogger.info(f"Copying {step['source']} to {step['target']}")
+            try:
+                copyCover(step["source"], step["target"])
+            except OSError as e:
+                applogger.error(f"Couldn't copy {step['source']}: {e}")
+                return False
+    if not fileExists(album["cover"]):
+        applogger.error(f"Album art file does not exist: {album['cover']}")
+        return False
+    return True
+
+
+def executeTrack(track, albumArt, editAll):
+    # Runs io-concurrency wide, so it only reports back, stats are updated by the caller
+    # Returns (action, result code, bytes written stats)
+    songPath = track["path"]
+    writeStats = {"bytes": 0, "inPlace": 0, "rewritten": 0}
+    action = ACTION_ADD if track["action"] == PLAN_ADD else ACTION_REPLACE
+    try:
+        with openTrack(songPath) as trackFile:
+            songStat = fstat(trackFile.fileno())
+            songFile = None
+            if (songStat.st_size, songStat.st_mtime_ns) != (
+                track["size"],
+                track["mtimeNs"],
+            ):
+                # Changed since it was planned, might have gotten art in the meantime
+                applogger.info(f"{songPath} changed since planning, checking it again")
+                hasArt, songFile = probeTrack(songPath, trackFile)
+                if hasArt and not editAll:
+                    return ACTION_SKIP, 0, writeStats
+                action = ACTION_REPLACE if hasArt else ACTION_ADD
+            applogger.info(
+                f"Adding album art to: {songPath}"
+                if action == ACTION_ADD
+                else f"Changing album art for: {songPath}"
+            )
+            result = addAlbumArtToSong(
+                songPath, *albumArt, writeStats, trackFile, songFile
+            )
+    except Exception as e:
+        applogger.error(f"Exception occured while tagging {songPath}: {e}")
+        result = -1
+    return action, result, writeStats
+
+
+def executeAlbum(album, settings, args, pool, stats):
+    albumArt = None
+    needArt = [track for track in album["tracks"] if track["action"] != PLAN_SKIP]
+    if needArt and runCoverSteps(album, settings, args):
+        albumArt = (album["cover"], album["mime"])
+        # Read the cover here once, not in every tagging thread
+        getCachedPicture(*albumArt)
+
+    for track in album["tracks"]:
+        if track["action"] != PLAN_SKIP:
+            continue
+        stats["tracks"] += 1
+        if track["reason"] == "unchanged":
+            stats["unchanged"] += 1
+        elif track["reason"] == "has art":
+            recordTrackResult(stats, track["path"], ACTION_SKIP, RESULT_OK)
+        elif track["reason"] == "no cover":
+            # Nothing went wrong, nobody came up with a cover, same as in processAlbum()
+            applogger.info(f"Art for {track['path']} not found")
+            stats["unresolved"].append(track["path"])
+        else:
+            applogger.error(f"Skipping {track['path']}: {track['reason']}")
+            stats["failed"].append(track["path"])
+            recordTrackResult(stats, track["path"], ACTION_ADD, RESULT_FAILED)
+
+    if albumArt is None:
+        for track in needArt:
+            applogger.error(f"No album art for {track['path']}, skipping...")
+            stats["tracks"] += 1
+            stats["failed"].append(track["path"])
+            recordTrackResult(stats, track["path"], ACTION_ADD, RESULT_FAILED)
+        return
+
+    # Tracks were planned in disk order, map() hands them out in that order
+    trackResults = pool.map(
+        executeTrack,
+        needArt,
+        itertools.repeat(albumArt),
+        itertools.repeat(settings["editAll"]),
+    )
+    for track, (action, result, writeStats) in zip(needArt, trackResults):
+        stats["tracks"] += 1
+        for name, count in writeStats.items():
+            stats["writes"][name] += count
+        if action == ACTION_SKIP:
+            applogger.info(f"File already has an album art: {track['path']}")
+            recordTrackResult(stats, track["path"], ACTION_SKIP, RESULT_OK)
+        elif result:
+            applogger.error(
+                f"Something went wrong when adding art to file {track['path']}"
+            )
+            stats["failed"].append(track["path"])
+            recordTrackResult(stats, track["path"], action, RESULT_FAILED, albumArt)
+        else:
+            stats["tagged"] += 1
+            recordTrackResult(stats, track["path"], action, RESULT_OK, albumArt)
+    takeResizeCacheCounters(stats)
+    takeCoverMemoryPeaks(stats)
+
+
+def executePlan(plan, args, stateDb):
+    # Phase two: album by album, each cover is made first, then its tracks are written
+    from concurrent.futures import ThreadPoolExecutor
+
+    stats = newStats()
+    with ThreadPoolExecutor(max_workers=args.io_concurrency) as pool:
+        for album in plan["albums"]:
+            applogger.debug("Executing plan for %s", album["dir"])
+            albumStats = newStats()
+            executeAlbum(album, plan["settings"], args, pool, albumStats)
+            mergeStats(stats, albumStats, stateDb)
+    logStats(stats)
+    return -1 if stats["failed"] or stats["unresolved"] else 0
+
+
+def runPlan(args):
+    stateDb = openStateDb(args)
+    plan = buildPlan(args, stateDb)
+    if stateDb is not None:
+        stateDb.close()
+    if plan is None:
+        return -1
+    savePlan(plan, args.plan)
+    return 0
+
+
+def runExecutePlan(args):
+    try:
+        plan = loadPlan(args.filename)
+    except PlanError as e:
+        applogger.error(str(e))
+        return -1
+    stateDb = openStateDb(args)
+    result = executePlan(plan, args, stateDb)
+    if stateDb is not None:
+        stateDb.close()
+    return result
+
+
+def runPlanFirst(args):
+    stateDb = openStateDb(args)
+    plan = buildPlan(args, stateDb)
+    result = -1 if plan is None else executePlan(plan, args, stateDb)
+    if stateDb is not None:
+        stateDb.close()
+    return result
+
+
+def snapshotDir(dirPath):
+    # (size, mtime) of the tracks and images in dirPath, right after we're done with it
+    snapshot = {}
+    try:
+        with scanDir(dirPath) as entries:
+            for entry in entries:
+                if fileExtension(entry.name)[1].lower().strip(".") in WATCH_EXTS:
+                    entryStat = entry.stat()
+                    snapshot[entry.name] = (entryStat.st_size, entryStat.st_mtime_ns)
+    except OSError:
+        pass
+    return snapshot
+
+
+def isOwnWrite(path, dirSnapshots):
+    # Tagging and resizing write into the watched tree too, those changes are already taken care of
+    dirSnapshot = dirSnapshots.get(dirname(path))
+    if dirSnapshot is None:
+        return False
+    try:
+        pathStat = stat(path)
+    except OSError:
+        # Gone again already, nothing to do with it
+        return True
+    return dirSnapshot.get(basename(path)) == (pathStat.st_size, pathStat.st_mtime_ns)
+
+
+def listTracks(albumDir):
+    with scanDir(albumDir) as entries:
+        return sorted(
+            entry.path
+            for entry in entries
+            if fileExtension(entry.name)[1].lower().strip(".") in SUPPORTED_TRACK_EXTS
+        )
+
+
+def processWatchedDir(albumDir, change, args, stateDb, totals):
+    # A new cover may have shown up, don't trust what the cover index remembers
+    forgetCoverIndex(albumDir)
+    if change["cover"]:
+        # Tracks that arrived before their cover have been waiting for this
+        songPaths = listTracks(albumDir)
+    else:
+        songPaths = sorted(path for path in change["tracks"] if fileExists(path))
+    if not songPaths:
+        return
+    coverPath, _ = checkForCommonAlbumArtNames(
+        songPaths[0],
+        COMMON_ART_NAMES,
+        args.copy_cover_name,
+        args.cover_resize_name,
+        args.cover_save_extension,
+    )
+    if coverPath is None:
+        # Not a failure yet, the cover is usually copied in last
+        applogger.info(f"No cover in {albumDir} yet, waiting for one")
+        return
+
+    albumStats = newStats()
+    songPaths = filterUnchangedTracks(songPaths, args, stateDb, albumStats)
+    if songPaths:
+        applogger.debug("Processing %s tracks in %s", len(songPaths), albumDir)
+        processAlbumSafe(songPaths, args, albumStats)
+    if stateDb is not None:
+        stateDb.record(albumStats["results"])
+
+    # Only running totals are kept, so nothing grows with the uptime
+    totals["albums"] += 1
+    totals["tagged"] += albumStats["tagged"]
+    totals["failed"] += len(albumStats["failed"])
+    for songPath in albumStats["failed"]:
+        applogger.warning(f"Failed: {songPath}")
+    if albumStats["tagged"] or albumStats["failed"]:
+        applogger.warning(
+            f"{albumDir}: {albumStats['tagged']} tagged, {len(albumStats['failed'])} failed "
+            f"({totals['tagged']} tagged, {totals['failed']} failed in {totals['albums']} albums so far)"
+        )
+
+
+def runWatch(args):
+    # Tags tracks as they show up, one album dir at a time, once the dir has been quiet for a bit
+    rootDir = args.filename
+    if not isDir(rootDir):
+        applogger.error(f"--watch needs a directory, got {rootDir}, exiting...")
+        return -1
+
+    watcher = openWatcher(
+        rootDir, WATCH_EXTS, args.watch_poll_interval, args.watch_poll
+    )
+    stateDb = openStateDb(args)
+    # album dir -> changed track paths and whether a cover changed, and when it last changed
+    pending = {}
+    lastChange = {}
+    dirSnapshots = OrderedDict()
+    totals = {"albums": 0, "tagged": 0, "failed": 0, "failedAlbums": 0}
+    applogger.warning(f"Watching {rootDir} for new tracks and covers...")
+    try:
+        while True:
+            timeout = None
+            if lastChange:
+                timeout = max(
+                    0.0, min(lastChange.values()) + args.watch_debounce - perfCounter()
+                )
+            for path in watcher.read(timeout):
+                if isOwnWrite(path, dirSnapshots):
+                    continue
+                albumDir = dirname(path)
+                change = pending.setdefault(albumDir, {"tracks": set(), "cover": False})
+                if fileExtension(path)[1].lower().strip(".") in SUPPORTED_TRACK_EXTS:
+                    change["tracks"].add(path)
+                else:
+                    change["cover"] = True
+                lastChange[albumDir] = perfCounter()
+
+            now = perfCounter()
+            for albumDir in [
+                albumDir
+                for albumDir, changedAt in lastChange.items()
+                if now - changedAt >= args.watch_debounce
+            ]:
+                del lastChange[albumDir]
+                try:
+                    processWatchedDir(
+                        albumDir, pending.pop(albumDir), args, stateDb, totals
+                    )
+                except Exception as e:
+                    # Removed again before we got to it, or something in it can't be read;
+                    # either way the watching goes on
+                    applogger.error(f"Couldn't process {albumDir}: {e}")
+                    totals["albums"] += 1
+                    totals["failedAlbums"] += 1
+                dirSnapshots[albumDir] = snapshotDir(albumDir)
+                dirSnapshots.move_to_end(albumDir)
+                if len(dirSnapshots) > WATCH_SNAPSHOT_MAX_DIRS:
+                    dirSnapshots.popitem(last=False)
+    except KeyboardInterrupt:
+        applogger.warning(
+            f"Stopped watching, {totals['tagged']} tagged and {totals['failed']} failed "
+            f"in {totals['albums']} albums ({totals['failedAlbums']} couldn't be processed)"
+        )
+    finally:
+        watcher.close()
+        if stateDb is not None:
+            stateDb.close()
+    return 0
+
+
+def runMode(args):
+    if args.list_artless:
+        return runListArtless(args)
+    if args.estimate_writes:
+        return runEstimateWrites(args)
+    if args.audit_art:
+        return runAuditArt(args)
+    if args.shrink_art:
+        return runShrinkArt(args)
+    if args.watch:
+        return runWatch(args)
+    if args.plan is not None:
+        return runPlan(args)
+    if args.execute_plan:
+        return runExecutePlan(args)
+    if args.plan_first:
+        return runPlanFirst(args)
+
+    if args.recursive:
+        return runRecursive(args)
+    return runSingleFile(args)
+
+
+def run(argv=None):
+    args = parseArguments(argv)
+    if args is None:
+        applogger.error("Invalid arguments, exiting...")
+        return -1
+    limitMemory(args, threading.BoundedSemaphore(args.max_decoded_images))
+
+    if args.metrics is None:
+        return runMode(args)
+    metrics.enable()
+    runStart = perfCounter()
+    result = runMode(args)
+    runSummary = {"wallSeconds": perfCounter() - runStart, "exitCode": result}
+    writeReport(buildReport({"run": runSummary}), args.metrics, args.metrics_file)
+    return result
@@ -0,0 +1,354 @@
+#!/usr/bin/env python3
+
+# Everything convert-album-art-to-jpg.py does, importable; see albumart.py for the functions meant to be used from Python
+
+# For parsing the commandline arguments
+import argparse
+
+import itertools
+import threading
+from collections import deque
+
+# Covers are written to a temp file and renamed into place, a tagger run may have the old one mapped
+from covermap import writeReplacing
+
+# For --jobs, the pool itself is imported when it's needed
+from os import cpu_count as cpuCount
+
+# System file handling stuff
+from os import listdir as listDir
+from os import stat
+from os import walk as walkDir
+from os.path import dirname, join
+from os.path import exists as fileExists
+from os.path import isdir as isDir
+
+# For the throughput summary
+from time import perf_counter as perfCounter
+
+# Draft-decoding resize engine, shared with album-art-script.py
+from resizer import resizeImage, ResizeError
+from resizer import DEFAULT_JPEG_QUALITY, DEFAULT_JPEG_SUBSAMPLING, JPEG_SUBSAMPLINGS
+from resizer import DEFAULT_MAX_DECODED_IMAGES, setDecodeSlots
+
+import logging
+from logger import applogger, setupLogging
+from logger import DEFAULT_TERMINAL_LEVEL, DEFAULT_FILE_LEVEL
+
+WANTED_NAME = "cover"
+WANTED_EXT = "jpg"
+WANTED_FILENAME = f"{WANTED_NAME}.{WANTED_EXT}"
+BACKUP_FILENAME = f"{WANTED_NAME}-original.{WANTED_EXT}"
+
+COMMON_ART_NAMES = [
+    WANTED_NAME,
+    "cover",
+    "Cover",
+    "COVER",
+    "cover0",
+    "folder",
+    "Folder",
+    "FOLDER",
+    "album_art",
+    "Album_art",
+    "ALBUM_ART",
+    "albumart",
+    "Albumart",
+    "AlbumArt",
+    "ALBUMART",
+    "jacket",
+    "Jacket",
+    "JACKET",
+]
+COMMON_ART_EXT = [
+    WANTED_EXT,
+    "jpg",
+    "Jpg",
+    "JPG",
+    "jpeg",
+    "JPEG",
+    "Jpeg",
+    "png",
+    "Png",
+    "PNG",
+    "tif",
+    "TIF",
+    "Tif",
+    "Tiff",
+    "tiff",
+    "TIFF",
+    "bmp",
+    "Bmp",
+    "BMP",
+]
+
+ART_NAMES = [
+    ".".join(combo) for combo in itertools.product(COMMON_ART_NAMES, COMMON_ART_EXT)
+]
+# Dir listings are matched case-insensitively, so the ~400 combinations above boil down to these,
+# still in the same order of preference
+ART_NAMES_LOWER = list(dict.fromkeys(name.lower() for name in ART_NAMES))
+
+DEFAULT_RESIZE_DIM = 512
+DIRS_IN_FLIGHT_PER_JOB = 4
+
+
+def resizeImageAndSave(
+    imagePath,
+    convertedName,
+    saveDir,
+    resizeDim=DEFAULT_RESIZE_DIM,
+    quality=DEFAULT_JPEG_QUALITY,
+    progressive=False,
+    subsampling=DEFAULT_JPEG_SUBSAMPLING,
+):
+    fileName = join(saveDir, convertedName)
+    try:
+        # Transparent covers are flattened onto white, since we're saving as JPG
+        imageData, imageSize = resizeImage(
+            imagePath, resizeDim, WANTED_EXT, quality, progressive, subsampling
+        )
+    except (ResizeError, OSError) as e:
+        applogger.error(
+            f"Unhandled exception occured while resizing the album art: {e}"
+        )
+        return None
+    applogger.debug("Trying to save the resized image...")
+    writeReplacing(fileName, imageData)
+    applogger.debug("Resized %s to %s and saved as %s.", imagePath, imageSize, fileName)
+    return fileName
+
+
+def buildArgumentParser():
+    argparser = argparse.ArgumentParser()
+    argparser.add_argument("filename")  # A track, or a dir with --recursive
+    argparser.add_argument("--verbose", "-v", action="store_true")
+    argparser.add_argument("--very-verbose", "-vv", action="store_true")
+    argparser.add_argument("--resize-dimensions", type=int, default=DEFAULT_RESIZE_DIM)
+    argparser.add_argument("--jpeg-quality", type=int, default=DEFAULT_JPEG_QUALITY)
+    argparser.add_argument("--jpeg-progressive", action="store_true")
+    argparser.add_argument(
+        "--jpeg-subsampling",
+        choices=JPEG_SUBSAMPLINGS,
+        default=DEFAULT_JPEG_SUBSAMPLING,
+    )
+    argparser.add_argument(
+        "--recursive", "-r", action="store_true"
+    )  # Convert the covers in every dir under filename
+    argparser.add_argument(
+        "--jobs", "-j", type=int, default=cpuCount() or 1
+    )  # Dirs converted at once, threads are enough since PIL lets go of the GIL while decoding/encoding
+    argparser.add_argument(
+        "--max-decoded-images", type=int, default=DEFAULT_MAX_DECODED_IMAGES
+    )  # Covers decoded at once, the other --jobs threads wait for their turn
+    argparser.add_argument(
+        "--force", action="store_true"
+    )  # Convert even if cover.jpg is already up to date
+    argparser.add_argument(
+        "--textlog", action="store_true"
+    )  # Also log to album-art-script.log
+    return argparser
+
+
+def parseArguments(argv=None):
+    args = buildArgumentParser().parse_args(argv)
+
+    if args.very_verbose:
+        terminalLevel = logging.DEBUG
+    elif args.verbose:
+        terminalLevel = logging.INFO
+    else:
+        terminalLevel = DEFAULT_TERMINAL_LEVEL
+    setupLogging(terminalLevel, DEFAULT_FILE_LEVEL if args.textlog else None)
+    applogger.debug("Args are %s", args)
+
+    if args.jobs < 1:
+        applogger.error("--jobs has to be at least 1!")
+        return None
+    if args.max_decoded_images < 1:
+        applogger.error("--max-decoded-images has to be at least 1!")
+        return None
+    setDecodeSlots(threading.BoundedSemaphore(args.max_decoded_images))
+    return args
+
+
+def findArt(fileNames):
+    # Returns the actual file name of the preferred cover in the listing (other than
+    # cover.jpg and its backup, those are handled separately), or None
+    dirFiles = {}
+    for fileName in fileNames:
+        dirFiles.setdefault(fileName.lower(), fileName)
+    for artName in ART_NAMES_LOWER:
+        if artName in (WANTED_FILENAME, BACKUP_FILENAME):
+            continue
+        if artName in dirFiles:
+            return dirFiles[artName]
+    return None
+
+
+def expectedSize(sourceSize, resizeDim):
+    # Roughly what PIL's thumbnail() does: keep the aspect ratio, never upscale
+    width, height = sourceSize
+    if max(width, height) <= resizeDim:
+        return width, height
+    if width >= height:
+        return resizeDim, max(1, round(height * resizeDim / width))
+    return max(1, round(width * resizeDim / height)), resizeDim
+
+
+def imageSize(imagePath):
+    # PIL only reads the header here, the pixels are decoded lazily
+    from PIL import Image as PILImage
+
+    with PILImage.open(imagePath) as image:
+        return image.size
+
+
+def hasWantedSize(wantedPath, sourcePath, resizeDim):
+    from PIL import Image as PILImage
+
+    try:
+        wantedSize = imageSize(wantedPath)
+        sourceSize = expectedSize(imageSize(sourcePath), resizeDim)
+    except (OSError, PILImage.DecompressionBombError):
+        return False
+    # PIL rounds the short side its own way, a pixel off either way is still the same cover
+    return all(abs(a - b) <= 1 for a, b in zip(wantedSize, sourceSize))
+
+
+def isUpToDate(wantedPath, sourcePath, resizeDim):
+    # cover.jpg is newer than what it'd be made from, and is already the size it'd come out as
+    try:
+        if stat(wantedPath).st_mtime_ns < stat(sourcePath).st_mtime_ns:
+            return False
+    except OSError:
+        return False
+    return hasWantedSize(wantedPath, sourcePath, resizeDim)
+
+
+def pickSource(songDir, fileNames, args):
+    # Returns the file to convert from, or None if there isn't one
+    # cover-original.jpg, once it's there, always wins: it's the untouched cover.jpg from the first run
+    # An existing cover.jpg that isn't the size we'd make is somebody else's cover, so it's backed up
+    # (once) and converted from the backup. One that is, is ours, made from the other art in the dir
+    lowerNames = {fileName.lower(): fileName for fileName in fileNames}
+    wantedPath = join(songDir, lowerNames.get(WANTED_FILENAME, WANTED_FILENAME))
+    if BACKUP_FILENAME in lowerNames:
+        return join(songDir, lowerNames[BACKUP_FILENAME])
+
+    otherArt = findArt(fileNames)
+    otherPath = join(songDir, otherArt) if otherArt else None
+    if WANTED_FILENAME in lowerNames:
+        if otherPath is not None and hasWantedSize(
+            wantedPath, otherPath, args.resize_dimensions
+        ):
+            return otherPath
+        backupPath = join(songDir, BACKUP_FILENAME)
+        applogger.info(
+            f"{WANTED_FILENAME} already exists in {songDir}, copying to {BACKUP_FILENAME}"
+        )
+        writeReplacing(backupPath, sourcePath=wantedPath)
+        return backupPath
+    return otherPath
+
+
+def convertDir(songDir, fileNames, args):
+    # Returns (outcome, bytes of source decoded), outcome being one of the summary counters
+    try:
+        sourcePath = pickSource(songDir, fileNames, args)
+    except OSError as e:
+        applogger.error(f"Couldn't back up the cover in {songDir}: {e}")
+        return "failed", 0
+    if sourcePath is None:
+        applogger.debug("No suitable files found for conversion in %s", songDir)
+        return "noArt", 0
+
+    wantedPath = join(songDir, WANTED_FILENAME)
+    if not args.force and isUpToDate(wantedPath, sourcePath, args.resize_dimensions):
+        applogger.debug("%s is up to date", wantedPath)
+        return "upToDate", 0
+
+    applogger.info(f"Converting {sourcePath} to {wantedPath}")
+    if (
+        resizeImageAndSave(
+            sourcePath,
+            WANTED_FILENAME,
+            songDir,
+            args.resize_dimensions,
+            args.jpeg_quality,
+            args.jpeg_progressive,
+            args.jpeg_subsampling,
+        )
+        is None
+    ):
+        applogger.error(f"Something went wrong when converting {sourcePath}.")
+        return "failed", 0
+    return "converted", stat(sourcePath).st_size
+
+
+def findArtDirs(rootDir):
+    # Yields (dir, file names) for every dir that has anything convertable in it, as the tree is walked
+    for songDir, subDirs, fileNames in walkDir(rootDir):
+        subDirs.sort()
+        lowerNames = {fileName.lower() for fileName in fileNames}
+        if lowerNames.intersection(ART_NAMES_LOWER):
+            yield songDir, fileNames
+
+
+def collectResult(future, stats):
+    outcome, sourceBytes = future.result()
+    stats["dirs"] += 1
+    stats[outcome] += 1
+    stats["sourceBytes"] += sourceBytes
+
+
+def run(argv=None):
+    args = parseArguments(argv)
+    if args is None:
+        return -1
+
+    if args.recursive:
+        if not isDir(args.filename):
+            applogger.error(f"--recursive needs a directory, got {args.filename}")
+            return -1
+        artDirs = findArtDirs(args.filename)
+    else:
+        songPath = args.filename
+        applogger.debug("Got track %s to work with.", songPath)
+        if not fileExists(songPath):
+            applogger.error(f"File does not exist: {songPath}, exiting...")
+            return -1
+        songDir = dirname(songPath)
+        artDirs = [(songDir, listDir(songDir or "."))]
+
+    stats = {
+        "dirs": 0,
+        "converted": 0,
+        "upToDate": 0,
+        "noArt": 0,
+        "failed": 0,
+        "sourceBytes": 0,
+    }
+    startTime = perfCounter()
+
+    from concurrent.futures import ThreadPoolExecutor
+
+    with ThreadPoolExecutor(max_workers=args.jobs) as pool:
+        # map() would queue up the whole tree, so only a few dirs per thread are in flight
+        pending = deque()
+        for songDir, fileNames in artDirs:
+            pending.append(pool.submit(convertDir, songDir, fileNames, args))
+            if len(pending) >= args.jobs * DIRS_IN_FLIGHT_PER_JOB:
+                collectResult(pending.popleft(), stats)
+        while pending:
+            collectResult(pending.popleft(), stats)
+
+    elapsed = perfCounter() - startTime
+    applogger.warning(
+        f"{stats['dirs']} dirs in {elapsed:.2f}s "
+        f"({stats['dirs'] / elapsed if elapsed > 0 else 0.0:.1f} dirs/sec, "
+        f"{stats['sourceBytes'] / 1024 / 1024 / elapsed if elapsed > 0 else 0.0:.1f} MB/sec of source covers): "
+        f"{stats['converted']} converted, {stats['upToDate']} up to date, "
+        f"{stats['noArt']} without art, {stats['failed']} failed"
+    )
+    return -1 if stats["failed"] or stats["converted"] + stats["upToDate"] == 0 else 0
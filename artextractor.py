@@ -0,0 +1,307 @@
+#!/usr/bin/env python3
+
+# Everything extract-album-art.py does, importable; see albumart.py for the functions meant to be used from Python
+
+# For parsing the commandline arguments
+import argparse
+
+import itertools
+
+# System file handling stuff
+from os import walk as walkDir
+from os import listdir as listDir
+from os.path import dirname, join
+from os.path import exists as fileExists
+from os.path import isdir as isDir
+from os.path import splitext as fileExtension
+
+# Needed for ogg album art
+import base64
+
+# For the run summary
+from time import perf_counter as perfCounter
+
+# Tags are read with mutagen and covers only go through PIL with --convert-to,
+# both are imported inside the functions that use them
+
+# Header-only checks, so only a track that actually has art in it gets fully parsed
+from artprobe import probeMP3, probeOGG, probeFLAC, ProbeError
+
+# Covers are written to a temp file and renamed into place, a tagger run may have the old one mapped
+from covermap import writeReplacing
+
+# Logging setup has been offloaded to a separate module, logger.py
+# applogger is the logger to call, defined in logger.py
+import logging
+from logger import applogger, setupLogging
+from logger import DEFAULT_TERMINAL_LEVEL, DEFAULT_FILE_LEVEL
+
+COMMON_ART_NAME_MAIN = [
+    "cover",
+    "Cover",
+    "COVER",
+    "cover0",
+    "folder",
+    "Folder",
+    "FOLDER",
+    "album_art",
+    "Album_art",
+    "ALBUM_ART",
+    "albumart",
+    "Albumart",
+    "AlbumArt",
+    "ALBUMART",
+]
+COMMON_ART_NAME_EXT = ["jpg", "Jpg", "jpeg", "Jpeg", "JPG", "JPEG", "png", "Png", "PNG"]
+COMMON_ART_NAMES = [
+    ".".join(combo)
+    for combo in itertools.product(COMMON_ART_NAME_MAIN, COMMON_ART_NAME_EXT)
+]
+# Covers are matched case-insensitively, so this is all that's needed for the lookup
+COMMON_ART_NAMES_LOWER = {name.lower() for name in COMMON_ART_NAMES}
+DEFAULT_SAVE_NAME = "cover"
+SUPPORTED_TRACK_EXTS = ["mp3", "ogg", "flac"]
+
+# Embedded MIME types are often wrong ("image/jpg", or nothing at all), the magic bytes aren't
+IMAGE_MAGIC = [
+    (b"\xff\xd8\xff", "jpg"),
+    (b"\x89PNG\r\n\x1a\n", "png"),
+    (b"GIF8", "gif"),
+]
+MIME_EXTS = {"image/jpeg": "jpg", "image/jpg": "jpg", "image/png": "png"}
+CONVERT_FORMATS = {"jpg": "JPEG", "png": "PNG"}
+# Everything saveImage() can come up with, a <save name>.<one of these> is an earlier run's cover
+SAVED_IMAGE_EXTS = (
+    {ext for _, ext in IMAGE_MAGIC} | set(MIME_EXTS.values()) | set(CONVERT_FORMATS)
+)
+FRONT_COVER = 3
+
+
+def buildArgumentParser():
+    argparser = argparse.ArgumentParser()
+    argparser.add_argument("filename")  # A track, or a dir with --recursive
+    argparser.add_argument("--verbose", "-v", action="store_true")
+    argparser.add_argument("--very-verbose", "-vv", action="store_true")
+    argparser.add_argument("--recursive", "-r", action="store_true")
+    argparser.add_argument(
+        "--save-name", default=DEFAULT_SAVE_NAME
+    )  # Extension comes from the image itself
+    argparser.add_argument(
+        "--convert-to", choices=list(CONVERT_FORMATS)
+    )  # Re-encode the extracted cover, otherwise the bytes are written as they are
+    argparser.add_argument(
+        "--force", action="store_true"
+    )  # Extract even if the album dir has a cover already
+    argparser.add_argument(
+        "--textlog", action="store_true"
+    )  # Also log to album-art-script.log
+    return argparser
+
+
+def parseArguments(argv=None):
+    args = buildArgumentParser().parse_args(argv)
+
+    if args.very_verbose:
+        terminalLevel = logging.DEBUG
+    elif args.verbose:
+        terminalLevel = logging.INFO
+    else:
+        terminalLevel = DEFAULT_TERMINAL_LEVEL
+    setupLogging(terminalLevel, DEFAULT_FILE_LEVEL if args.textlog else None)
+    applogger.debug("Args are %s", args)
+    return args
+
+
+def hasCoverFile(fileNames, saveName=DEFAULT_SAVE_NAME):
+    # fileNames is the dir listing we already have from walking the tree, no extra stat()s
+    savedNames = {f"{saveName}.{ext}".lower() for ext in SAVED_IMAGE_EXTS}
+    return any(
+        fileName.lower() in COMMON_ART_NAMES_LOWER or fileName.lower() in savedNames
+        for fileName in fileNames
+    )
+
+
+def probeTrack(songPath):
+    # True/False if the track has art, None if it couldn't be told from the headers
+    songExt = fileExtension(songPath)[1].lower().strip(".")
+    probes = {"mp3": probeMP3, "ogg": probeOGG, "flac": probeFLAC}
+    try:
+        return bool(probes[songExt](songPath))
+    except (ProbeError, OSError) as e:
+        applogger.debug("Couldn't probe %s (%s), parsing it instead", songPath, e)
+        return None
+
+
+def pickPicture(pictures):
+    # Front cover if there's one, otherwise whatever comes first
+    # pictures are (picture type, MIME type, data)
+    for picture in pictures:
+        if picture[0] == FRONT_COVER:
+            return picture
+    return pictures[0] if pictures else None
+
+
+def extractImageFromMP3(songPath):
+    from mutagen.id3 import ID3, ID3NoHeaderError
+
+    try:
+        trackTags = ID3(songPath)
+    except ID3NoHeaderError:
+        applogger.debug("No ID3 tags in %s", songPath)
+        return None
+    return pickPicture(
+        [(frame.type, frame.mime, frame.data) for frame in trackTags.getall("APIC")]
+    )
+
+
+def extractImageFromOGG(songPath):
+    from mutagen.oggvorbis import OggVorbis
+    from mutagen.flac import Picture as MutagenFLACPicture
+
+    pictures = []
+    for encodedPicture in OggVorbis(songPath).get("metadata_block_picture", []):
+        try:
+            picture = MutagenFLACPicture(base64.b64decode(encodedPicture))
+        except Exception as e:
+            applogger.warning(f"Broken metadata_block_picture in {songPath}: {e}")
+            continue
+        pictures.append((picture.type, picture.mime, picture.data))
+    return pickPicture(pictures)
+
+
+def extractImageFromFLAC(songPath):
+    from mutagen.flac import FLAC
+
+    return pickPicture(
+        [
+            (picture.type, picture.mime, picture.data)
+            for picture in FLAC(songPath).pictures
+        ]
+    )
+
+
+def extractImageFromTrack(songPath):
+    # Returns (MIME type, image bytes), or None if there's no embedded art
+    songExt = fileExtension(songPath)[1].lower().strip(".")
+    if songExt == "mp3":
+        picture = extractImageFromMP3(songPath)
+    elif songExt == "ogg":
+        picture = extractImageFromOGG(songPath)
+    elif songExt == "flac":
+        picture = extractImageFromFLAC(songPath)
+    else:
+        applogger.error(f"File type {songExt} is not supported for track {songPath}")
+        return None
+    if picture is None:
+        return None
+    return picture[1], picture[2]
+
+
+def imageExtension(imageMimeType, imageData):
+    for magic, ext in IMAGE_MAGIC:
+        if imageData.startswith(magic):
+            return ext
+    return MIME_EXTS.get(imageMimeType.lower(), "jpg")
+
+
+def convertImage(imageData, convertTo):
+    # Only with --convert-to, everything else is written byte for byte
+    from PIL import Image as PILImage
+    from resizer import flattenTransparency
+
+    from io import BytesIO
+
+    with PILImage.open(BytesIO(imageData)) as image:
+        if convertTo == "jpg":
+            image = flattenTransparency(image)
+        output = BytesIO()
+        image.save(output, CONVERT_FORMATS[convertTo])
+    return output.getvalue()
+
+
+def saveImage(imageMimeType, imageData, saveDir, saveName, convertTo=None):
+    if convertTo is not None:
+        imageData = convertImage(imageData, convertTo)
+        imageExt = convertTo
+    else:
+        imageExt = imageExtension(imageMimeType, imageData)
+    imagePath = join(saveDir, f"{saveName}.{imageExt}")
+    writeReplacing(imagePath, imageData)
+    return imagePath
+
+
+def extractAlbum(albumDir, songPaths, args, stats):
+    # Tries the tracks in order until one has art, usually that's the first one
+    for songPath in songPaths:
+        hasArt = probeTrack(songPath)
+        if hasArt is False:
+            continue
+        try:
+            picture = extractImageFromTrack(songPath)
+        except Exception as e:
+            applogger.error(f"Couldn't read tags from {songPath}: {e}")
+            continue
+        if picture is None:
+            continue
+        imageMimeType, imageData = picture
+        try:
+            imagePath = saveImage(
+                imageMimeType, imageData, albumDir, args.save_name, args.convert_to
+            )
+        except Exception as e:
+            applogger.error(f"Couldn't save the cover from {songPath}: {e}")
+            stats["failed"] += 1
+            return
+        applogger.info(
+            f"Extracted {len(imageData)} bytes from {songPath} to {imagePath}"
+        )
+        stats["extracted"] += 1
+        return
+    applogger.warning(f"No embedded art in any track in {albumDir}")
+    stats["noArt"] += 1
+
+
+def findAlbums(rootDir):
+    # Yields (albumDir, file names, [track paths]) as the tree is walked, nothing is collected up front
+    for albumDir, subDirs, fileNames in walkDir(rootDir):
+        subDirs.sort()
+        songPaths = [
+            join(albumDir, fileName)
+            for fileName in sorted(fileNames)
+            if fileExtension(fileName)[1].lower().strip(".") in SUPPORTED_TRACK_EXTS
+        ]
+        if songPaths:
+            yield albumDir, fileNames, songPaths
+
+
+def run(argv=None):
+    args = parseArguments(argv)
+    if args.recursive:
+        if not isDir(args.filename):
+            applogger.error(f"--recursive needs a directory, got {args.filename}")
+            return -1
+        albums = findAlbums(args.filename)
+    elif fileExists(args.filename):
+        # Single track, there's no walk to get the dir listing from
+        songDir = dirname(args.filename)
+        albums = [(songDir, listDir(songDir or "."), [args.filename])]
+    else:
+        applogger.error(f"File does not exist: {args.filename}, exiting...")
+        return -1
+
+    stats = {"albums": 0, "extracted": 0, "hadCover": 0, "noArt": 0, "failed": 0}
+    startTime = perfCounter()
+    for albumDir, fileNames, songPaths in albums:
+        stats["albums"] += 1
+        if not args.force and hasCoverFile(fileNames, args.save_name):
+            applogger.debug("%s already has a cover, skipping", albumDir)
+            stats["hadCover"] += 1
+            continue
+        extractAlbum(albumDir, songPaths, args, stats)
+
+    applogger.warning(
+        f"{stats['albums']} albums in {perfCounter() - startTime:.2f}s: "
+        f"{stats['extracted']} covers extracted, {stats['hadCover']} already had one, "
+        f"{stats['noArt']} without embedded art, {stats['failed']} failed"
+    )
+    return -1 if stats["failed"] else 0
@@ -0,0 +1,275 @@
+#!/usr/bin/env python3
+
+# Fast "is there art in this track" checks, reading only tag/frame headers
+# Picture data itself is never read, it's seek()ed over
+# The *PictureSizes() versions go through all of the pictures and return their sizes, for --audit-art
+# Anything unusual raises ProbeError, callers then fall back to a full mutagen parse
+# All of them take either a path or a file that's already open (binary, seekable), the latter is
+# rewound and left open, so the caller can go on to parse and write the tags through it
+
+import struct
+from contextlib import contextmanager
+from os import PathLike
+
+from metrics import metrics
+
+
+class ProbeError(Exception):
+    pass
+
+
+def syncsafeInt(data):
+    return (data[0] << 21) | (data[1] << 14) | (data[2] << 7) | data[3]
+
+
+class CountingReader:
+    # Passes everything through to the track, keeping count of what's read from it
+    def __init__(self, f):
+        self.f = f
+        self.bytesRead = 0
+
+    def read(self, size=-1):
+        data = self.f.read(size)
+        self.bytesRead += len(data)
+        return data
+
+    def __getattr__(self, name):
+        return getattr(self.f, name)
+
+
+@contextmanager
+def openSong(song):
+    # Whatever's read through it goes into io.trackBytesRead once it's closed
+    ownFile = isinstance(song, (str, bytes, PathLike))
+    f = open(song, "rb") if ownFile else song
+    f.seek(0)
+    reader = CountingReader(f)
+    try:
+        yield reader
+    finally:
+        metrics.count("io.trackBytesRead", reader.bytesRead)
+        if ownFile:
+            f.close()
+
+
+def mp3PictureSizes(songPath, firstOnly=False):
+    # Returns the sizes of the APIC (or v2.2 PIC) frames, and None if there's no ID3v2 tag at all
+    sizes = []
+    with openSong(songPath) as f:
+        header = f.read(10)
+        if len(header) < 10 or header[:3] != b"ID3":
+            return None
+        majorVersion, flags = header[3], header[5]
+        tagSize = syncsafeInt(header[6:10])
+        if majorVersion not in (2, 3, 4):
+            raise ProbeError(f"Unknown ID3v2.{majorVersion} tag")
+        if flags & 0x80 and majorVersion < 4:
+            # Whole-tag unsynchronisation can mangle frame headers, not worth handling here
+            raise ProbeError("Unsynchronised ID3 tag")
+
+        pos = 10
+        if flags & 0x40 and majorVersion >= 3:
+            extSize = f.read(4)
+            if len(extSize) < 4:
+                raise ProbeError("Truncated extended header")
+            # v2.3 doesn't count the size field itself, v2.4 does
+            if majorVersion == 4:
+                pos += syncsafeInt(extSize)
+            else:
+                pos += 4 + struct.unpack(">I", extSize)[0]
+            f.seek(pos)
+
+        if majorVersion == 2:
+            frameHeaderSize, idSize, pictureIds = 6, 3, (b"PIC",)
+        else:
+            frameHeaderSize, idSize, pictureIds = 10, 4, (b"APIC",)
+
+        end = 10 + tagSize
+        while pos + frameHeaderSize <= end:
+            frameHeader = f.read(frameHeaderSize)
+            if len(frameHeader) < frameHeaderSize:
+                raise ProbeError("Truncated frame header")
+            frameId = frameHeader[:idSize]
+            if frameId[0] == 0:
+                # Padding, no more frames
+                return sizes
+            if not frameId.isalnum() or frameId != frameId.upper():
+                raise ProbeError(f"Garbage frame id {frameId!r}")
+            if majorVersion == 2:
+                frameSize = int.from_bytes(frameHeader[3:6], "big")
+            elif majorVersion == 3:
+                frameSize = struct.unpack(">I", frameHeader[4:8])[0]
+            else:
+                frameSize = syncsafeInt(frameHeader[4:8])
+            if frameId in pictureIds:
+                sizes.append(frameSize)
+                if firstOnly:
+                    return sizes
+            pos += frameHeaderSize + frameSize
+            f.seek(pos)
+        return sizes
+
+
+def probeMP3(songPath):
+    # Returns True if there's an APIC (or v2.2 PIC) frame, False if there isn't,
+    # and None if there's no ID3v2 tag at all
+    sizes = mp3PictureSizes(songPath, firstOnly=True)
+    return None if sizes is None else bool(sizes)
+
+
+class OggPacketReader:
+    # Reads the packet data of a single logical Ogg stream across page boundaries,
+    # skip() seeks over page bodies instead of reading them
+    def __init__(self, f):
+        self.f = f
+        self.serial = None
+        self.remaining = 0
+
+    def nextPage(self):
+        header = self.f.read(27)
+        if len(header) < 27 or header[:4] != b"OggS":
+            raise ProbeError("Not an Ogg page")
+        serial = struct.unpack("<I", header[14:18])[0]
+        if self.serial is None:
+            self.serial = serial
+        elif serial != self.serial:
+            raise ProbeError("Multiplexed Ogg stream")
+        segmentTable = self.f.read(header[26])
+        self.remaining = sum(segmentTable)
+
+    def skipPage(self):
+        self.nextPage()
+        self.f.seek(self.remaining, 1)
+        self.remaining = 0
+
+    def read(self, size):
+        data = b""
+        while len(data) < size:
+            while self.remaining == 0:
+                self.nextPage()
+            chunk = self.f.read(min(size - len(data), self.remaining))
+            if not chunk:
+                raise ProbeError("Truncated Ogg page")
+            self.remaining -= len(chunk)
+            data += chunk
+        return data
+
+    def skip(self, size):
+        while size > 0:
+            while self.remaining == 0:
+                self.nextPage()
+            step = min(size, self.remaining)
+            self.f.seek(step, 1)
+            self.remaining -= step
+            size -= step
+
+
+def oggPictureSizes(songPath, firstOnly=False):
+    # Returns the sizes of the metadata_block_pictures in the Vorbis comment,
+    # as they'd be once the base64 is decoded
+    wantedKey = b"metadata_block_picture="
+    sizes = []
+    with openSong(songPath) as f:
+        reader = OggPacketReader(f)
+        # Identification header always sits on a page of its own
+        reader.skipPage()
+        if reader.read(7) != b"\x03vorbis":
+            raise ProbeError("No Vorbis comment header")
+        reader.skip(struct.unpack("<I", reader.read(4))[0])  # vendor string
+        commentCount = struct.unpack("<I", reader.read(4))[0]
+        for _ in range(commentCount):
+            commentSize = struct.unpack("<I", reader.read(4))[0]
+            keySize = min(commentSize, len(wantedKey))
+            if reader.read(keySize).lower() == wantedKey:
+                sizes.append((commentSize - keySize) * 3 // 4)
+                if firstOnly:
+                    return sizes
+            reader.skip(commentSize - keySize)
+        return sizes
+
+
+def probeOGG(songPath):
+    # Returns True if the Vorbis comment has a metadata_block_picture in it
+    return bool(oggPictureSizes(songPath, firstOnly=True))
+
+
+def oggCommentPagesEnd(songPath):
+    # Where the page the Vorbis comment packet ends on ends, everything before that is what
+    # mutagen rewrites to save the tags; a packet ends on a lacing value under 255
+    with openSong(songPath) as f:
+        serial = None
+        # Identification header always sits on a page of its own
+        isFirstPage = True
+        while True:
+            header = f.read(27)
+            if len(header) < 27 or header[:4] != b"OggS":
+                raise ProbeError("Not an Ogg page")
+            pageSerial = struct.unpack("<I", header[14:18])[0]
+            if serial is None:
+                serial = pageSerial
+            elif pageSerial != serial:
+                raise ProbeError("Multiplexed Ogg stream")
+            segmentTable = f.read(header[26])
+            f.seek(sum(segmentTable), 1)
+            if not isFirstPage and any(size < 255 for size in segmentTable):
+                return f.tell()
+            isFirstPage = False
+
+
+def skipID3v2(f):
+    # Some FLACs have an ID3v2 tag glued on the front, returns the offset right after it
+    header = f.read(10)
+    if len(header) == 10 and header[:3] == b"ID3":
+        offset = 10 + syncsafeInt(header[6:10])
+        # Footer flag adds another 10 bytes
+        if header[5] & 0x10:
+            offset += 10
+        f.seek(offset)
+        return offset
+    f.seek(0)
+    return 0
+
+
+def flacAudioOffset(songPath):
+    # Where the metadata blocks end and the audio frames start
+    with openSong(songPath) as f:
+        skipID3v2(f)
+        if f.read(4) != b"fLaC":
+            raise ProbeError("No fLaC marker")
+        while True:
+            blockHeader = f.read(4)
+            if len(blockHeader) < 4:
+                raise ProbeError("Truncated metadata block header")
+            f.seek(int.from_bytes(blockHeader[1:4], "big"), 1)
+            if blockHeader[0] & 0x80:
+                return f.tell()
+
+
+def flacPictureSizes(songPath, firstOnly=False):
+    # Returns the sizes of the PICTURE metadata blocks
+    sizes = []
+    with openSong(songPath) as f:
+        skipID3v2(f)
+        if f.read(4) != b"fLaC":
+            raise ProbeError("No fLaC marker")
+        while True:
+            blockHeader = f.read(4)
+            if len(blockHeader) < 4:
+                raise ProbeError("Truncated metadata block header")
+            blockType = blockHeader[0] & 0x7F
+            blockSize = int.from_bytes(blockHeader[1:4], "big")
+            if blockType == 6:
+                sizes.append(blockSize)
+                if firstOnly:
+                    return sizes
+            if blockType == 127:
+                raise ProbeError("Invalid metadata block type")
+            if blockHeader[0] & 0x80:
+                # Last metadata block
+                return sizes
+            f.seek(blockSize, 1)
+
+
+def probeFLAC(songPath):
+    # Returns True if there's a PICTURE metadata block
+    return bool(flacPictureSizes(songPath, firstOnly=True))
@@ -0,0 +1,310 @@
+#!/usr/bin/env python3
+
+# Checks --fetch-covers against a local stub of MusicBrainz and the Cover Art Archive
+# Synthetic albums (tracks from synthlib.py, tagged with an artist and album, no cover files) are tagged
+# with --recursive --no-prompt --fetch-covers musicbrainz --fetch-url <the stub>; the stub knows
+# some of them and redirects to the images the way the Cover Art Archive does
+# Fails unless the known albums got their cover and the rest didn't, requests kept to
+# --fetch-rate (give or take one late arrival), connections got reused, and a second run was answered
+# from the cache alone
+# Usage: python benchmarks/fetch.py [--albums 12] [--rate 20] [--jobs 4] [--latency-ms 10] [--output results.json]
+
+import argparse
+import json
+import platform
+import re
+import subprocess
+import sys
+import tempfile
+import threading
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from os import makedirs
+from os.path import join
+from random import Random
+from time import monotonic, perf_counter, sleep
+from urllib.parse import parse_qs, urlsplit
+
+from stages import REPO_DIR, SCRIPT, gitCommit
+from synthlib import TRACK_WRITERS, makeCover, DEFAULT_SEED
+
+DEFAULT_ALBUMS = 12
+DEFAULT_RATE = 20.0
+DEFAULT_JOBS = 4
+DEFAULT_LATENCY_MS = 10
+DEFAULT_TRACK_KB = 64
+DEFAULT_COVER_KB = 100
+# Every this many albums one the stub doesn't know, and one without tags to look it up by
+UNKNOWN_EVERY = 4
+UNTAGGED_EVERY = 6
+# Requests are timed as the stub sees them, and the limiter hands out fixed slots, so one that
+# arrives late (a new connection, a busy scheduler) leaves the next gap short; single gaps can't be
+# held to the rate, but no stretch of the run may have more than this many requests over it
+MAX_EXTRA_REQUESTS = 1
+
+RELEASE_GROUP_QUERY = re.compile(r'releasegroup:"((?:[^"\\]|\\.)*)"')
+
+
+class StubState:
+    def __init__(self, covers, latency):
+        # album name -> release group id, and id -> JPEG bytes
+        self.releaseGroups = {}
+        self.images = {}
+        for index, (album, data) in enumerate(covers.items()):
+            releaseGroupId = f"00000000-0000-0000-0000-{index:012}"
+            self.releaseGroups[album] = releaseGroupId
+            self.images[releaseGroupId] = data
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.requestTimes = []
+        self.connections = 0
+
+    def reset(self):
+        with self.lock:
+            self.requestTimes = []
+            self.connections = 0
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    # Keep-alive, so the client's connection pooling has something to show for itself
+    protocol_version = "HTTP/1.1"
+
+    def setup(self):
+        super().setup()
+        with self.server.state.lock:
+            self.server.state.connections += 1
+
+    def log_message(self, format, *args):
+        pass
+
+    def answer(self, status, body=b"", contentType=None, location=None):
+        self.send_response(status)
+        if contentType:
+            self.send_header("Content-Type", contentType)
+        if location:
+            self.send_header("Location", location)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        state = self.server.state
+        with state.lock:
+            state.requestTimes.append(monotonic())
+        sleep(state.latency)
+        url = urlsplit(self.path)
+        parts = url.path.strip("/").split("/")
+
+        if parts[:2] == ["ws", "2"]:
+            query = parse_qs(url.query).get("query", [""])[0]
+            match = RELEASE_GROUP_QUERY.search(query)
+            album = match.group(1).replace('\\"', '"') if match else None
+            releaseGroups = []
+            if album in state.releaseGroups:
+                releaseGroups.append({"id": state.releaseGroups[album], "score": 100})
+            self.answer(
+                200,
+                json.dumps({"release-groups": releaseGroups}).encode(),
+                "application/json",
+            )
+        elif parts[:1] == ["release-group"] and len(parts) == 3:
+            if parts[1] in state.images:
+                self.answer(307, location=f"/images/{parts[1]}.jpg")
+            else:
+                self.answer(404)
+        elif parts[:1] == ["images"] and len(parts) == 2:
+            data = state.images.get(parts[1].removesuffix(".jpg"))
+            if data is None:
+                self.answer(404)
+            else:
+                self.answer(200, data, "image/jpeg")
+        else:
+            self.answer(404)
+
+
+def tagTrack(path, artist, album):
+    from mutagen import File as MutagenFile
+
+    songFile = MutagenFile(path, easy=True)
+    if songFile.tags is None:
+        songFile.add_tags()
+    songFile["artist"] = artist
+    songFile["album"] = album
+    songFile.save()
+
+
+def buildLibrary(libraryDir, albumCount, seed, trackKb, coverKb):
+    # Returns (albums, the covers the stub knows by album name)
+    rng = Random(seed)
+    albums, covers = [], {}
+    for albumIndex in range(albumCount):
+        albumDir = join(libraryDir, f"album{albumIndex:03}")
+        makedirs(albumDir)
+        artist, album = f"Artist {albumIndex % 3}", f"Album {albumIndex:03}"
+        tagged = albumIndex % UNTAGGED_EVERY != UNTAGGED_EVERY - 1
+        known = tagged and albumIndex % UNKNOWN_EVERY != UNKNOWN_EVERY - 1
+        tracks = []
+        for trackExt, writeTrack in TRACK_WRITERS.items():
+            trackPath = join(albumDir, f"00.{trackExt}")
+            writeTrack(trackPath, trackKb, rng)
+            if tagged:
+                tagTrack(trackPath, artist, album)
+            tracks.append(trackPath)
+        if known:
+            covers[album] = makeCover(rng, "jpeg", coverKb)
+        albums.append({"dir": albumDir, "tracks": tracks, "known": known})
+    return albums, covers
+
+
+def runScript(libraryDir, baseUrl, cacheDir, rate, jobs):
+    command = [
+        sys.executable,
+        SCRIPT,
+        libraryDir,
+        "--recursive",
+        "--no-prompt",
+        "--jobs",
+        "1",
+        "--fetch-covers",
+        "musicbrainz",
+        "--fetch-url",
+        baseUrl,
+        "--fetch-cache",
+        cacheDir,
+        "--fetch-rate",
+        str(rate),
+        "--fetch-jobs",
+        str(jobs),
+    ]
+    start = perf_counter()
+    # Exits non-zero for the albums left without a cover, that's expected here
+    subprocess.run(command, capture_output=True, check=False)
+    return perf_counter() - start
+
+
+def extraRequests(requestTimes, rate):
+    # The most requests any stretch of the run had over what the rate allows in it
+    extra = 0.0
+    for first, firstTime in enumerate(requestTimes):
+        for last in range(first + 1, len(requestTimes)):
+            allowed = (requestTimes[last] - firstTime) * rate + 1
+            extra = max(extra, last - first + 1 - allowed)
+    return extra
+
+
+def countTaggedAlbums(albums):
+    sys.path.insert(0, REPO_DIR)
+    from albumtagger import checkExistingAlbumArt
+
+    tagged, wronglyTagged = 0, 0
+    for album in albums:
+        hasArt = all(checkExistingAlbumArt(trackPath) for trackPath in album["tracks"])
+        if hasArt and album["known"]:
+            tagged += 1
+        elif hasArt:
+            wronglyTagged += 1
+    return tagged, wronglyTagged
+
+
+def main():
+    argparser = argparse.ArgumentParser()
+    argparser.add_argument("--output")  # stdout if not given
+    argparser.add_argument("--albums", type=int, default=DEFAULT_ALBUMS)
+    argparser.add_argument("--rate", type=float, default=DEFAULT_RATE)
+    argparser.add_argument("--jobs", type=int, default=DEFAULT_JOBS)
+    argparser.add_argument("--latency-ms", type=float, default=DEFAULT_LATENCY_MS)
+    argparser.add_argument("--seed", type=int, default=DEFAULT_SEED)
+    argparser.add_argument("--track-kb", type=int, default=DEFAULT_TRACK_KB)
+    argparser.add_argument("--cover-kb", type=int, default=DEFAULT_COVER_KB)
+    args = argparser.parse_args()
+
+    runs = []
+    with tempfile.TemporaryDirectory() as tmpDir:
+        libraryDir = join(tmpDir, "library")
+        albums, covers = buildLibrary(
+            libraryDir, args.albums, args.seed, args.track_kb, args.cover_kb
+        )
+        server = ThreadingHTTPServer(("127.0.0.1", 0), StubHandler)
+        server.daemon_threads = True
+        server.state = StubState(covers, args.latency_ms / 1000)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        baseUrl = f"http://127.0.0.1:{server.server_address[1]}"
+        try:
+            for runName in ("cold", "cached"):
+                server.state.reset()
+                seconds = runScript(
+                    libraryDir, baseUrl, join(tmpDir, "cache"), args.rate, args.jobs
+                )
+                requestTimes = sorted(server.state.requestTimes)
+                gaps = [
+                    later - earlier
+                    for earlier, later in zip(requestTimes, requestTimes[1:])
+                ]
+                runs.append(
+                    {
+                        "run": runName,
+                        "requests": len(requestTimes),
+                        "connections": server.state.connections,
+                        "minGapSeconds": round(min(gaps), 4) if gaps else None,
+                        "extraRequests": round(
+                            extraRequests(requestTimes, args.rate), 2
+                        ),
+                        "seconds": round(seconds, 3),
+                    }
+                )
+        finally:
+            server.shutdown()
+            server.server_close()
+        tagged, wronglyTagged = countTaggedAlbums(albums)
+
+    cold, cached = runs
+    failures = []
+    if tagged != len(covers):
+        failures.append(f"{tagged} of {len(covers)} known albums got their cover")
+    if wronglyTagged:
+        failures.append(f"{wronglyTagged} albums got a cover the stub doesn't have")
+    if cold["extraRequests"] > MAX_EXTRA_REQUESTS:
+        failures.append(
+            f"{cold['extraRequests']} requests more than --fetch-rate {args.rate} allows "
+            "in one stretch of the run"
+        )
+    if cold["connections"] >= cold["requests"]:
+        failures.append(
+            f"{cold['connections']} connections for {cold['requests']} requests, none reused"
+        )
+    if cached["requests"]:
+        failures.append(f"{cached['requests']} requests with everything cached")
+
+    report = {
+        "meta": {
+            "time": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+            "commit": gitCommit(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "rate": args.rate,
+            "jobs": args.jobs,
+            "latencyMs": args.latency_ms,
+        },
+        "library": {
+            "seed": args.seed,
+            "albums": args.albums,
+            "knownAlbums": len(covers),
+            "trackKb": args.track_kb,
+            "coverKb": args.cover_kb,
+        },
+        "runs": runs,
+        "taggedAlbums": tagged,
+    }
+    if args.output:
+        with open(args.output, "w") as outputFile:
+            json.dump(report, outputFile, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+    for failure in failures:
+        print(f"FAIL: {failure}")
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
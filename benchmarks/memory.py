@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+
+# Checks that album-art-script.py --recursive runs in flat memory, whatever the library size
+# The same synthetic albums (see synthlib.py) are copied --copies times into a small library and
+# --scale times that into a bigger one, both get tagged with their covers resized (so images are decoded
+# and cover buffers held), and the peak RSS of the biggest process of each run is compared
+# The small library has to be big enough for the bounded caches to fill up, or that's what gets measured
+# Fails if the bigger library took more than --tolerance more memory
+# Usage: python benchmarks/memory.py [--copies 4] [--scale 4] [--jobs 2] [--tolerance 0.15] [--output results.json]
+
+import argparse
+import json
+import platform
+import subprocess
+import sys
+import tempfile
+from datetime import datetime, timezone
+from os import listdir as listDir
+from os.path import isdir, join
+from shutil import copytree
+from time import perf_counter
+
+from stages import SCRIPT, gitCommit
+from synthlib import generateLibrary, parseSizes
+from synthlib import DEFAULT_SEED, DEFAULT_TRACKS_PER_FORMAT
+
+DEFAULT_COPIES = 4
+DEFAULT_SCALE = 4
+DEFAULT_JOBS = 2
+DEFAULT_TOLERANCE = 0.15
+# Big enough to be resized with -s 1, small enough to generate quickly
+DEFAULT_COVER_SIZES_KB = [2000, 8000]
+DEFAULT_TRACK_KB = 64
+
+# ru_maxrss of the children is the biggest process of the tree that ran, workers included
+MEASURE = """
+import resource, subprocess, sys
+subprocess.run(sys.argv[1:], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+print(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * 1024)
+"""
+
+
+def buildLibrary(baseDir, libraryDir, copies):
+    # copies of every album in baseDir, each copy in its own dir so they're all tagged separately
+    albumNames = sorted(name for name in listDir(baseDir) if isdir(join(baseDir, name)))
+    for copyIndex in range(copies):
+        for albumName in albumNames:
+            copytree(
+                join(baseDir, albumName), join(libraryDir, f"{copyIndex:04}", albumName)
+            )
+    return len(albumNames) * copies
+
+
+def measureRun(libraryDir, stateDbPath, jobs):
+    command = [
+        sys.executable,
+        SCRIPT,
+        libraryDir,
+        "--recursive",
+        "--jobs",
+        str(jobs),
+        "--copy-cover",
+        "--max-cover-size",
+        "1",
+        "--no-prompt",
+        "--state-db",
+        stateDbPath,
+    ]
+    start = perf_counter()
+    result = subprocess.run(
+        [sys.executable, "-c", MEASURE] + command,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    return int(result.stdout.strip()), perf_counter() - start
+
+
+def main():
+    argparser = argparse.ArgumentParser()
+    argparser.add_argument("--output")  # stdout if not given
+    argparser.add_argument("--copies", type=int, default=DEFAULT_COPIES)
+    argparser.add_argument("--scale", type=int, default=DEFAULT_SCALE)
+    argparser.add_argument("--jobs", type=int, default=DEFAULT_JOBS)
+    argparser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE)
+    argparser.add_argument("--seed", type=int, default=DEFAULT_SEED)
+    argparser.add_argument(
+        "--cover-sizes-kb", type=parseSizes, default=DEFAULT_COVER_SIZES_KB
+    )
+    argparser.add_argument(
+        "--tracks-per-format", type=int, default=DEFAULT_TRACKS_PER_FORMAT
+    )
+    argparser.add_argument("--track-kb", type=int, default=DEFAULT_TRACK_KB)
+    args = argparser.parse_args()
+
+    runs = []
+    with tempfile.TemporaryDirectory() as tmpDir:
+        baseDir = join(tmpDir, "base")
+        manifest = generateLibrary(
+            baseDir,
+            args.seed,
+            args.cover_sizes_kb,
+            args.tracks_per_format,
+            args.track_kb,
+        )
+        tracksPerCopy = sum(len(album["tracks"]) for album in manifest["albums"])
+        for copies in (args.copies, args.copies * args.scale):
+            libraryDir = join(tmpDir, f"library-{copies}")
+            albumCount = buildLibrary(baseDir, libraryDir, copies)
+            peakRss, seconds = measureRun(
+                libraryDir, join(tmpDir, f"state-{copies}.sqlite"), args.jobs
+            )
+            runs.append(
+                {
+                    "albums": albumCount,
+                    "tracks": tracksPerCopy * copies,
+                    "peakRssBytes": peakRss,
+                    "seconds": round(seconds, 3),
+                }
+            )
+
+    growth = runs[1]["peakRssBytes"] / runs[0]["peakRssBytes"] - 1
+    report = {
+        "meta": {
+            "time": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+            "commit": gitCommit(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "jobs": args.jobs,
+        },
+        "library": {
+            "seed": args.seed,
+            "coverSizesKb": args.cover_sizes_kb,
+            "tracksPerFormat": args.tracks_per_format,
+            "trackKb": args.track_kb,
+            "copies": args.copies,
+            "scale": args.scale,
+        },
+        "runs": runs,
+        "peakRssGrowth": round(growth, 4),
+    }
+    if args.output:
+        with open(args.output, "w") as outputFile:
+            json.dump(report, outputFile, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+    if growth > args.tolerance:
+        print(
+            f"FAIL: peak RSS grew {growth:.0%} for a {args.scale}x bigger library "
+            f"(allowed {args.tolerance:.0%})"
+        )
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,355 @@
+#!/usr/bin/env python3
+
+# Times each stage of album-art-script.py against a fresh synthetic library (see synthlib.py):
+# art detection, cover lookup, resizing and tagging, per track format / cover kind and size
+# trackIO compares the syscall I/O of checking + tagging a track through one handle against
+# the probe and mutagen opening it each on their own (Linux only, it's from /proc/self/io)
+# Writes the results as JSON, so runs can be kept and compared over time
+# Usage: python benchmarks/stages.py [--output results.json] [--repeat 3] [--cover-sizes-kb 100,1000]
+
+import argparse
+import json
+import logging
+import math
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+from datetime import datetime, timezone
+from os import makedirs
+from os.path import abspath, dirname, getsize, join, relpath
+from shutil import copytree
+from time import perf_counter
+
+from synthlib import generateLibrary, parseSizes
+from synthlib import DEFAULT_SEED, DEFAULT_COVER_SIZES_KB, DEFAULT_TRACK_KB
+from synthlib import DEFAULT_TRACKS_PER_FORMAT
+
+REPO_DIR = dirname(dirname(abspath(__file__)))
+SCRIPT = join(REPO_DIR, "album-art-script.py")
+DEFAULT_REPEAT = 3
+
+
+def loadScript():
+    # album-art-script.py is just the command line, the stages themselves are in albumtagger.py
+    sys.path.insert(0, REPO_DIR)
+    import albumtagger as script
+
+    # Missing-tag warnings and such would just be noise here
+    script.applogger.setLevel(logging.ERROR)
+    return script
+
+
+def summarize(timings):
+    timings = sorted(timings)
+    return {
+        "count": len(timings),
+        "totalMs": round(sum(timings) * 1000, 3),
+        "meanMs": round(statistics.mean(timings) * 1000, 3),
+        "medianMs": round(statistics.median(timings) * 1000, 3),
+        "p95Ms": round(timings[math.ceil(0.95 * len(timings)) - 1] * 1000, 3),
+        "maxMs": round(timings[-1] * 1000, 3),
+    }
+
+
+def timed(function, *args):
+    start = perf_counter()
+    result = function(*args)
+    return perf_counter() - start, result
+
+
+def benchDetection(script, manifest, repeat):
+    timings = {}
+    mismatches = 0
+    for _ in range(repeat):
+        for album in manifest["albums"]:
+            for track in album["tracks"]:
+                elapsed, hasArt = timed(script.checkExistingAlbumArt, track["path"])
+                timings.setdefault(track["format"], []).append(elapsed)
+                mismatches += bool(hasArt) != track["hasArt"]
+    results = {trackFormat: summarize(t) for trackFormat, t in timings.items()}
+    results["mismatches"] = mismatches
+    return results
+
+
+def benchLookup(script, manifest, repeat):
+    cold, warm = [], []
+    mismatches = 0
+    for _ in range(repeat):
+        # Cold means nothing in the cover index yet, so every album dir gets listed
+        script.coverIndex.clear()
+        for album in manifest["albums"]:
+            trackPath = album["tracks"][0]["path"]
+            lookupArgs = (
+                trackPath,
+                script.COMMON_ART_NAMES,
+                script.DEFAULT_SAVE_NAME,
+                script.DEFAULT_RESIZED_SAVE_NAME,
+                script.DEFAULT_SAVE_EXT,
+            )
+            elapsed, (coverPath, _) = timed(
+                script.checkForCommonAlbumArtNames, *lookupArgs
+            )
+            cold.append(elapsed)
+            mismatches += coverPath != album["cover"]
+            elapsed, _ = timed(script.checkForCommonAlbumArtNames, *lookupArgs)
+            warm.append(elapsed)
+    return {"cold": summarize(cold), "warm": summarize(warm), "mismatches": mismatches}
+
+
+def benchResize(script, manifest, repeat, outDir):
+    # Resized covers go to outDir, the library isn't touched, returns them for the tagging stage too
+    results = {}
+    resizedCovers = {}
+    for albumIndex, album in enumerate(manifest["albums"]):
+        if album["cover"] is None:
+            continue
+        saveDir = join(outDir, str(albumIndex))
+        makedirs(saveDir, exist_ok=True)
+        timings = []
+        for _ in range(repeat):
+            elapsed, resizedPath = timed(
+                script.resizeImageAndSave, album["cover"], saveDir
+            )
+            timings.append(elapsed)
+        key = f"{album['coverKind']}-{album['coverBytes'] // 1024}kb"
+        results[key] = summarize(timings)
+        if resizedPath is None:
+            results[key]["failed"] = True
+            continue
+        resizedCovers[album["dir"]] = resizedPath
+    return results, resizedCovers
+
+
+# open() calls made so far, counted by an audit hook that trackIO installs (they can't be removed)
+fileOpens = [0]
+
+
+def countFileOpens(event, _):
+    if event == "open":
+        fileOpens[0] += 1
+
+
+def readIOCounters():
+    # rchar/wchar/syscr/syscw of this process so far, None where there's no /proc/self/io
+    try:
+        with open("/proc/self/io") as ioFile:
+            return {
+                name: int(value)
+                for name, value in (line.split(": ") for line in ioFile)
+            }
+    except OSError:
+        return None
+
+
+def tagSeparately(script, trackPath, coverPath, imageMimeType, writes):
+    # The probe opens the track, then mutagen opens it again to parse and once more to save
+    script.checkExistingAlbumArt(trackPath)
+    return script.addAlbumArtToSong(trackPath, coverPath, imageMimeType, writes)
+
+
+def tagThroughOneHandle(script, trackPath, coverPath, imageMimeType, writes):
+    # What processAlbum() does
+    with script.openTrack(trackPath) as trackFile:
+        _, songFile = script.probeTrack(trackPath, trackFile)
+        return script.addAlbumArtToSong(
+            trackPath, coverPath, imageMimeType, writes, trackFile, songFile
+        )
+
+
+def benchTrackIO(script, manifest, resizedCovers, outDir):
+    # Each way gets its own copy of the albums, made before anything's measured
+    imageMimeType = script.MIME_TYPES[script.DEFAULT_SAVE_EXT]
+    ways = {"separate": tagSeparately, "oneHandle": tagThroughOneHandle}
+    tracks = {way: [] for way in ways}
+    for albumIndex, album in enumerate(manifest["albums"]):
+        coverPath = resizedCovers.get(album["dir"])
+        if coverPath is None:
+            continue
+        for way in ways:
+            albumDir = join(outDir, way, str(albumIndex))
+            copytree(album["dir"], albumDir)
+            tracks[way].extend(
+                (join(albumDir, relpath(track["path"], album["dir"])), coverPath)
+                for track in album["tracks"]
+            )
+
+    sys.addaudithook(countFileOpens)
+    results = {}
+    for way, tagTrack in ways.items():
+        timings = []
+        writes = {"bytes": 0, "inPlace": 0, "rewritten": 0}
+        before = readIOCounters()
+        opensBefore = fileOpens[0]
+        for trackPath, coverPath in tracks[way]:
+            elapsed, result = timed(
+                tagTrack, script, trackPath, coverPath, imageMimeType, writes
+            )
+            if result:
+                raise RuntimeError(f"Tagging {trackPath} failed")
+            timings.append(elapsed)
+        opens = fileOpens[0] - opensBefore
+        after = readIOCounters()
+        trackCount = len(tracks[way])
+        results[way] = summarize(timings)
+        results[way]["writes"] = writes
+        results[way]["opensPerTrack"] = round(opens / trackCount, 2)
+        if before is not None and after is not None:
+            results[way].update(
+                readBytesPerTrack=round(
+                    (after["rchar"] - before["rchar"]) / trackCount
+                ),
+                readCallsPerTrack=round(
+                    (after["syscr"] - before["syscr"]) / trackCount, 2
+                ),
+                writeCallsPerTrack=round(
+                    (after["syscw"] - before["syscw"]) / trackCount, 2
+                ),
+            )
+    results["savedPerTrack"] = {
+        key: round(results["separate"][key] - results["oneHandle"][key], 2)
+        for key in (
+            "opensPerTrack",
+            "readBytesPerTrack",
+            "readCallsPerTrack",
+            "writeCallsPerTrack",
+        )
+        if key in results["oneHandle"]
+    }
+    return results
+
+
+def benchTagging(script, manifest, resizedCovers):
+    # Every track is tagged twice: first time it's an add (or replace, for tracks that had art),
+    # the second time the same cover goes over it again, which should fit in place
+    # An in-place write has to count at least the cover and at most the whole track,
+    # anything else means the bytes written are miscounted
+    timings = {}
+    writes = {"bytes": 0, "inPlace": 0, "rewritten": 0}
+    implausibleWrites = []
+    for album in manifest["albums"]:
+        coverPath = resizedCovers.get(album["dir"])
+        if coverPath is None:
+            continue
+        for tagPass in ("first", "again"):
+            for track in album["tracks"]:
+                trackWrites = {"bytes": 0, "inPlace": 0, "rewritten": 0}
+                elapsed, result = timed(
+                    script.addAlbumArtToSong,
+                    track["path"],
+                    coverPath,
+                    script.MIME_TYPES[script.DEFAULT_SAVE_EXT],
+                    trackWrites,
+                )
+                if result:
+                    raise RuntimeError(f"Tagging {track['path']} failed")
+                timings.setdefault(f"{track['format']}-{tagPass}", []).append(elapsed)
+                if trackWrites["inPlace"] and not (
+                    getsize(coverPath) <= trackWrites["bytes"] <= getsize(track["path"])
+                ):
+                    implausibleWrites.append(
+                        {"path": track["path"], "bytes": trackWrites["bytes"]}
+                    )
+                for name, count in trackWrites.items():
+                    writes[name] += count
+    results = {key: summarize(t) for key, t in timings.items()}
+    results["writes"] = writes
+    results["implausibleWrites"] = implausibleWrites
+    return results
+
+
+def gitCommit():
+    try:
+        result = subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            cwd=REPO_DIR,
+            capture_output=True,
+            text=True,
+            check=True,
+        )
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return result.stdout.strip()
+
+
+def main():
+    argparser = argparse.ArgumentParser()
+    argparser.add_argument("--output")  # stdout if not given
+    argparser.add_argument("--repeat", type=int, default=DEFAULT_REPEAT)
+    argparser.add_argument("--seed", type=int, default=DEFAULT_SEED)
+    argparser.add_argument(
+        "--cover-sizes-kb", type=parseSizes, default=DEFAULT_COVER_SIZES_KB
+    )
+    argparser.add_argument(
+        "--tracks-per-format", type=int, default=DEFAULT_TRACKS_PER_FORMAT
+    )
+    argparser.add_argument("--track-kb", type=int, default=DEFAULT_TRACK_KB)
+    args = argparser.parse_args()
+
+    script = loadScript()
+    with tempfile.TemporaryDirectory() as tmpDir:
+        libraryDir = join(tmpDir, "library")
+        generateStart = perf_counter()
+        manifest = generateLibrary(
+            libraryDir,
+            args.seed,
+            args.cover_sizes_kb,
+            args.tracks_per_format,
+            args.track_kb,
+        )
+        generateSeconds = perf_counter() - generateStart
+
+        stages = {
+            "detection": benchDetection(script, manifest, args.repeat),
+            "lookup": benchLookup(script, manifest, args.repeat),
+        }
+        stages["resize"], resizedCovers = benchResize(
+            script, manifest, args.repeat, join(tmpDir, "resized")
+        )
+        # Before the tagging stage, that one writes to the library itself
+        stages["trackIO"] = benchTrackIO(
+            script, manifest, resizedCovers, join(tmpDir, "trackIO")
+        )
+        stages["tagging"] = benchTagging(script, manifest, resizedCovers)
+
+    report = {
+        "meta": {
+            "time": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+            "commit": gitCommit(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "repeat": args.repeat,
+            "generateSeconds": round(generateSeconds, 3),
+        },
+        "library": {
+            "seed": manifest["seed"],
+            "coverSizesKb": manifest["coverSizesKb"],
+            "tracksPerFormat": manifest["tracksPerFormat"],
+            "trackKb": manifest["trackKb"],
+            "albums": len(manifest["albums"]),
+        },
+        "stages": stages,
+    }
+    if args.output:
+        with open(args.output, "w") as outputFile:
+            json.dump(report, outputFile, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+    mismatches = stages["detection"]["mismatches"] + stages["lookup"]["mismatches"]
+    if mismatches:
+        print(f"FAIL: {mismatches} detection/lookup results didn't match the library")
+        return 1
+    implausibleWrites = stages["tagging"]["implausibleWrites"]
+    if implausibleWrites:
+        print(
+            f"FAIL: {len(implausibleWrites)} in-place writes counted less than the cover "
+            "or more than the track"
+        )
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+
+# Cold-start budget for the "track already has art" path of album-art-script.py
+# Runs the script in fresh interpreters on an MP3 that already has a cover in it,
+# fails if the median wall time is over budget or if any heavy module got imported on the way
+# Usage: python benchmarks/startup.py [--budget-ms 150] [--runs 10]
+
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+import tempfile
+from os.path import abspath, dirname, join
+from time import perf_counter
+
+SCRIPT = join(dirname(dirname(abspath(__file__))), "album-art-script.py")
+
+# None of these should be needed to find out that a track already has art
+HEAVY_MODULES = [
+    "tkinter",
+    "PIL",
+    "mutagen",
+    "sqlite3",
+    "multiprocessing",
+    "concurrent.futures.process",
+    "http.client",
+]
+DEFAULT_BUDGET_MS = 150
+DEFAULT_RUNS = 10
+
+# Runs the script like the shell would, then prints which of the heavy modules it has pulled in
+MODULE_PROBE = """
+import json, os, runpy, sys
+sys.argv = [{script!r}, {track!r}]
+sys.path.insert(0, os.path.dirname({script!r}))
+try:
+    runpy.run_path({script!r}, run_name="__main__")
+except SystemExit:
+    pass
+print(json.dumps([m for m in {heavy!r} if m in sys.modules]))
+"""
+
+
+def syncsafe(size):
+    return bytes(
+        [(size >> 21) & 0x7F, (size >> 14) & 0x7F, (size >> 7) & 0x7F, size & 0x7F]
+    )
+
+
+def writeTrackWithArt(path):
+    # Hand-rolled ID3v2.4 tag with a single APIC frame, followed by a few silent MPEG frames,
+    # so the benchmark itself doesn't need mutagen
+    apicBody = b"\x03image/jpeg\x00\x03Cover\x00" + b"\xff\xd8" + b"\x00" * 64 * 1024
+    apicFrame = b"APIC" + syncsafe(len(apicBody)) + b"\x00\x00" + apicBody
+    tag = b"ID3\x04\x00\x00" + syncsafe(len(apicFrame)) + apicFrame
+    mpegFrame = b"\xff\xfb\x90\x64" + b"\x00" * 413
+    with open(path, "wb") as f:
+        f.write(tag + mpegFrame * 40)
+
+
+def timeRuns(trackPath, runs, cwd):
+    timings = []
+    for _ in range(runs):
+        start = perf_counter()
+        subprocess.run(
+            [sys.executable, SCRIPT, trackPath],
+            cwd=cwd,
+            check=True,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+        timings.append((perf_counter() - start) * 1000)
+    return timings
+
+
+def heavyModulesImported(trackPath, cwd):
+    probe = MODULE_PROBE.format(script=SCRIPT, track=trackPath, heavy=HEAVY_MODULES)
+    result = subprocess.run(
+        [sys.executable, "-c", probe],
+        cwd=cwd,
+        check=True,
+        capture_output=True,
+        text=True,
+    )
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def main():
+    argparser = argparse.ArgumentParser()
+    argparser.add_argument("--budget-ms", type=float, default=DEFAULT_BUDGET_MS)
+    argparser.add_argument("--runs", type=int, default=DEFAULT_RUNS)
+    args = argparser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmpDir:
+        trackPath = join(tmpDir, "track.mp3")
+        writeTrackWithArt(trackPath)
+
+        # Bare interpreter startup, to see how much of the time is actually ours
+        baseline = []
+        for _ in range(args.runs):
+            start = perf_counter()
+            subprocess.run([sys.executable, "-c", "pass"], check=True)
+            baseline.append((perf_counter() - start) * 1000)
+
+        timings = timeRuns(trackPath, args.runs, tmpDir)
+        heavy = heavyModulesImported(trackPath, tmpDir)
+
+    median = statistics.median(timings)
+    report = {
+        "runs": args.runs,
+        "budgetMs": args.budget_ms,
+        "medianMs": round(median, 2),
+        "minMs": round(min(timings), 2),
+        "maxMs": round(max(timings), 2),
+        "interpreterMedianMs": round(statistics.median(baseline), 2),
+        "heavyModulesImported": heavy,
+    }
+    print(json.dumps(report, indent=2))
+
+    failed = False
+    if median > args.budget_ms:
+        print(f"FAIL: median {median:.1f} ms is over the {args.budget_ms} ms budget")
+        failed = True
+    if heavy:
+        print(f"FAIL: heavy modules imported on the already-has-art path: {heavy}")
+        failed = True
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
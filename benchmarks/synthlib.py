@@ -0,0 +1,226 @@
+#!/usr/bin/env python3
+
+# Reproducible synthetic music library for the benchmarks
+# Every album gets MP3, Ogg Vorbis and FLAC tracks, some with a cover already embedded and some without,
+# and a cover file of one of the kinds/sizes below under one of the mixed-case common names
+# The same seed and settings always give byte-identical files, a manifest.json describes what was made
+# Usage: python benchmarks/synthlib.py path/to/library [--seed 1] [--cover-sizes-kb 100,1000,10000,50000]
+
+import argparse
+import json
+import struct
+import sys
+from io import BytesIO
+from os import makedirs
+from os.path import join
+from random import Random
+
+DEFAULT_SEED = 1
+DEFAULT_COVER_SIZES_KB = [100, 1000, 10000, 50000]
+DEFAULT_TRACKS_PER_FORMAT = 2
+DEFAULT_TRACK_KB = 256
+COVER_KINDS = ["jpeg", "png", "rgba-png"]
+# Mixed case on purpose, the lookup has to find all of these
+COVER_NAMES = {
+    "jpeg": ["Folder.JPG", "cover.jpg", "AlbumArt.Jpeg"],
+    "png": ["cover.png", "Folder.PNG", "COVER.Png"],
+    "rgba-png": ["folder.png", "Cover.PNG", "albumart.png"],
+}
+# Roughly what noise compresses to, the sizes only have to be in the right ballpark
+BYTES_PER_PIXEL = {"jpeg": 1.2, "png": 3.0, "rgba-png": 4.0}
+EMBEDDED_COVER_PX = 300
+
+MPEG_FRAME = b"\xff\xfb\x90\x64" + b"\x00" * 413
+
+
+def noiseImage(rng, mode, size):
+    from PIL import Image
+
+    channels = len(mode)
+    return Image.frombytes(mode, size, rng.randbytes(size[0] * size[1] * channels))
+
+
+def makeCover(rng, kind, sizeKb):
+    side = max(16, int((sizeKb * 1024 / BYTES_PER_PIXEL[kind]) ** 0.5))
+    output = BytesIO()
+    if kind == "jpeg":
+        noiseImage(rng, "RGB", (side, side)).save(output, "JPEG", quality=95)
+    elif kind == "png":
+        noiseImage(rng, "RGB", (side, side)).save(output, "PNG", compress_level=1)
+    else:
+        noiseImage(rng, "RGBA", (side, side)).save(output, "PNG", compress_level=1)
+    return output.getvalue()
+
+
+def makeEmbeddedCover(rng):
+    output = BytesIO()
+    noiseImage(rng, "RGB", (EMBEDDED_COVER_PX, EMBEDDED_COVER_PX)).save(
+        output, "JPEG", quality=85
+    )
+    return output.getvalue()
+
+
+def writeMP3(path, trackKb, rng):
+    # Silent frames behind some noise, so the audio doesn't compress away on any filesystem
+    frameCount = max(1, trackKb * 1024 // len(MPEG_FRAME))
+    with open(path, "wb") as f:
+        for _ in range(frameCount):
+            f.write(MPEG_FRAME[:4] + rng.randbytes(len(MPEG_FRAME) - 4))
+
+
+def writeOGG(path, trackKb, rng):
+    from mutagen.ogg import OggPage
+
+    ident = (
+        b"\x01vorbis" + struct.pack("<IBIiii", 0, 2, 44100, 0, 128000, 0) + b"\xb8\x01"
+    )
+    vendor = b"synthlib"
+    comment = b"\x03vorbis" + struct.pack("<I", len(vendor)) + vendor
+    comment += struct.pack("<I", 0) + b"\x01"
+    setup = b"\x05vorbis" + b"\x00" * 30
+
+    pages = []
+    page = OggPage()
+    page.packets, page.serial, page.sequence, page.first = [ident], 1, 0, True
+    pages.append(page)
+    page = OggPage()
+    page.packets, page.serial, page.sequence = [comment, setup], 1, 1
+    pages.append(page)
+    audioPackets = max(1, trackKb // 4)
+    for i in range(audioPackets):
+        page = OggPage()
+        page.packets = [rng.randbytes(4096)]
+        page.serial, page.sequence, page.position = 1, 2 + i, (i + 1) * 4096
+        pages.append(page)
+    pages[-1].last = True
+    with open(path, "wb") as f:
+        for page in pages:
+            f.write(page.write())
+
+
+def writeFLAC(path, trackKb, rng):
+    # Just STREAMINFO (4096 sample blocks, 44.1k stereo 16 bit), then noise standing in for frames
+    streamInfo = struct.pack(">HH", 4096, 4096) + b"\x00" * 6
+    streamInfo += bytes([0x0A, 0xC4, 0x42, 0xF0]) + b"\x00" * 4 + b"\x00" * 16
+    with open(path, "wb") as f:
+        f.write(b"fLaC" + bytes([0x80]) + struct.pack(">I", 34)[1:] + streamInfo)
+        f.write(b"\xff\xf8" + rng.randbytes(trackKb * 1024))
+
+
+def embedCover(path, trackExt, coverData):
+    # Tracks that "already have art", tagged the way other taggers would
+    if trackExt == "mp3":
+        from mutagen.id3 import ID3, APIC
+
+        tags = ID3()
+        tags.add(APIC(encoding=3, mime="image/jpeg", type=3, desc="", data=coverData))
+        tags.save(path)
+        return
+    from mutagen.flac import Picture
+
+    picture = Picture()
+    picture.type, picture.mime, picture.data = 3, "image/jpeg", coverData
+    if trackExt == "ogg":
+        import base64
+        from mutagen.oggvorbis import OggVorbis
+
+        songFile = OggVorbis(path)
+        songFile["metadata_block_picture"] = [
+            base64.b64encode(picture.write()).decode("ascii")
+        ]
+        songFile.save()
+    else:
+        from mutagen.flac import FLAC
+
+        songFile = FLAC(path)
+        songFile.add_picture(picture)
+        songFile.save()
+
+
+TRACK_WRITERS = {"mp3": writeMP3, "ogg": writeOGG, "flac": writeFLAC}
+
+
+def generateLibrary(
+    root,
+    seed=DEFAULT_SEED,
+    coverSizesKb=DEFAULT_COVER_SIZES_KB,
+    tracksPerFormat=DEFAULT_TRACKS_PER_FORMAT,
+    trackKb=DEFAULT_TRACK_KB,
+):
+    # One album per cover kind and size, plus one album without any cover file
+    # Returns the manifest, which is also saved as root/manifest.json
+    rng = Random(seed)
+    embeddedCover = makeEmbeddedCover(rng)
+    manifest = {
+        "seed": seed,
+        "coverSizesKb": coverSizesKb,
+        "tracksPerFormat": tracksPerFormat,
+        "trackKb": trackKb,
+        "albums": [],
+    }
+
+    albumSpecs = [(kind, sizeKb) for kind in COVER_KINDS for sizeKb in coverSizesKb] + [
+        (None, None)
+    ]
+    for albumIndex, (kind, sizeKb) in enumerate(albumSpecs):
+        albumDir = join(root, f"album{albumIndex:03}")
+        makedirs(albumDir, exist_ok=True)
+        album = {"dir": albumDir, "cover": None, "coverKind": kind, "tracks": []}
+
+        if kind is not None:
+            names = COVER_NAMES[kind]
+            coverPath = join(albumDir, names[albumIndex % len(names)])
+            coverData = makeCover(rng, kind, sizeKb)
+            with open(coverPath, "wb") as coverFile:
+                coverFile.write(coverData)
+            album.update(cover=coverPath, coverBytes=len(coverData))
+
+        for trackExt, writeTrack in TRACK_WRITERS.items():
+            for trackIndex in range(tracksPerFormat):
+                trackPath = join(albumDir, f"{trackIndex:02}.{trackExt}")
+                writeTrack(trackPath, trackKb, rng)
+                # Every other track already has art in it
+                hasArt = trackIndex % 2 == 1
+                if hasArt:
+                    embedCover(trackPath, trackExt, embeddedCover)
+                album["tracks"].append(
+                    {"path": trackPath, "format": trackExt, "hasArt": hasArt}
+                )
+        manifest["albums"].append(album)
+
+    with open(join(root, "manifest.json"), "w") as manifestFile:
+        json.dump(manifest, manifestFile, indent=2)
+    return manifest
+
+
+def parseSizes(value):
+    return [int(size) for size in value.split(",") if size]
+
+
+def main():
+    argparser = argparse.ArgumentParser()
+    argparser.add_argument("root")
+    argparser.add_argument("--seed", type=int, default=DEFAULT_SEED)
+    argparser.add_argument(
+        "--cover-sizes-kb", type=parseSizes, default=DEFAULT_COVER_SIZES_KB
+    )
+    argparser.add_argument(
+        "--tracks-per-format", type=int, default=DEFAULT_TRACKS_PER_FORMAT
+    )
+    argparser.add_argument("--track-kb", type=int, default=DEFAULT_TRACK_KB)
+    args = argparser.parse_args()
+
+    manifest = generateLibrary(
+        args.root,
+        args.seed,
+        args.cover_sizes_kb,
+        args.tracks_per_format,
+        args.track_kb,
+    )
+    trackCount = sum(len(album["tracks"]) for album in manifest["albums"])
+    print(f"{len(manifest['albums'])} albums, {trackCount} tracks in {args.root}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
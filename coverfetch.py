@@ -0,0 +1,425 @@
+#!/usr/bin/env python3
+
+# Looking covers up online for the albums that don't have one, see --fetch-covers in album-art-script.py
+# Albums are looked up by their artist and album tags, a few at a time, through one set of keep-alive
+# connections that keeps to a request rate per host
+# Every answer (the cover, or that there isn't one) goes into an on-disk cache, so an album is only
+# ever asked about once, not once per run
+# Sources are pluggable, see CoverSource and registerCoverSource(); the built-in ones can be pointed at
+# another server with baseUrl, a mirror or a local stub for testing
+# Standard library only, nothing extra to install for it; http.client is imported where it's used,
+# runs that don't fetch anything don't pay for it
+
+import json
+import threading
+from hashlib import sha1
+from os import environ, makedirs
+from os.path import exists as fileExists
+from os.path import expanduser, join
+from time import monotonic, sleep, time
+from urllib.parse import urlencode, urljoin, urlsplit
+
+from covermap import writeReplacing
+from logger import applogger
+from metrics import metrics
+
+DEFAULT_FETCH_JOBS = 4
+# Requests per second, for hosts the source doesn't say anything about
+DEFAULT_HOST_RATE = 4.0
+DEFAULT_TIMEOUT = 15.0
+# MusicBrainz asks for an application name, version and contact in the User-Agent
+DEFAULT_USER_AGENT = "album-art-script/0.1 ( python http.client )"
+MAX_IDLE_CONNECTIONS_PER_HOST = 4
+MAX_REDIRECTS = 5
+# For 429/503, and for keep-alive connections the server has dropped in the meantime
+MAX_RETRIES = 2
+DEFAULT_RETRY_DELAY = 2.0
+MAX_RETRY_DELAY = 30.0
+MAX_API_RESPONSE_BYTES = 2 * 1024 * 1024
+MAX_IMAGE_BYTES = 20 * 1024 * 1024
+# Albums nothing was found for are asked about again after this, covers get added to the databases
+NOT_FOUND_TTL_DAYS = 30
+REDIRECT_STATUSES = (301, 302, 303, 307, 308)
+RETRY_STATUSES = (429, 503)
+
+
+def defaultCacheDir():
+    cacheHome = environ.get("XDG_CACHE_HOME") or expanduser(join("~", ".cache"))
+    return join(cacheHome, "album-art-script", "fetched-covers")
+
+
+class FetchError(Exception):
+    pass
+
+
+class RateLimiter:
+    # Requests to one host are spaced 1/rate seconds apart, over all the fetching threads
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate > 0 else 0.0
+        self.nextSlot = 0.0
+        self.lock = threading.Lock()
+
+    def wait(self):
+        with self.lock:
+            now = monotonic()
+            slot = max(now, self.nextSlot)
+            self.nextSlot = slot + self.interval
+        # Slept outside the lock, the next thread already knows its own slot
+        sleep(max(0.0, slot - now))
+
+    def backOff(self, seconds):
+        with self.lock:
+            self.nextSlot = max(self.nextSlot, monotonic() + seconds)
+
+
+def retryDelay(retryAfter):
+    try:
+        return min(max(0.0, float(retryAfter)), MAX_RETRY_DELAY)
+    except (TypeError, ValueError):
+        # Missing, or an HTTP date, which isn't worth parsing for this
+        return DEFAULT_RETRY_DELAY
+
+
+class HttpSession:
+    # GETs over keep-alive connections, idle ones are kept per (scheme, host, port) for the next request
+    # Thread-safe, all the fetching threads share one
+    def __init__(self, userAgent=DEFAULT_USER_AGENT, hostRates=None, rate=None):
+        self.userAgent = userAgent
+        self.hostRates = hostRates or {}
+        # Overrides hostRates for every host
+        self.rate = rate
+        self.idle = {}
+        self.limiters = {}
+        self.lock = threading.Lock()
+
+    def limiterFor(self, host):
+        with self.lock:
+            if host not in self.limiters:
+                rate = self.rate or self.hostRates.get(host, DEFAULT_HOST_RATE)
+                self.limiters[host] = RateLimiter(rate)
+            return self.limiters[host]
+
+    def connect(self, poolKey):
+        # Returns (connection, reused)
+        with self.lock:
+            idle = self.idle.get(poolKey)
+            if idle:
+                return idle.pop(), True
+        import http.client
+
+        scheme, host, port = poolKey
+        metrics.count("fetch.connections")
+        if scheme == "https":
+            return (
+                http.client.HTTPSConnection(host, port, timeout=DEFAULT_TIMEOUT),
+                False,
+            )
+        return http.client.HTTPConnection(host, port, timeout=DEFAULT_TIMEOUT), False
+
+    def release(self, poolKey, connection):
+        with self.lock:
+            idle = self.idle.setdefault(poolKey, [])
+            if len(idle) < MAX_IDLE_CONNECTIONS_PER_HOST:
+                idle.append(connection)
+                return
+        connection.close()
+
+    def get(self, url, maxBytes, accept="*/*"):
+        # Returns (status, body), redirects are followed
+        for _ in range(MAX_REDIRECTS + 1):
+            status, location, body = self.send(url, maxBytes, accept)
+            if status in REDIRECT_STATUSES and location:
+                url = urljoin(url, location)
+                continue
+            return status, body
+        raise FetchError(f"Too many redirects, last one to {url}")
+
+    def send(self, url, maxBytes, accept):
+        import http.client
+
+        parts = urlsplit(url)
+        if parts.scheme not in ("http", "https") or not parts.hostname:
+            raise FetchError(f"Can't fetch {url}")
+        poolKey = (parts.scheme, parts.hostname, parts.port)
+        path = (parts.path or "/") + (f"?{parts.query}" if parts.query else "")
+        headers = {"User-Agent": self.userAgent, "Accept": accept}
+        limiter = self.limiterFor(parts.hostname)
+
+        for attempt in range(MAX_RETRIES + 1):
+            limiter.wait()
+            connection, reused = self.connect(poolKey)
+            try:
+                connection.request("GET", path, headers=headers)
+                response = connection.getresponse()
+                body = response.read(maxBytes + 1)
+            except (http.client.HTTPException, OSError) as e:
+                connection.close()
+                if reused and attempt < MAX_RETRIES:
+                    # The server closed it while it was idle
+                    continue
+                raise FetchError(f"GET {url} failed: {e}") from e
+            metrics.count("fetch.requests")
+            if len(body) > maxBytes:
+                connection.close()
+                raise FetchError(f"{url} is over {maxBytes} bytes")
+            # Only a connection with the whole response read off it can be used again
+            if response.isclosed() and not response.will_close:
+                self.release(poolKey, connection)
+            else:
+                connection.close()
+
+            if response.status in RETRY_STATUSES and attempt < MAX_RETRIES:
+                delay = retryDelay(response.getheader("Retry-After"))
+                applogger.debug(
+                    "%s answered %s, trying again in %ss", url, response.status, delay
+                )
+                limiter.backOff(delay)
+                continue
+            return response.status, response.getheader("Location"), body
+        raise FetchError(f"GET {url} failed {MAX_RETRIES + 1} times")
+
+    def getJSON(self, url):
+        status, body = self.get(url, MAX_API_RESPONSE_BYTES, "application/json")
+        if status != 200:
+            raise FetchError(f"{url} answered {status}")
+        try:
+            return json.loads(body)
+        except ValueError as e:
+            raise FetchError(f"{url} didn't answer with JSON: {e}") from e
+
+    def close(self):
+        with self.lock:
+            connections = [
+                connection for idle in self.idle.values() for connection in idle
+            ]
+            self.idle = {}
+        for connection in connections:
+            connection.close()
+
+
+def normalizeName(name):
+    # For cache keys and for matching search results: case, punctuation and spacing don't count
+    return " ".join(
+        "".join(char if char.isalnum() else " " for char in name.casefold()).split()
+    )
+
+
+def queryKey(artist, album):
+    return f"{normalizeName(artist)}\0{normalizeName(album)}"
+
+
+def imageExtension(data):
+    if data[:3] == b"\xff\xd8\xff":
+        return "jpg"
+    if data[:8] == b"\x89PNG\r\n\x1a\n":
+        return "png"
+    return None
+
+
+class CoverSource:
+    # Somewhere to look covers up; subclasses set name and defaultBaseUrl and implement
+    # findImageUrls(session, artist, album), which returns image URLs, best match first
+    # baseRate is the most requests per second the base URL's host wants to see
+    name = None
+    defaultBaseUrl = None
+    baseRate = DEFAULT_HOST_RATE
+
+    def __init__(self, baseUrl=None):
+        self.baseUrl = (baseUrl or self.defaultBaseUrl).rstrip("/")
+        self.hostRates = {urlsplit(self.baseUrl).hostname: self.baseRate}
+
+    def findImageUrls(self, session, artist, album):
+        raise NotImplementedError
+
+
+def luceneQuote(value):
+    return '"' + value.replace("\\", "\\\\").replace('"', '\\"') + '"'
+
+
+class MusicBrainzSource(CoverSource):
+    # Release groups are searched on MusicBrainz, their front covers come from the Cover Art Archive
+    # With a baseUrl both are asked there
+    name = "musicbrainz"
+    defaultBaseUrl = "https://musicbrainz.org"
+    defaultArtUrl = "https://coverartarchive.org"
+    baseRate = 1.0  # MusicBrainz's own rule, more than that gets 503s
+    minScore = 90
+    imageSize = 500
+
+    def __init__(self, baseUrl=None):
+        super().__init__(baseUrl)
+        self.artUrl = (baseUrl or self.defaultArtUrl).rstrip("/")
+
+    def findImageUrls(self, session, artist, album):
+        query = f"releasegroup:{luceneQuote(album)} AND artist:{luceneQuote(artist)}"
+        answer = session.getJSON(
+            f"{self.baseUrl}/ws/2/release-group/?"
+            + urlencode({"query": query, "fmt": "json", "limit": 5})
+        )
+        return [
+            f"{self.artUrl}/release-group/{releaseGroup['id']}/front-{self.imageSize}"
+            for releaseGroup in answer.get("release-groups", [])
+            if releaseGroup.get("score", 0) >= self.minScore and "id" in releaseGroup
+        ]
+
+
+class ITunesSource(CoverSource):
+    name = "itunes"
+    defaultBaseUrl = "https://itunes.apple.com"
+    baseRate = 0.3  # roughly the 20 a minute it's documented to allow
+    imageSize = 600
+
+    def findImageUrls(self, session, artist, album):
+        answer = session.getJSON(
+            f"{self.baseUrl}/search?"
+            + urlencode({"term": f"{artist} {album}", "entity": "album", "limit": 10})
+        )
+        wantedArtist, wantedAlbum = normalizeName(artist), normalizeName(album)
+        imageUrls = []
+        for result in answer.get("results", []):
+            artworkUrl = result.get("artworkUrl100")
+            # "Album (Deluxe Edition)" and "Album - EP" still count
+            if (
+                artworkUrl
+                and normalizeName(result.get("artistName", "")) == wantedArtist
+                and normalizeName(result.get("collectionName", "")).startswith(
+                    wantedAlbum
+                )
+            ):
+                imageUrls.append(
+                    artworkUrl.replace(
+                        "100x100bb", f"{self.imageSize}x{self.imageSize}bb"
+                    )
+                )
+        return imageUrls
+
+
+COVER_SOURCES = {source.name: source for source in (MusicBrainzSource, ITunesSource)}
+
+
+def registerCoverSource(sourceClass):
+    # For sources of your own, before the command line is parsed (or with albumart.options())
+    COVER_SOURCES[sourceClass.name] = sourceClass
+
+
+class FetchCache:
+    # One entry per (source, artist, album): <key>.json, and <key>.jpg/png if a cover was found
+    # The image is written first, so an entry is never there without its cover
+    def __init__(self, cacheDir):
+        self.cacheDir = cacheDir
+        makedirs(cacheDir, exist_ok=True)
+
+    def key(self, sourceName, artist, album):
+        return sha1(f"{sourceName}\0{queryKey(artist, album)}".encode()).hexdigest()
+
+    def entryPath(self, key, ext):
+        # Same two-level fanout as the resize cache
+        return join(self.cacheDir, key[:2], f"{key}.{ext}")
+
+    def get(self, key):
+        # Returns (known, cover path or None)
+        try:
+            with open(self.entryPath(key, "json")) as entryFile:
+                entry = json.load(entryFile)
+        except (OSError, ValueError):
+            return False, None
+        if not isinstance(entry, dict):
+            return False, None
+        if entry.get("ext") is None:
+            if time() - entry.get("time", 0) > NOT_FOUND_TTL_DAYS * 24 * 3600:
+                return False, None
+            return True, None
+        coverPath = self.entryPath(key, entry["ext"])
+        if not fileExists(coverPath):
+            return False, None
+        return True, coverPath
+
+    def put(self, key, entry, data=None):
+        makedirs(join(self.cacheDir, key[:2]), exist_ok=True)
+        coverPath = None
+        if data is not None:
+            coverPath = self.entryPath(key, entry["ext"])
+            writeReplacing(coverPath, data)
+        writeReplacing(
+            self.entryPath(key, "json"),
+            json.dumps(dict(entry, time=time())).encode(),
+        )
+        return coverPath
+
+
+class CoverFetcher:
+    def __init__(
+        self,
+        source,
+        cacheDir=None,
+        jobs=DEFAULT_FETCH_JOBS,
+        rate=None,
+        userAgent=DEFAULT_USER_AGENT,
+    ):
+        self.source = source
+        self.cache = FetchCache(cacheDir or defaultCacheDir())
+        self.jobs = jobs
+        self.session = HttpSession(userAgent, source.hostRates, rate)
+
+    def findImageUrls(self, artist, album):
+        # Answers that aren't shaped the way the source expects (a list where a dict should be,
+        # a missing key, a score that isn't a number) count as failed lookups like any other
+        try:
+            return list(self.source.findImageUrls(self.session, artist, album))
+        except FetchError:
+            raise
+        except (AttributeError, KeyError, IndexError, TypeError, ValueError) as e:
+            raise FetchError(f"Unexpected answer from {self.source.name}: {e!r}") from e
+
+    def fetch(self, artist, album):
+        # Returns the cached cover's path, or None if there isn't one to be had
+        key = self.cache.key(self.source.name, artist, album)
+        known, coverPath = self.cache.get(key)
+        if known:
+            metrics.count("fetch.cacheHits")
+            applogger.debug("Cached answer for %s - %s: %s", artist, album, coverPath)
+            return coverPath
+
+        entry = {"source": self.source.name, "artist": artist, "album": album}
+        try:
+            with metrics.stage("fetch"):
+                for imageUrl in self.findImageUrls(artist, album):
+                    status, data = self.session.get(
+                        imageUrl, MAX_IMAGE_BYTES, "image/jpeg, image/png"
+                    )
+                    if status == 404:
+                        continue
+                    if status != 200:
+                        raise FetchError(f"{imageUrl} answered {status}")
+                    ext = imageExtension(data)
+                    if ext is None:
+                        applogger.debug("%s isn't a JPEG or PNG, skipping it", imageUrl)
+                        continue
+                    metrics.count("io.fetchedBytes", len(data))
+                    applogger.info(f"Fetched the cover for {artist} - {album}")
+                    return self.cache.put(key, dict(entry, url=imageUrl, ext=ext), data)
+            applogger.info(f"No cover for {artist} - {album} on {self.source.name}")
+            self.cache.put(key, dict(entry, ext=None))
+        except (FetchError, OSError) as e:
+            # Nothing's cached, it may well work next time
+            metrics.count("fetch.failures")
+            applogger.error(f"Couldn't fetch the cover for {artist} - {album}: {e}")
+        return None
+
+    def fetchAll(self, queries):
+        # queries is {anything: (artist, album)}, returns {the same: cover path or None}
+        # Albums asked for more than once (CD1/CD2 dirs and such) are only looked up once
+        from concurrent.futures import ThreadPoolExecutor
+
+        unique = {
+            queryKey(artist, album): (artist, album)
+            for artist, album in queries.values()
+        }
+        with ThreadPoolExecutor(max_workers=self.jobs) as pool:
+            results = dict(
+                zip(unique, pool.map(lambda query: self.fetch(*query), unique.values()))
+            )
+        return {name: results[queryKey(*query)] for name, query in queries.items()}
+
+    def close(self):
+        self.session.close()
@@ -0,0 +1,42 @@
+#!/usr/bin/env python3
+
+# Cover bytes for embedding, mapped read-only from the cover file instead of read into memory
+# Mapped pages are the page cache's, so every worker process tagging with the same cover shares one
+# copy of it, and under memory pressure the kernel drops them instead of swapping them out
+# mutagen takes a mapping wherever bytes-like data will do (FLAC/Ogg pictures), ID3 frames want bytes
+# A mapped file that's truncated under the mapping kills the process with SIGBUS on the next access,
+# so covers this script writes go through writeReplacing(): a new file renamed over the old one
+
+import mmap
+from os import fstat, getpid, replace, unlink
+from shutil import copy as copyFile
+
+# Smaller covers aren't worth a mapping
+COVER_MAP_MIN_BYTES = 1024 * 1024
+
+
+def loadCover(imagePath):
+    # Returns (data, mapped), data being bytes or a read-only mmap
+    with open(imagePath, "rb") as imageFile:
+        if fstat(imageFile.fileno()).st_size < COVER_MAP_MIN_BYTES:
+            return imageFile.read(), False
+        # The mapping stays valid once the file is closed
+        return mmap.mmap(imageFile.fileno(), 0, access=mmap.ACCESS_READ), True
+
+
+def writeReplacing(targetPath, data=None, sourcePath=None):
+    # Writes data (or a copy of sourcePath) to targetPath without ever rewriting the old file in place
+    tmpPath = f"{targetPath}.{getpid()}.tmp"
+    try:
+        if sourcePath is not None:
+            copyFile(sourcePath, tmpPath)
+        else:
+            with open(tmpPath, "wb") as tmpFile:
+                tmpFile.write(data)
+        replace(tmpPath, targetPath)
+    except BaseException:
+        try:
+            unlink(tmpPath)
+        except OSError:
+            pass
+        raise
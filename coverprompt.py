@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+
+# Asking the user for the covers that couldn't be found automatically, see album-art-script.py
+# Batch runs don't stop for this: albums without a cover are collected while everything else
+# is tagged, and each one is asked about once at the end
+# The file dialog is used where there's a display, the terminal where there isn't
+
+import sys
+from os.path import expanduser, isfile, join
+
+from logger import applogger
+
+
+class CoverPrompter:
+    def __init__(self, tkRoot=None):
+        # One hidden root window for all the dialogs, not a new one per album
+        self.tkRoot = tkRoot
+
+    def ask(self, albumDir, trackCount):
+        # Returns the chosen file, or None if the album was skipped
+        if self.tkRoot is not None:
+            return self.askWithDialog(albumDir, trackCount)
+        return self.askInTerminal(albumDir, trackCount)
+
+    def askWithDialog(self, albumDir, trackCount):
+        from tkinter import filedialog as tkFileDialog
+
+        imagePath = tkFileDialog.askopenfilename(
+            parent=self.tkRoot,
+            initialdir=albumDir,
+            title=f"Cover for {albumDir} ({trackCount} tracks)",
+        )
+        applogger.debug("Got %s from the user.", imagePath)
+        # askopenfilename returns either () or "" if the dialog was cancelled
+        return imagePath or None
+
+    def askInTerminal(self, albumDir, trackCount):
+        while True:
+            try:
+                answer = input(
+                    f"Cover for {albumDir} ({trackCount} tracks), path or nothing to skip: "
+                ).strip()
+            except EOFError:
+                return None
+            if not answer:
+                return None
+            # Relative paths are relative to the album dir, it's what the dialog starts in too
+            imagePath = join(albumDir, expanduser(answer))
+            if isfile(imagePath):
+                return imagePath
+            applogger.error(f"{imagePath} doesn't exist, try again")
+
+    def close(self):
+        if self.tkRoot is not None:
+            self.tkRoot.destroy()
+            self.tkRoot = None
+
+
+def openPrompter():
+    # Returns None if there's no way to ask: no display for the dialog and no terminal either
+    try:
+        import tkinter as tk
+    except ImportError:
+        tk = None
+    if tk is not None:
+        try:
+            tkRoot = tk.Tk()
+            tkRoot.withdraw()
+            return CoverPrompter(tkRoot)
+        except tk.TclError as e:
+            applogger.debug("Couldn't open the file dialog: %s", e)
+    if sys.stdin.isatty():
+        return CoverPrompter()
+    return None
+
+
+def writeUnresolved(albums, outputPath):
+    # One track per line, same as --list-artless, so it can be fed to whatever comes next
+    with open(outputPath, "w") as outputFile:
+        for songPaths in albums.values():
+            for songPath in songPaths:
+                outputFile.write(f"{songPath}\n")
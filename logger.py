@@ -1,6 +1,7 @@
 #!/usr/bin/env python3
 
 import sys
+import atexit
 import logging
 
 
@@ -12,18 +13,20 @@ class TerminalLoggingFormatter(logging.Formatter):
     reset = "\x1b[0m"
     format = "%(name)s - %(levelname)s - %(message)s (%(filename)s:%(lineno)d)"
 
-    FORMATS = {
-        logging.DEBUG: grey + format + reset,
-        logging.INFO: grey + format + reset,
-        logging.WARNING: yellow + format + reset,
-        logging.ERROR: red + format + reset,
-        logging.CRITICAL: bold_red + format + reset,
+    # Built once here, not for every record
+    FORMATTERS = {
+        logging.DEBUG: logging.Formatter(grey + format + reset),
+        logging.INFO: logging.Formatter(grey + format + reset),
+        logging.WARNING: logging.Formatter(yellow + format + reset),
+        logging.ERROR: logging.Formatter(red + format + reset),
+        logging.CRITICAL: logging.Formatter(bold_red + format + reset),
     }
+    DEFAULT_FORMATTER = logging.Formatter(format)
 
     def format(self, record):
-        log_fmt = self.FORMATS.get(record.levelno)
-        formatter = logging.Formatter(log_fmt)
-        return formatter.format(record)
+        return self.FORMATTERS.get(record.levelno, self.DEFAULT_FORMATTER).format(
+            record
+        )
 
 
 class FileLoggingFormatter(logging.Formatter):
@@ -34,30 +37,87 @@ class FileLoggingFormatter(logging.Formatter):
     reset = "\x1b[0m"
     format = "%(name)s - %(levelname)s - %(message)s (%(filename)s:%(lineno)d)"
 
-    FORMATS = {
-        logging.DEBUG: format,
-        logging.INFO: format,
-        logging.WARNING: format,
-        logging.ERROR: format,
-        logging.CRITICAL: format,
-    }
+    # Same format for every level, no colors in the file
+    FORMATTER = logging.Formatter(format)
 
     def format(self, record):
-        log_fmt = self.FORMATS.get(record.levelno)
-        formatter = logging.Formatter(log_fmt)
-        return formatter.format(record)
+        return self.FORMATTER.format(record)
+
+
+class RecordCollectingHandler(logging.Handler):
+    # Keeps the records instead of emitting them, used by worker processes to
+    # send their logs back to the parent, which then logs them in order
+    def __init__(self):
+        super().__init__()
+        self.records = []
+
+    def emit(self, record):
+        # Same as QueueHandler.prepare(): bake the message and traceback in, so the record can be pickled
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        self.records.append(record)
 
+    def takeRecords(self):
+        records, self.records = self.records, []
+        return records
+
+
+LOG_FILE_NAME = "album-art-script.log"
+DEFAULT_TERMINAL_LEVEL = logging.WARNING
+DEFAULT_FILE_LEVEL = logging.DEBUG
 
 applogger = logging.getLogger("album-art-script")
-applogger.setLevel(logging.DEBUG)
+applogger.setLevel(DEFAULT_TERMINAL_LEVEL)
+# Only hooked up by setupLogging(), importing the modules (see albumart.py) leaves logging
+# and sys.excepthook to whoever's importing them
 ch = logging.StreamHandler()
 ch.setLevel(logging.DEBUG)
 ch.setFormatter(TerminalLoggingFormatter())
-fh = logging.FileHandler("album-art-script.log")
-fh.setLevel(logging.DEBUG)
-fh.setFormatter(FileLoggingFormatter())
-applogger.addHandler(ch)
-applogger.addHandler(fh)
+
+# See setupFileLogging()
+fileListener = None
+
+
+def setupFileLogging(fileLevel=DEFAULT_FILE_LEVEL, fileName=LOG_FILE_NAME):
+    # The logging call only puts the record on a queue, formatting and writing
+    # to the file is done by the QueueListener's thread, off the hot path
+    global fileListener
+    if fileListener is not None:
+        return
+    # Imported here, logging.handlers pulls in a lot that runs without a log file don't need
+    from logging.handlers import QueueHandler, QueueListener
+    from queue import SimpleQueue
+
+    # delay=True: the log file is only opened once something is actually written to it
+    fh = logging.FileHandler(fileName, delay=True)
+    fh.setLevel(fileLevel)
+    fh.setFormatter(FileLoggingFormatter())
+    logQueue = SimpleQueue()
+    qh = QueueHandler(logQueue)
+    qh.setLevel(fileLevel)
+    fileListener = QueueListener(logQueue, fh, respect_handler_level=True)
+    fileListener.start()
+    applogger.addHandler(qh)
+    # Flushes whatever is still queued up when the script exits
+    atexit.register(fileListener.stop)
+
+
+def setupLogging(terminalLevel=DEFAULT_TERMINAL_LEVEL, fileLevel=None):
+    # fileLevel=None means no log file at all
+    # The logger itself is set to the lowest level anything wants, so that e.g. debug messages
+    # aren't even formatted if neither the terminal nor the file is going to show them
+    if ch not in applogger.handlers:
+        applogger.addHandler(ch)
+        sys.excepthook = logUnhandledException
+    ch.setLevel(terminalLevel)
+    loggerLevel = terminalLevel
+    if fileLevel is not None:
+        setupFileLogging(fileLevel)
+        loggerLevel = min(loggerLevel, fileLevel)
+    applogger.setLevel(loggerLevel)
 
 
 def logUnhandledException(excType, excValue, excTrace):
@@ -68,6 +128,3 @@ def logUnhandledException(excType, excValue, excTrace):
     applogger.error(
         "Unhandled exception occurred!", exc_info=(excType, excValue, excTrace)
     )
-
-
-sys.excepthook = logUnhandledException
@@ -0,0 +1,192 @@
+#!/usr/bin/env python3
+
+# Per-stage timings and I/O counters for --metrics in album-art-script.py
+# Everything is a no-op until enable() is called, so normal runs don't pay for it
+# Worker processes record into their own copy, take() the snapshot and send it back,
+# the parent merge()s it, same as the log records
+
+import functools
+import json
+import math
+import threading
+from time import perf_counter
+
+METRIC_PREFIX = "albumart"
+QUANTILES = [0.5, 0.9, 0.95, 0.99]
+
+
+class StageTimer:
+    def __init__(self, metrics, name):
+        self.metrics = metrics
+        self.name = name
+
+    def __enter__(self):
+        self.start = perf_counter()
+        return self
+
+    def __exit__(self, *excInfo):
+        self.metrics.record(self.name, perf_counter() - self.start)
+        return False
+
+
+class NullTimer:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *excInfo):
+        return False
+
+
+NULL_TIMER = NullTimer()
+
+
+class Metrics:
+    def __init__(self):
+        self.enabled = False
+        self.timings = {}
+        self.counters = {}
+        # The plan executor tags from threads
+        self.lock = threading.Lock()
+
+    def enable(self, enabled=True):
+        self.enabled = enabled
+
+    def stage(self, name):
+        # with metrics.stage("tag.save"): ...
+        if not self.enabled:
+            return NULL_TIMER
+        return StageTimer(self, name)
+
+    def record(self, name, seconds):
+        with self.lock:
+            self.timings.setdefault(name, []).append(seconds)
+
+    def count(self, name, amount=1):
+        if not self.enabled:
+            return
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def take(self):
+        # Snapshot for sending to the parent process, starts over afterwards
+        with self.lock:
+            snapshot = {"timings": self.timings, "counters": self.counters}
+            self.timings, self.counters = {}, {}
+        return snapshot
+
+    def merge(self, snapshot):
+        if not snapshot:
+            return
+        with self.lock:
+            for name, seconds in snapshot["timings"].items():
+                self.timings.setdefault(name, []).extend(seconds)
+            for name, amount in snapshot["counters"].items():
+                self.counters[name] = self.counters.get(name, 0) + amount
+
+
+metrics = Metrics()
+
+
+def timedStage(name):
+    # Decorator version of metrics.stage(), for when the whole function is the stage
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not metrics.enabled:
+                return function(*args, **kwargs)
+            with StageTimer(metrics, name):
+                return function(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def peakRssBytes():
+    # ru_maxrss is in KB on Linux, None where there's no resource module (Windows)
+    try:
+        import resource
+    except ImportError:
+        return None, None
+    selfRss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    # Biggest of the worker processes that have already exited
+    childrenRss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * 1024
+    return selfRss, childrenRss
+
+
+def quantile(sortedValues, q):
+    return sortedValues[max(0, math.ceil(q * len(sortedValues)) - 1)]
+
+
+def summarizeTimings(timings):
+    summary = {}
+    for name, seconds in sorted(timings.items()):
+        seconds = sorted(seconds)
+        summary[name] = {
+            "count": len(seconds),
+            "totalSeconds": sum(seconds),
+            "maxSeconds": seconds[-1],
+            **{f"p{int(q * 100)}Seconds": quantile(seconds, q) for q in QUANTILES},
+        }
+    return summary
+
+
+def buildReport(extra=None):
+    # extra is whatever else the caller wants in there, the run summary counts for example
+    selfRss, childrenRss = peakRssBytes()
+    report = {
+        "stages": summarizeTimings(metrics.timings),
+        "counters": dict(sorted(metrics.counters.items())),
+        "peakRssBytes": {"self": selfRss, "children": childrenRss},
+    }
+    if extra:
+        report.update(extra)
+    return report
+
+
+def promName(name):
+    return f"{METRIC_PREFIX}_{name.replace('.', '_')}"
+
+
+def formatJSON(report):
+    return json.dumps(report, indent=2)
+
+
+def formatPrometheus(report):
+    # Text exposition format, for node_exporter's textfile collector and such
+    lines = [f"# TYPE {METRIC_PREFIX}_stage_seconds summary"]
+    for name, summary in report["stages"].items():
+        for q in QUANTILES:
+            lines.append(
+                f'{METRIC_PREFIX}_stage_seconds{{stage="{name}",quantile="{q}"}} '
+                f"{summary[f'p{int(q * 100)}Seconds']:.9f}"
+            )
+        lines.append(
+            f'{METRIC_PREFIX}_stage_seconds_sum{{stage="{name}"}} {summary["totalSeconds"]:.9f}'
+        )
+        lines.append(
+            f'{METRIC_PREFIX}_stage_seconds_count{{stage="{name}"}} {summary["count"]}'
+        )
+    for name, amount in report["counters"].items():
+        lines.append(f"# TYPE {promName(name)}_total counter")
+        lines.append(f"{promName(name)}_total {amount}")
+    lines.append(f"# TYPE {METRIC_PREFIX}_peak_rss_bytes gauge")
+    for process, rss in report["peakRssBytes"].items():
+        if rss is not None:
+            lines.append(f'{METRIC_PREFIX}_peak_rss_bytes{{process="{process}"}} {rss}')
+    for name, value in report.get("run", {}).items():
+        lines.append(f"# TYPE {promName('run.' + name)} gauge")
+        lines.append(f"{promName('run.' + name)} {value}")
+    return "\n".join(lines) + "\n"
+
+
+METRICS_FORMATTERS = {"json": formatJSON, "prometheus": formatPrometheus}
+
+
+def writeReport(report, metricsFormat, metricsPath=None):
+    output = METRICS_FORMATTERS[metricsFormat](report)
+    if metricsPath is None:
+        print(output, end="" if output.endswith("\n") else "\n")
+        return
+    with open(metricsPath, "w") as metricsFile:
+        metricsFile.write(output)
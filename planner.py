@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+
+# Plan files and disk-locality ordering for the two-phase mode, see --plan in album-art-script.py
+# A plan is plain JSON: per album the cover to use, what has to be done to it first (resize or copy),
+# and per track whether art is added, replaced or the track is skipped
+# Albums and tracks are ordered by where they are on disk, so executing a plan walks the disk
+# (or the NFS server's cache) forward instead of seeking all over the place
+
+import json
+import struct
+from os import stat
+
+from logger import applogger
+
+PLAN_VERSION = 1
+
+# Per-track actions
+PLAN_ADD = "add"
+PLAN_REPLACE = "replace"
+PLAN_SKIP = "skip"
+# Per-album cover steps
+PLAN_RESIZE = "resize"
+PLAN_COPY = "copy"
+
+DEFAULT_IO_CONCURRENCY = 4
+
+# FIEMAP ioctl, Linux only, gives the physical offset of a file's first extent without root
+FS_IOC_FIEMAP = 0xC020660B
+FIEMAP_HEADER = struct.Struct("=QQLLLL")
+FIEMAP_EXTENT = struct.Struct("=QQQQQLLLL")
+
+
+class PlanError(Exception):
+    pass
+
+
+def physicalOffset(path):
+    # Returns None where FIEMAP isn't there (other OSes, network filesystems, tmpfs...)
+    try:
+        import fcntl
+    except ImportError:
+        return None
+    request = bytearray(FIEMAP_HEADER.size + FIEMAP_EXTENT.size)
+    # Map the whole file, but only ask for one extent back
+    FIEMAP_HEADER.pack_into(request, 0, 0, 0xFFFFFFFFFFFFFFFF, 0, 0, 1, 0)
+    try:
+        with open(path, "rb") as f:
+            fcntl.ioctl(f.fileno(), FS_IOC_FIEMAP, request, True)
+    except OSError:
+        return None
+    mappedExtents = FIEMAP_HEADER.unpack_from(request)[3]
+    if not mappedExtents:
+        return None
+    return FIEMAP_EXTENT.unpack_from(request, FIEMAP_HEADER.size)[1]
+
+
+def localityKey(path):
+    # Physical offset where we can get it, inode number otherwise, which on most filesystems
+    # roughly follows allocation order. Files that can't be stat()ed go last
+    try:
+        pathStat = stat(path)
+    except OSError:
+        return (1, 0, 0, path)
+    offset = physicalOffset(path)
+    if offset is None:
+        return (0, pathStat.st_dev, pathStat.st_ino, path)
+    return (0, pathStat.st_dev, offset, path)
+
+
+def sortByLocality(paths):
+    return sorted(paths, key=localityKey)
+
+
+def newPlan(root, settings):
+    return {"version": PLAN_VERSION, "root": root, "settings": settings, "albums": []}
+
+
+def countPlanActions(plan):
+    counts = {PLAN_ADD: 0, PLAN_REPLACE: 0, PLAN_SKIP: 0, PLAN_RESIZE: 0, PLAN_COPY: 0}
+    for album in plan["albums"]:
+        for step in album["coverSteps"]:
+            counts[step["action"]] += 1
+        for track in album["tracks"]:
+            counts[track["action"]] += 1
+    return counts
+
+
+def savePlan(plan, planPath):
+    # "-" is stdout, that's the dry run
+    if planPath == "-":
+        print(json.dumps(plan, indent=2))
+        return
+    with open(planPath, "w") as planFile:
+        json.dump(plan, planFile, indent=2)
+    applogger.debug("Plan saved to %s", planPath)
+
+
+def loadPlan(planPath):
+    try:
+        with open(planPath) as planFile:
+            plan = json.load(planFile)
+    except (OSError, ValueError) as e:
+        raise PlanError(f"Couldn't read plan {planPath}: {e}")
+    if not isinstance(plan, dict) or plan.get("version") != PLAN_VERSION:
+        raise PlanError(f"{planPath} is not a version {PLAN_VERSION} plan")
+    return plan
@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+
+# Content-addressed cache of resized covers, see --resize-cache in album-art-script.py
+# Entries are keyed by the hash of the source image bytes plus the resize settings,
+# so box sets, multi-disc albums and compilations sharing a cover only get it decoded and resized once
+# The cache dir is size-bounded, least recently used entries (by mtime, bumped on every hit) go first
+
+from hashlib import sha1
+from os import makedirs, replace, scandir, unlink, utime, getpid
+from os.path import getsize, join
+
+from logger import applogger
+
+DEFAULT_RESIZE_CACHE_SIZE_MB = 1024
+# Evicting down to a bit under the limit, so that not every put() has to rescan the dir
+EVICT_TO_FRACTION = 0.9
+
+
+class ResizeCache:
+    def __init__(self, cacheDir, maxBytes):
+        self.cacheDir = cacheDir
+        self.maxBytes = maxBytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        makedirs(cacheDir, exist_ok=True)
+        # Other processes can write here too, so this is only an estimate between rescans
+        self.totalBytes = sum(size for _, size, _ in self.listEntries())
+
+    def key(self, sourceData, resizeParams):
+        return sha1(sha1(sourceData).digest() + repr(resizeParams).encode()).hexdigest()
+
+    def entryPath(self, key):
+        # Two-level fanout, so no single dir ends up with hundreds of thousands of files
+        return join(self.cacheDir, key[:2], key)
+
+    def listEntries(self):
+        entries = []
+        with scandir(self.cacheDir) as subDirs:
+            for subDir in subDirs:
+                if not subDir.is_dir():
+                    continue
+                with scandir(subDir.path) as files:
+                    for entry in files:
+                        try:
+                            entryStat = entry.stat()
+                        except FileNotFoundError:
+                            continue
+                        entries.append(
+                            (entry.path, entryStat.st_size, entryStat.st_mtime_ns)
+                        )
+        return entries
+
+    def get(self, key):
+        path = self.entryPath(key)
+        try:
+            with open(path, "rb") as entryFile:
+                data = entryFile.read()
+            utime(path)
+        except FileNotFoundError:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return data
+
+    def put(self, key, data):
+        path = self.entryPath(key)
+        makedirs(join(self.cacheDir, key[:2]), exist_ok=True)
+        # Written under a temp name first, so other processes never see half an entry
+        tmpPath = f"{path}.{getpid()}.tmp"
+        with open(tmpPath, "wb") as entryFile:
+            entryFile.write(data)
+        # An entry that's already there (another worker got to it first) is replaced, not added to
+        try:
+            oldSize = getsize(path)
+        except OSError:
+            oldSize = 0
+        replace(tmpPath, path)
+        self.totalBytes += len(data) - oldSize
+        if self.totalBytes > self.maxBytes:
+            self.evict()
+
+    def evict(self):
+        entries = self.listEntries()
+        self.totalBytes = sum(size for _, size, _ in entries)
+        target = self.maxBytes * EVICT_TO_FRACTION
+        for path, size, _ in sorted(entries, key=lambda entry: entry[2]):
+            if self.totalBytes <= target:
+                break
+            try:
+                unlink(path)
+            except FileNotFoundError:
+                pass
+            self.totalBytes -= size
+            self.evictions += 1
+        applogger.debug("Resize cache evicted down to %s bytes", self.totalBytes)
+
+    def takeCounters(self):
+        counters = {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+        self.hits = self.misses = self.evictions = 0
+        return counters
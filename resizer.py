@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+
+# Cover resizing shared by album-art-script.py and convert-album-art-to-jpg.py
+# Big JPEG scans are never decoded at full resolution: draft() makes libjpeg decode straight
+# to 1/2, 1/4 or 1/8 scale, reduce() does a cheap box downscale after that,
+# and only the last small step is done with a proper resampling filter
+# The result is encoded in memory, so callers can write it and embed it without reading it back
+
+from contextlib import nullcontext
+from io import BytesIO
+
+from logger import applogger
+from metrics import metrics
+
+DEFAULT_JPEG_QUALITY = 90
+DEFAULT_JPEG_SUBSAMPLING = "4:2:0"
+JPEG_SUBSAMPLINGS = ["4:4:4", "4:2:2", "4:2:0"]
+# Decoded images over this are refused instead of eating all the memory, ~400 MB as RGBA
+DEFAULT_MAX_DECODE_MEGAPIXELS = 100
+# How much bigger than the target the image is kept before the final resample, same as PIL's default
+REDUCING_GAP = 2.0
+# Background for transparent covers saved as JPEG
+JPEG_BACKGROUND = (255, 255, 255)
+
+SAVE_FORMATS = {"jpg": "JPEG", "jpeg": "JPEG", "png": "PNG"}
+DEFAULT_MAX_DECODED_IMAGES = 2
+
+# Caps how many images are decoded at once, see setDecodeSlots()
+decodeSlots = None
+
+
+class ResizeError(Exception):
+    pass
+
+
+def flattenTransparency(image):
+    # JPEG can't do alpha, put the image on a white background instead of letting PIL drop it
+    from PIL import Image as PILImage
+
+    if image.mode == "P":
+        image = image.convert("RGBA" if "transparency" in image.info else "RGB")
+    if image.mode in ("RGBA", "LA"):
+        background = PILImage.new("RGB", image.size, JPEG_BACKGROUND)
+        background.paste(image, mask=image.getchannel("A"))
+        return background
+    if image.mode != "RGB":
+        return image.convert("RGB")
+    return image
+
+
+def setDecodeSlots(slots):
+    # slots is a threading or multiprocessing BoundedSemaphore, the latter is shared by worker processes
+    # A decoded cover can be hundreds of MB, so this is what keeps the memory use flat
+    global decodeSlots
+    decodeSlots = slots
+
+
+def resizeImage(
+    source,
+    resizeDim,
+    saveExt="jpg",
+    quality=DEFAULT_JPEG_QUALITY,
+    progressive=False,
+    subsampling=DEFAULT_JPEG_SUBSAMPLING,
+    maxDecodeMegapixels=DEFAULT_MAX_DECODE_MEGAPIXELS,
+):
+    # source is a path or a file-like object, returns (encoded bytes, (width, height))
+    from PIL import Image as PILImage
+
+    saveFormat = SAVE_FORMATS.get(saveExt.lower())
+    if saveFormat is None:
+        raise ResizeError(f"Can't save covers as {saveExt}")
+
+    # DecompressionBombError isn't an OSError, it's turned into a ResizeError like the decode limit;
+    # the source is closed on every way out, the images made from it along the way are closed below
+    try:
+        with PILImage.open(source) as image:
+            sourceSize, sourceMode = image.size, image.mode
+            if image.format == "JPEG":
+                # Decode at the smallest 1/2^n scale that's still at least REDUCING_GAP times the target
+                gapDim = int(resizeDim * REDUCING_GAP)
+                image.draft("RGB", (gapDim, gapDim))
+
+            width, height = image.size
+            if width * height > maxDecodeMegapixels * 1_000_000:
+                raise ResizeError(
+                    f"{width}x{height} image is over the {maxDecodeMegapixels} MP decode limit"
+                )
+            # Waits here while other threads/workers have their max of images decoded
+            with decodeSlots or nullcontext():
+                with metrics.stage("resize.decode"):
+                    image.load()
+                metrics.count("image.sourcePixels", sourceSize[0] * sourceSize[1])
+                metrics.count("image.decodedPixels", width * height)
+
+                # Integer box downscale, a lot cheaper than running LANCZOS over the whole thing
+                factor = int(max(width, height) / (resizeDim * REDUCING_GAP))
+                if factor >= 2:
+                    image = image.reduce(factor)
+                image.thumbnail(
+                    (resizeDim, resizeDim), PILImage.LANCZOS, reducing_gap=None
+                )
+
+                saveOptions = {}
+                if saveFormat == "JPEG":
+                    image = flattenTransparency(image)
+                    saveOptions = {
+                        "quality": quality,
+                        "progressive": progressive,
+                        "subsampling": subsampling,
+                        "optimize": True,
+                    }
+
+                output = BytesIO()
+                with metrics.stage("resize.encode"):
+                    image.save(output, saveFormat, **saveOptions)
+                resizedSize = image.size
+                # Let go of the pixels before the next image gets its turn
+                image.close()
+                del image
+    except PILImage.DecompressionBombError as e:
+        raise ResizeError(str(e)) from e
+    applogger.debug(
+        "Resized %s %s image to %s, %s bytes",
+        sourceSize,
+        sourceMode,
+        resizedSize,
+        output.tell(),
+    )
+    return output.getvalue(), resizedSize
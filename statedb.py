@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+
+# Persistent per-track state for incremental re-runs, see --state-db in album-art-script.py
+# A track is only looked at again if its size/mtime changed, or if the cover it was tagged with did
+
+from os import stat
+from time import time
+
+from logger import applogger
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS tracks (
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    action TEXT NOT NULL,
+    result TEXT NOT NULL,
+    cover_path TEXT,
+    cover_size INTEGER,
+    cover_mtime_ns INTEGER,
+    cover_hash TEXT,
+    mime TEXT,
+    updated_at REAL NOT NULL
+)
+"""
+
+# What processAlbum() did to a track
+ACTION_SKIP = "skip"  # already had art, left alone
+ACTION_ADD = "add"
+ACTION_REPLACE = "replace"
+
+RESULT_OK = "ok"
+RESULT_FAILED = "failed"
+
+
+def statOrNone(path):
+    try:
+        return stat(path)
+    except OSError:
+        return None
+
+
+class TrackStateDB:
+    def __init__(self, dbPath):
+        # Not imported at the top, runs without --state-db don't need it
+        import sqlite3
+
+        self.connection = sqlite3.connect(dbPath)
+        # One commit per album, WAL keeps that from being an fsync fest
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute(SCHEMA)
+        self.connection.commit()
+        applogger.debug("Opened track state database %s", dbPath)
+
+    def close(self):
+        self.connection.close()
+
+    def getAlbumRows(self, songPaths):
+        rows = {}
+        # Chunked, since sqlite has a limit on the number of query parameters
+        for i in range(0, len(songPaths), 500):
+            chunk = songPaths[i : i + 500]
+            query = (
+                "SELECT path, size, mtime_ns, action, result, cover_path, cover_size, cover_mtime_ns "
+                f"FROM tracks WHERE path IN ({','.join('?' * len(chunk))})"
+            )
+            for row in self.connection.execute(query, chunk):
+                rows[row[0]] = row
+        return rows
+
+    def filterChanged(self, songPaths, currentCoverPath, editAll):
+        # Returns the tracks that have to be processed again, costs one stat() per track
+        # currentCoverPath is what the cover lookup finds in the album dir right now (or None)
+        rows = self.getAlbumRows(songPaths)
+        coverStats = {}
+        changed = []
+        for songPath in songPaths:
+            row = rows.get(songPath)
+            songStat = statOrNone(songPath)
+            if row is None or songStat is None:
+                changed.append(songPath)
+                continue
+            _, size, mtimeNs, action, result, coverPath, coverSize, coverMtimeNs = row
+            if (size, mtimeNs) != (songStat.st_size, songStat.st_mtime_ns):
+                changed.append(songPath)
+            elif result != RESULT_OK:
+                changed.append(songPath)
+            elif action == ACTION_SKIP:
+                # Track had its own art, that only matters again if we're told to edit everything
+                if editAll:
+                    changed.append(songPath)
+            else:
+                # Tagged by us: redo it if a different cover shows up, or the same one has been changed
+                if currentCoverPath is not None and currentCoverPath != coverPath:
+                    changed.append(songPath)
+                    continue
+                if coverPath not in coverStats:
+                    coverStats[coverPath] = statOrNone(coverPath)
+                coverStat = coverStats[coverPath]
+                if coverStat is None or (coverSize, coverMtimeNs) != (
+                    coverStat.st_size,
+                    coverStat.st_mtime_ns,
+                ):
+                    changed.append(songPath)
+        return changed
+
+    def record(self, trackResults):
+        # trackResults come from processAlbum(), see recordTrackResult() in albumtagger.py
+        rows = []
+        for trackResult in trackResults:
+            songStat = statOrNone(trackResult["path"])
+            if songStat is None:
+                continue
+            coverStat = (
+                statOrNone(trackResult["coverPath"])
+                if trackResult["coverPath"]
+                else None
+            )
+            rows.append(
+                (
+                    trackResult["path"],
+                    songStat.st_size,
+                    songStat.st_mtime_ns,
+                    trackResult["action"],
+                    trackResult["result"],
+                    trackResult["coverPath"],
+                    coverStat.st_size if coverStat else None,
+                    coverStat.st_mtime_ns if coverStat else None,
+                    trackResult["coverHash"],
+                    trackResult["mime"],
+                    time(),
+                )
+            )
+        self.connection.executemany(
+            "INSERT OR REPLACE INTO tracks VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            rows,
+        )
+        self.connection.commit()
@@ -0,0 +1,183 @@
+#!/usr/bin/env python3
+
+# Change notification for --watch in album-art-script.py
+# inotify (through libc, no extra packages) where there is one, polling the tree otherwise
+# Both hand out paths of files that have been written, moved in or created since the last read(),
+# the caller does the debouncing and the filtering
+
+import select
+import struct
+from os import close as closeFd
+from os import read as readFd
+from os import stat
+from os import walk as walkDir
+from os import O_CLOEXEC, O_NONBLOCK
+from os.path import join
+from os.path import splitext as fileExtension
+from time import monotonic, sleep
+
+from logger import applogger
+
+DEFAULT_POLL_INTERVAL = 30.0
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+# Files are only interesting once they're complete, dirs as soon as they show up, so they get watched
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+EVENT_HEADER = struct.Struct("iIII")
+READ_SIZE = 64 * 1024
+
+
+class WatchError(Exception):
+    pass
+
+
+def isWanted(fileName, wantedExts):
+    return fileExtension(fileName)[1].lower().strip(".") in wantedExts
+
+
+class InotifyWatcher:
+    def __init__(self, rootDir, wantedExts):
+        import ctypes
+        import ctypes.util
+
+        self.wantedExts = wantedExts
+        self.rootDir = rootDir
+        self.libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        if not hasattr(self.libc, "inotify_init1"):
+            raise WatchError("No inotify in this libc")
+        self.getErrno = ctypes.get_errno
+        self.fd = self.libc.inotify_init1(O_NONBLOCK | O_CLOEXEC)
+        if self.fd < 0:
+            raise WatchError(f"inotify_init1 failed, errno {self.getErrno()}")
+        # Watch descriptor -> dir, dirs that go away drop out of here again (IN_IGNORED)
+        self.watches = {}
+        try:
+            self.watchTree(rootDir)
+        except WatchError:
+            self.close()
+            raise
+
+    def watchTree(self, topDir):
+        # Returns the wanted files already in there, for dirs that have been moved in whole
+        found = []
+        for dirPath, subDirs, fileNames in walkDir(topDir):
+            watchDescriptor = self.libc.inotify_add_watch(
+                self.fd, dirPath.encode(), WATCH_MASK
+            )
+            if watchDescriptor < 0:
+                # Most likely ENOSPC, fs.inotify.max_user_watches is too low for the library
+                raise WatchError(f"Couldn't watch {dirPath}, errno {self.getErrno()}")
+            self.watches[watchDescriptor] = dirPath
+            found.extend(
+                join(dirPath, fileName)
+                for fileName in fileNames
+                if isWanted(fileName, self.wantedExts)
+            )
+        return found
+
+    def read(self, timeout):
+        # Blocks for up to timeout seconds (None for as long as it takes)
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return []
+        changed = []
+        try:
+            data = readFd(self.fd, READ_SIZE)
+        except BlockingIOError:
+            return []
+        offset = 0
+        while offset < len(data):
+            watchDescriptor, mask, _, nameSize = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size
+            name = (
+                data[offset : offset + nameSize]
+                .rstrip(b"\0")
+                .decode(errors="surrogateescape")
+            )
+            offset += nameSize
+
+            if mask & IN_Q_OVERFLOW:
+                # Events got lost, the only way to be sure is to look at everything again
+                applogger.warning("inotify queue overflowed, rescanning the whole tree")
+                changed.extend(self.watchTree(self.rootDir))
+                continue
+            if mask & IN_IGNORED:
+                self.watches.pop(watchDescriptor, None)
+                continue
+            dirPath = self.watches.get(watchDescriptor)
+            if dirPath is None:
+                continue
+            path = join(dirPath, name)
+            if mask & IN_ISDIR:
+                if mask & (IN_CREATE | IN_MOVED_TO):
+                    try:
+                        changed.extend(self.watchTree(path))
+                    except WatchError as e:
+                        applogger.error(str(e))
+            elif mask & (IN_CLOSE_WRITE | IN_MOVED_TO) and isWanted(
+                name, self.wantedExts
+            ):
+                changed.append(path)
+        return changed
+
+    def close(self):
+        if self.fd >= 0:
+            closeFd(self.fd)
+            self.fd = -1
+
+
+class PollingWatcher:
+    # Keeps (size, mtime) of every wanted file, so memory follows the library size, not the uptime
+    def __init__(self, rootDir, wantedExts, pollInterval):
+        self.rootDir = rootDir
+        self.wantedExts = wantedExts
+        self.pollInterval = pollInterval
+        self.snapshot = self.scan()
+        self.nextPoll = monotonic() + pollInterval
+
+    def scan(self):
+        snapshot = {}
+        for dirPath, _, fileNames in walkDir(self.rootDir):
+            for fileName in fileNames:
+                if not isWanted(fileName, self.wantedExts):
+                    continue
+                path = join(dirPath, fileName)
+                try:
+                    fileStat = stat(path)
+                except OSError:
+                    continue
+                snapshot[path] = (fileStat.st_size, fileStat.st_mtime_ns)
+        return snapshot
+
+    def read(self, timeout):
+        waitFor = self.nextPoll - monotonic()
+        if timeout is not None and timeout < waitFor:
+            sleep(max(0.0, timeout))
+            return []
+        sleep(max(0.0, waitFor))
+        self.nextPoll = monotonic() + self.pollInterval
+        snapshot = self.scan()
+        changed = [
+            path
+            for path, signature in snapshot.items()
+            if self.snapshot.get(path) != signature
+        ]
+        self.snapshot = snapshot
+        return changed
+
+    def close(self):
+        self.snapshot = {}
+
+
+def openWatcher(rootDir, wantedExts, pollInterval=DEFAULT_POLL_INTERVAL, poll=False):
+    if not poll:
+        try:
+            return InotifyWatcher(rootDir, wantedExts)
+        except (WatchError, OSError, AttributeError) as e:
+            applogger.warning(f"Can't use inotify ({e}), polling every {pollInterval}s")
+    return PollingWatcher(rootDir, wantedExts, pollInterval)